@@ -0,0 +1,241 @@
+"""
+ASF search queries with an on-disk cache of the results.
+
+A search over a long period is split into pages of one calendar month (the
+part of the month inside the period), each page is fetched with one JSON
+request and its records are cached in a file keyed by the query parameters.
+The cache can be shared by concurrent searches (threads), each page is then
+queried only once.
+Cached pages are re-used until they are older than the TTL; pages of closed
+periods (ending more than closed_days ago, when no new products are added to
+the catalogue any more) are never queried again. Repeated checks of the same
+year or month therefore need no request at all, and overlapping periods
+(e.g. a year and one of its months) share the cached month pages.
+
+CSV files for download-all.py are written from the cached records
+(records_to_csv), so no second query in CSV format is needed.
+"""
+import csv
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+# ASF search API (can be replaced with a local test server, see mock_asf.py)
+ASF_API = "https://api.daac.asf.alaska.edu/services/search/param"
+
+# Seconds after which cached results of open periods are queried again
+QUERY_TTL = 24 * 3600
+
+# Days after the end of a period after which it is considered closed
+CLOSED_DAYS = 30
+
+# Columns of the ASF CSV output and the matching fields of the JSON records
+CSV_FIELDS = [
+    ("Granule Name", "granuleName"),
+    ("Platform", "platform"),
+    ("Sensor", "sensor"),
+    ("Beam Mode", "beamMode"),
+    ("Beam Mode Description", "beamModeDesc"),
+    ("Orbit", "absoluteOrbit"),
+    ("Path Number", "relativeOrbit"),
+    ("Frame Number", "frameNumber"),
+    ("Acquisition Date", "sceneDate"),
+    ("Processing Date", "processingDate"),
+    ("Processing Level", "processingLevel"),
+    ("Start Time", "startTime"),
+    ("End Time", "stopTime"),
+    ("Ascending or Descending?", "flightDirection"),
+    ("URL", "downloadUrl"),
+    ("Size (MB)", "sizeMB"),
+    ("MD5", "md5sum")
+]
+
+
+def to_utc(dt):
+    """Returns timezone-aware datetime in UTC (naive datetimes are UTC, as
+    in the search API)."""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def month_pages(start, end):
+    """Splits period [start, end) into (start, end) of each calendar month
+    (timezone-aware datetime in UTC)."""
+    pages = []
+    page_start, end = to_utc(start), to_utc(end)
+    while page_start < end:
+        if page_start.month == 12:
+            next_month = datetime(page_start.year + 1, 1, 1,
+                                  tzinfo=timezone.utc)
+        else:
+            next_month = datetime(page_start.year, page_start.month + 1, 1,
+                                  tzinfo=timezone.utc)
+        pages.append((page_start, min(end, next_month)))
+        page_start = next_month
+    return pages
+
+
+class QueryCache:
+    """Cache of search results in a folder (one JSON file per page).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache folder.
+    ttl : float
+        Seconds after which cached results of open periods are stale.
+    closed_days : float
+        Pages that end more than closed_days before the time of the query
+        are closed and never stale.
+    """
+    def __init__(self, cache_dir, ttl=QUERY_TTL, closed_days=CLOSED_DAYS):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.closed_days = closed_days
+        os.makedirs(cache_dir, exist_ok=True)
+        self.stats = {"cached": 0, "queried": 0}
+        self._lock = threading.Lock()
+        self._page_locks = {}
+
+    def __repr__(self):
+        return (f"QueryCache({self.cache_dir!r}, ttl={self.ttl}, "
+                f"closed_days={self.closed_days})")
+
+    @staticmethod
+    def key(params):
+        """Returns cache key of the query parameters."""
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _path(self, params):
+        return os.path.join(self.cache_dir, self.key(params) + ".json")
+
+    def lock(self, params):
+        """Returns lock of the query (held while a page is fetched)."""
+        with self._lock:
+            return self._page_locks.setdefault(self.key(params),
+                                               threading.Lock())
+
+    def count(self, key):
+        """Increments stats[key] (thread-safe)."""
+        with self._lock:
+            self.stats[key] += 1
+
+    def get(self, params):
+        """Returns cached records of the query (None if they are missing or
+        stale)."""
+        path = self._path(params)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            entry = json.load(f)
+        if entry["closed"]:
+            return entry["records"]
+        # Older caches stored the time of the query as a timestamp
+        fetched = entry["fetched"]
+        if isinstance(fetched, (int, float)):
+            fetched = datetime.fromtimestamp(fetched, timezone.utc)
+        else:
+            fetched = datetime.fromisoformat(fetched)
+        if datetime.now(timezone.utc) - fetched > timedelta(seconds=self.ttl):
+            return None
+        return entry["records"]
+
+    def put(self, params, records, closed):
+        """Stores records of the query (written atomically)."""
+        path = self._path(params)
+        entry = {"params": params,
+                 "fetched": datetime.now(timezone.utc).isoformat(),
+                 "closed": closed, "records": records}
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def report(self):
+        return (f"Query cache {self.cache_dir}: {self.stats['cached']} pages "
+                f"from cache, {self.stats['queried']} queried")
+
+
+def query_page(aoi, start, end, api_url=ASF_API, session=None):
+    """Sends one search request (JSON) and returns the list of records."""
+    params = {
+        "platform": "Sentinel-1",
+        "polygon": aoi,
+        "start": f"{to_utc(start):%Y-%m-%dT%H:%M:%S}Z",
+        "end": f"{to_utc(end):%Y-%m-%dT%H:%M:%S}Z",
+        "processingLevel": "SLC",
+        "output": "JSON"
+    }
+    res = (session or requests).get(api_url, params=params, timeout=300)
+    if res.status_code != 200:
+        raise Exception(f"ASF search failed ({res.status_code}): {res.text}")
+    return res.json()[0]
+
+
+def search(aoi, start, end, api_url=ASF_API, cache=None, session=None):
+    """Returns records (JSON output of the search API) of all SLC products in
+    the AOI acquired in [start, end) (datetime, naive ones are UTC).
+
+    Parameters
+    ----------
+    aoi : str
+        Polygon (lon,lat,lon,lat,...).
+    start, end : datetime
+        Searched period (one request per calendar month).
+    api_url : str
+        URL of the search API.
+    cache : QueryCache or str (optional)
+        Cache (or path to the cache folder) for the results.
+    session : requests.Session (optional)
+        Session used for the requests.
+
+    Returns
+    -------
+    records : list(dict)
+        Records of the products (each product once).
+    """
+    if isinstance(cache, str):
+        cache = QueryCache(cache)
+    records = []
+    seen = set()
+    for page_start, page_end in month_pages(start, end):
+        # Same keys as for the naive UTC datetimes of older caches
+        params = {"api": api_url, "aoi": aoi,
+                  "start": f"{page_start:%Y-%m-%dT%H:%M:%S}",
+                  "end": f"{page_end:%Y-%m-%dT%H:%M:%S}"}
+        if cache:
+            with cache.lock(params):
+                page = cache.get(params)
+                if page is None:
+                    queried = datetime.now(timezone.utc)
+                    page = query_page(aoi, page_start, page_end, api_url,
+                                      session)
+                    closed = page_end < queried - timedelta(
+                        days=cache.closed_days)
+                    cache.put(params, page, closed)
+                    cache.count("queried")
+                else:
+                    cache.count("cached")
+        else:
+            page = query_page(aoi, page_start, page_end, api_url, session)
+        for record in page:
+            if record["granuleName"] not in seen:
+                seen.add(record["granuleName"])
+                records.append(record)
+    return records
+
+
+def records_to_csv(records, csv_path):
+    """Writes records as CSV file of the ASF search (for download-all.py)."""
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([a[0] for a in CSV_FIELDS])
+        for record in records:
+            writer.writerow([record.get(a[1], "") for a in CSV_FIELDS])
+    return csv_path
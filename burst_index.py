@@ -0,0 +1,158 @@
+"""
+Spatial index of burst footprints.
+
+To decide which bursts of a product overlap the bbox, read_bursts() has to
+know the extents of every burst. Without an index each burst raster (on a
+network share) is opened for every combo, tile and week and tested against
+the bbox one by one.
+
+BurstIndex keeps the footprint (extents from the raster header, read once)
+and the raster files of each burst folder in a GeoSeries with a spatial index
+(R-tree, geopandas sindex), so "which bursts touch this bbox (tile)" is one
+indexed query. VV and VH rasters of a burst have the same extents, so the
+footprints are shared by all combos. One index is used for the whole run
+(all weeks and combos) and it is passed to the tile workers together with
+the other settings of the process.
+"""
+import glob
+import os
+import threading
+
+import geopandas as gpd
+import rasterio
+from shapely.geometry import box
+
+
+class BurstIndex:
+    """Footprints of burst folders with a spatial index.
+
+    Bursts are added with update() (headers of unknown bursts are read),
+    the spatial index is rebuilt on the next query after new bursts were
+    added.
+    """
+    def __init__(self):
+        self.folders = []
+        self.footprints = []
+        self.files = []
+        self._position = {}
+        self._series = None
+        self._lock = threading.Lock()
+        self.stats = self._empty_stats()
+
+    # Index is passed to tile workers (without the spatial index, it is
+    # rebuilt by the worker on the first query)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_series"] = None
+        state["stats"] = self._empty_stats()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_stats():
+        return {"headers": 0, "queries": 0, "builds": 0}
+
+    def __len__(self):
+        return len(self.folders)
+
+    def __contains__(self, folder):
+        return folder in self._position
+
+    def add(self, folder, bounds, files):
+        """Adds burst folder with its extents (x_min, y_min, x_max, y_max)
+        and list of its raster files."""
+        with self._lock:
+            self._add(folder, bounds, files)
+
+    def _add(self, folder, bounds, files):
+        if folder in self._position:
+            return
+        self._position[folder] = len(self.folders)
+        self.folders.append(folder)
+        self.footprints.append(box(*bounds))
+        self.files.append(files)
+        self._series = None
+
+    def update(self, folders):
+        """Adds all burst folders that are not in the index yet (reads the
+        header of one raster in each folder). Returns number of added
+        folders."""
+        with self._lock:
+            new = [a for a in dict.fromkeys(folders) if a not in self._position]
+        for folder in new:
+            files = sorted(glob.glob(os.path.join(folder, "*.img")))
+            if not files:
+                continue
+            with rasterio.open(files[0]) as src:
+                bounds = src.bounds
+            with self._lock:
+                self._add(folder, bounds, files)
+                self.stats["headers"] += 1
+        return len(new)
+
+    def update_products(self, to_aggregate):
+        """Adds bursts of all products in to_aggregate (list of (product,
+        list of burst folders))."""
+        return self.update([a for _, bursts in to_aggregate for a in bursts])
+
+    def footprint(self, folder):
+        """Returns footprint (box) of the burst folder."""
+        return self.footprints[self._position[folder]]
+
+    def burst_file(self, folder, polarity):
+        """Returns path to the raster of the burst folder for polarity."""
+        for path in self.files[self._position[folder]]:
+            if polarity in os.path.basename(path):
+                return path
+        raise Exception(f"No {polarity} raster in {folder}")
+
+    def query(self, bbox, folders=None):
+        """Returns set of burst folders whose footprints intersect bbox
+        (x_min, y_min, x_max, y_max), only from folders if given."""
+        with self._lock:
+            self.stats["queries"] += 1
+            if not self.folders:
+                return set()
+            if self._series is None:
+                self._series = gpd.GeoSeries(self.footprints)
+                self.stats["builds"] += 1
+            series = self._series
+            found = {self.folders[i] for i in series.sindex.query(
+                box(*bbox), predicate="intersects")}
+        if folders is not None:
+            found &= set(folders)
+        return found
+
+    def add_stats(self, stats):
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] += stats[key]
+
+    def pop_stats(self):
+        with self._lock:
+            stats = self.stats
+            self.stats = self._empty_stats()
+        return stats
+
+    def report(self):
+        st = self.stats
+        return (f"Burst index: {len(self)} bursts, {st['headers']} headers "
+                f"read, {st['queries']} queries, {st['builds']} builds")
+
+
+# Index used by the processing routines (None = read extents of each burst)
+_burst_index = None
+
+
+def set_burst_index(index):
+    """Sets the burst index for this process (None to disable it)."""
+    global _burst_index
+    _burst_index = index
+
+
+def get_burst_index():
+    return _burst_index
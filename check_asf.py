@@ -5,20 +5,85 @@ Finds:
     - missing files (creates CSV for download)
     - surplus files (moves to a desired folder)
 
+Downloaded products are compared by full granule name with the indexed
+inventory of the download folder (inventory.py), which is updated
+incrementally on each call. Search results are cached (asf_search.py), the
+CSV file of missing products is written from the cached records.
+
+check_asf_batch() checks many (AOI, period) pairs at once: the searches run
+concurrently, the inventory is updated once and one report and one download
+list are written for all of them.
 """
-import glob
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from os import makedirs
 from os.path import join, basename
 
-import pandas as pd
-import requests
+from asf_search import ASF_API, QueryCache, records_to_csv, search
+from inventory import INVENTORY_FILE, Inventory
+
+# Default name of the query cache folder (in the archive folder)
+QUERY_CACHE_DIR = "_asf_queries"
+
+
+def search_period(year=None, month=None, start_date=None, end_date=None):
+    """Returns start and end (exclusive) of the searched period as datetime:
+    interval between start_date and end_date (YYYYmmdd, inclusive), one month
+    or one year."""
+    if start_date and end_date:
+        start = datetime.strptime(start_date, "%Y%m%d")
+        end = datetime.strptime(end_date, "%Y%m%d")
+        return start, end.replace(hour=23, minute=59, second=59)
+    if month is None:
+        return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    if month == 12:
+        return datetime(year, 12, 1), datetime(year + 1, 1, 1)
+    return datetime(year, month, 1), datetime(year, month + 1, 1)
+
+
+def period_args(period):
+    """Returns search_period() arguments of a period given as year (int),
+    (year, month) or (start_date, end_date) (YYYYmmdd)."""
+    if isinstance(period, int):
+        return {"year": period}
+    if isinstance(period[0], int):
+        return {"year": period[0], "month": period[1]}
+    return {"start_date": period[0], "end_date": period[1]}
+
+
+def period_label(period):
+    """Returns name of the period for reports."""
+    if isinstance(period, int):
+        return str(period)
+    if isinstance(period[0], int):
+        return f"{period[0]}-{period[1]:02}"
+    return f"{period[0]}-{period[1]}"
 
 
 def check_asf(aoi, src_pth, copy_to_folder, year=None, month=None,
-              start_date=None, end_date=None):
+              start_date=None, end_date=None, api_url=ASF_API,
+              inventory=None, query_cache=None):
+    """Compares products in src_pth with the ASF search results for the AOI
+    and period, writes a log file and a CSV file of the missing products
+    (for download-all.py) to src_pth.
+
+    The inventory (inventory.Inventory) and the cache of search results
+    (asf_search.QueryCache) are kept in src_pth by default. The inventory is
+    updated before the log file is written, afterwards the new modification
+    time of src_pth is stored, so the next update does not rescan it.
+    """
     makedirs(copy_to_folder, exist_ok=True)
+    own_inventory = inventory is None
+    if own_inventory:
+        inventory = Inventory(join(src_pth, INVENTORY_FILE))
+    if query_cache is None:
+        query_cache = QueryCache(join(src_pth, QUERY_CACHE_DIR))
+
+    # UPDATE INVENTORY OF ALREADY DOWNLOADED (before files are written to
+    # src_pth)
+    inv_stats = inventory.update(src_pth)
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # a) Initiate log file for saving results
 
@@ -41,73 +106,39 @@ def check_asf(aoi, src_pth, copy_to_folder, year=None, month=None,
     logfile.write(f"Source folder: {src_pth}\n")
     logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
 
-    # b) Build url
-    if start_date and end_date:
-        qs = (start_date[0:4], start_date[4:5], start_date[5:6])
-        qe = (end_date[0:4], end_date[4:5], end_date[5:6])
-        q_start = f"&start={qs[0]}-{qs[1]}-{qs[2]}T00:00:00Z"
-        q_end = f"&end={qe[0]}-{qe[1]}-{qe[2]}T23:59:59.99Z"
-    elif month is None:
-        q_start = f"&start={year}-01-01T00:00:00Z"
-        q_end = f"&end={year + 1}-01-01T00:00:00Z"
-    else:
-        q_start = f"&start={year}-{month:02}-01T00:00:00Z"
-        if month == 12:
-            q_end = f"&end={year + 1}-01-01T00:00:00Z"
-        else:
-            q_end = f"&end={year}-{month + 1:02}-01T00:00:00Z"
-
-    url = ("https://api.daac.asf.alaska.edu/services/search/param?"
-           "platform=Sentinel-1"
-           f"&polygon={aoi}"
-           f"{q_start}{q_end}"
-           "&processingLevel=SLC"
-           "&output=JSON")
+    # b) Searched period
+    p_start, p_end = search_period(year, month, start_date, end_date)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # SEARCH FOLDER FOR ALREADY DOWNLOADED
-    if start_date and end_date:
-        # TODO: search for specific interval (probably have to loop glob with all dates)
-        search_zip_files = f"*{year}*.zip"
-    elif month is None:
-        search_zip_files = f"*{year}*.zip"
-    else:
-        search_zip_files = f"*{year}{month:02}*.zip"
-
-    q = join(src_pth, search_zip_files)
-    downloaded = glob.glob(q)
-    in_folder_files = [a[-8:-4] for a in downloaded]
+    # FILES ALREADY DOWNLOADED
+    in_folder_files = inventory.granules(p_start, p_end, folder=src_pth)
     logfile.write(f"Number of files in folder: {len(in_folder_files)}\n")
+    logfile.write(f"Inventory: {inventory.db_path} (updated in "
+                  f"{inv_stats['time']:.2f} s, {inv_stats['added']} added, "
+                  f"{inv_stats['changed']} changed, {inv_stats['removed']} "
+                  f"removed)\n")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # GET LIST OF FILES FROM SERVER
-    res = requests.get(url)
-    if res.status_code != 200:
-        print(res.status_code)
-    res_json = res.json()[0]
-    on_server_codes = [file['sceneId'][-4:] for file in res_json]
-    logfile.write(f"Number of files on server: {len(on_server_codes)}\n")
+    # GET LIST OF FILES FROM SERVER (or from the query cache)
+    res_json = search(aoi, p_start, p_end, api_url, query_cache)
+    on_server = {file['granuleName'] for file in res_json}
+    logfile.write(f"Number of files on server: {len(on_server)}\n")
+    logfile.write(f"{query_cache.report()}\n")
     logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # COMPARE AND CREATE THREE LISTS: downloaded, missing and to be moved
 
-    already_downloaded = []
-    have_to_download = []
-    have_to_download_codes = []
-    for product in res_json:
-        if product['sceneId'][-4:] in in_folder_files:
-            already_downloaded.append(product['sceneId'][-4:])
-        else:
-            have_to_download.append(product['granuleName'])
-            have_to_download_codes.append(product['sceneId'][-4:])
+    already_downloaded, have_to_download, surplus = inventory.compare(
+        on_server, p_start, p_end, folder=src_pth)
+    have_to_download = sorted(have_to_download)
 
     # Files not covering NL AOI,probably Denmark
-    files_not_needed = list(set(in_folder_files) - set(on_server_codes))
+    files_not_needed = sorted(surplus)
 
     logfile.write(f"Already downloaded files: {len(already_downloaded)}\n")
     logfile.write("----\n")
-    logfile.write(f"Missing {len(have_to_download_codes)} files:\n")
+    logfile.write(f"Missing {len(have_to_download)} files:\n")
     if have_to_download:
         [logfile.write(f"{text}\n") for text in have_to_download]
     else:
@@ -121,20 +152,20 @@ def check_asf(aoi, src_pth, copy_to_folder, year=None, month=None,
     logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Create CSV file, do another request and filter out the dataframe for
-    # only the files that are missing from the folder
+    # Create CSV file from the search results, only for the files that are
+    # missing from the folder
     if have_to_download:
-        asf_df = pd.read_csv(url[:-4] + "CSV")
-        asf_df = asf_df[asf_df["Granule Name"].isin(have_to_download)]
+        missing = [a for a in res_json
+                   if a['granuleName'] not in already_downloaded]
 
-        if not asf_df.empty:
+        if missing:
             if month is None:
                 csv_name = f"missing_ASF_{year}-all--{timestr}"
             else:
                 csv_name = f"missing_ASF_{year}-{month}--{timestr}"
 
             csv_name = join(src_pth, csv_name + ".csv")
-            asf_df.to_csv(csv_name, index=False)
+            records_to_csv(missing, csv_name)
 
             logfile.write("Created CSV file for bulk download of missing data:\n")
             logfile.write(f" {csv_name}\n")
@@ -145,8 +176,7 @@ def check_asf(aoi, src_pth, copy_to_folder, year=None, month=None,
     # if files_not_needed:
     #     logfile.write("The following files have been moved:\n")
     #     for i, undesired in enumerate(files_not_needed):
-    #         q = join(src_pth, f"*{undesired}*.zip")
-    #         src = glob.glob(q)[0]
+    #         src = surplus[undesired]
     #         dst = join(copy_to_folder, basename(src))
     #         print(f"Moving file {i+1}/{len(files_not_needed)}")
     #         try:
@@ -161,10 +191,157 @@ def check_asf(aoi, src_pth, copy_to_folder, year=None, month=None,
     # CLEAN-UP
 
     logfile.close()
+    # The log and CSV files changed the modification time of src_pth
+    inventory.refresh_folder(src_pth)
+    if own_inventory:
+        inventory.close()
 
     return f"Finished {year} {month}!"
 
 
+def check_asf_batch(jobs, src_pth, api_url=ASF_API, workers=4,
+                    inventory=None, query_cache=None):
+    """Compares products in src_pth with the ASF search results of several
+    AOIs and periods.
+
+    The searches run concurrently (at most workers at once, pages shared by
+    several jobs are queried once), the inventory of src_pth is updated once
+    for all jobs. Writes one report (per job and merged numbers, all missing
+    and surplus products) and one CSV file of all missing products (for
+    download-all.py) to src_pth. Afterwards the new modification time of
+    src_pth is stored in the inventory, so the next update does not rescan
+    it.
+
+    Parameters
+    ----------
+    jobs : list(tuple)
+        (name, aoi, period) of each check, the period is a year (int),
+        (year, month) or (start_date, end_date) (YYYYmmdd).
+    src_pth : str
+        Download folder.
+    api_url : str
+        URL of the ASF search API.
+    workers : int
+        Maximum number of concurrent searches.
+    inventory : inventory.Inventory (optional)
+        Inventory of src_pth, default is kept in src_pth.
+    query_cache : asf_search.QueryCache (optional)
+        Cache of search results, default is kept in src_pth.
+
+    Returns
+    -------
+    report_name : str
+        Path to the report.
+    csv_name : str
+        Path to the CSV file of missing products (None if nothing is
+        missing).
+    """
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    own_inventory = inventory is None
+    if own_inventory:
+        inventory = Inventory(join(src_pth, INVENTORY_FILE))
+    if query_cache is None:
+        query_cache = QueryCache(join(src_pth, QUERY_CACHE_DIR))
+
+    # One scan of the download folder for all jobs
+    inv_stats = inventory.update(src_pth)
+
+    def run_search(job):
+        name, aoi, period = job
+        p_start, p_end = search_period(**period_args(period))
+        try:
+            return p_start, p_end, search(aoi, p_start, p_end, api_url,
+                                          query_cache), None
+        except Exception as err:
+            return p_start, p_end, None, err
+
+    t_search = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_search, jobs))
+    t_search = time.time() - t_search
+
+    # Compare each job, merge the results
+    rows = []
+    on_server = set()
+    missing = {}
+    surplus = {}
+    failed = []
+    for (name, aoi, period), (p_start, p_end, records, err) in zip(jobs,
+                                                                  results):
+        label = f"{name} {period_label(period)}"
+        if err is not None:
+            failed.append(f"{label}: {err}")
+            rows.append(f"{label:<24} query failed")
+            continue
+        job_server = {a['granuleName'] for a in records}
+        present, job_missing, job_surplus = inventory.compare(
+            job_server, p_start, p_end, folder=src_pth)
+        on_server |= job_server
+        surplus.update(job_surplus)
+        for record in records:
+            if record['granuleName'] in job_missing:
+                missing.setdefault(record['granuleName'], record)
+        rows.append(f"{label:<24} {len(job_server):>8} {len(present):>10} "
+                    f"{len(job_missing):>8} {len(job_surplus):>8}")
+    # Surplus of one AOI can be needed by another one
+    surplus = {k: v for k, v in surplus.items() if k not in on_server}
+
+    csv_name = None
+    if missing:
+        csv_name = join(src_pth, f"missing_ASF_batch--{timestr}.csv")
+        records_to_csv(sorted(missing.values(),
+                              key=lambda a: a['granuleName']), csv_name)
+
+    report_name = join(src_pth, f"check_dwn-asf_batch--{timestr}.txt")
+    with open(report_name, 'w') as logfile:
+        logfile.write(time.strftime("%Y-%m-%d-%H:%M:%S") + "\n")
+        logfile.write("CHECK IF ALL FILES HAVE BEEN DOWNLOADED FROM ASF "
+                      "(BATCH)\n\n")
+        logfile.write(f"Source folder: {src_pth}\n")
+        logfile.write(f"Inventory: {inventory.db_path} (updated in "
+                      f"{inv_stats['time']:.2f} s, {inv_stats['added']} "
+                      f"added, {inv_stats['changed']} changed, "
+                      f"{inv_stats['removed']} removed)\n")
+        logfile.write(f"{len(jobs)} searches in {t_search:.2f} s "
+                      f"({workers} concurrent), {query_cache.report()}\n")
+        logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
+        logfile.write(f"{'AOI period':<24} {'server':>8} {'downloaded':>10} "
+                      f"{'missing':>8} {'surplus':>8}\n")
+        [logfile.write(f"{text}\n") for text in rows]
+        logfile.write(f"{'All':<24} {len(on_server):>8} "
+                      f"{len(on_server) - len(missing):>10} "
+                      f"{len(missing):>8} {len(surplus):>8}\n")
+        if failed:
+            logfile.write("----\n")
+            logfile.write(f"{len(failed)} searches failed (not in the "
+                          f"download list):\n")
+            [logfile.write(f"{text}\n") for text in failed]
+        logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
+        logfile.write(f"Missing {len(missing)} files:\n")
+        if missing:
+            [logfile.write(f"{text}\n") for text in sorted(missing)]
+        else:
+            logfile.write("None\n")
+        logfile.write("----\n")
+        logfile.write(f"There are {len(surplus)} surplus files:\n")
+        if surplus:
+            [logfile.write(f"{surplus[text]}\n") for text in sorted(surplus)]
+        else:
+            logfile.write("None\n")
+        logfile.write("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n")
+        if csv_name:
+            logfile.write("Created CSV file for bulk download of missing "
+                          "data:\n")
+            logfile.write(f" {csv_name}\n")
+
+    # The report and CSV file changed the modification time of src_pth
+    inventory.refresh_folder(src_pth)
+    if own_inventory:
+        inventory.close()
+
+    return report_name, csv_name
+
+
 if __name__ == "__main__":
     # Polygon for Netherlands (AOI)
     netherlands = ("6.525,53.5239,5.1388,53.3312,4.6883,52.9431,3.6671,51.4616,"
@@ -199,3 +376,13 @@ if __name__ == "__main__":
 
     out = check_asf(in_polygon, in_src_pth, in_sur_pth, in_year, in_month)
     print(out)
+
+    # Check all AOIs and years at once
+    # (period is year, (year, month) or ("YYYYmmdd", "YYYYmmdd"))
+    # in_jobs = [(name, polygon, year)
+    #            for name, polygon in (("NL", netherlands), ("DK", denmark),
+    #                                  ("SI", slovenia))
+    #            for year in (2017, 2018, 2019, 2020)]
+    #
+    # out = check_asf_batch(in_jobs, in_src_pth, workers=4)
+    # print(out)
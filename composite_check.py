@@ -0,0 +1,142 @@
+"""
+Check that compositing sparse products (footprint windows, strip by strip)
+gives the same weekly composite as compositing full-grid products with Dask.
+
+Synthetic products with different footprints, nodata edges and zero stripes
+(float32 and quantized) are mosaicked onto the same grid twice, as full-grid
+and as sparse products (mosaic.Mosaic), and composite() is run on both sets
+with every method. The strips are made small, so the sources cross several
+strip borders. The strip path sums the mean in float64 and Dask in float32,
+so the mean may differ by the float32 rounding (one quantization step for
+quantized products), the other methods have to be identical.
+"""
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import composite_dask
+from composite_dask import composite
+from mosaic import Mosaic
+from output_profile import creation_options
+from quantize import ENCODINGS, encoding_from_tags, write_encoding
+
+# Methods of composite()
+METHODS = ["mean", "median", "max", "min"]
+
+# Extents of the grid of the products
+BOUNDS = [1000, 4000, 4000, 6000]
+
+# Relative difference of float32 means allowed (rounding of the sum)
+MEAN_RTOL = 1e-6
+
+
+def make_products(src_folder, number=4, quantize=False, seed=0):
+    """Writes synthetic products (GeoTIFFs on the 10 m grid covering parts
+    of BOUNDS), returns list of paths."""
+    rng = np.random.default_rng(seed)
+    encoding = ENCODINGS["SIG"] if quantize else None
+    os.makedirs(src_folder, exist_ok=True)
+    paths = []
+    for k in range(number):
+        height, width = rng.integers(50, 180), rng.integers(80, 280)
+        arr = rng.random((height, width)).astype("float32")
+        arr[:rng.integers(1, 6), :] = 0
+        arr[:, :rng.integers(1, 9)] = np.nan
+        arr[rng.integers(10, height), 20:width - 20] = 0
+        profile = {"driver": "GTiff", "width": width, "height": height,
+                   "count": 1, "dtype": "float32", "nodata": np.nan,
+                   "crs": "EPSG:28992",
+                   "transform": from_origin(
+                       BOUNDS[0] + 10 * int(rng.integers(0, 300 - width)),
+                       BOUNDS[3] - 10 * int(rng.integers(0, 200 - height)),
+                       10, 10)}
+        if encoding:
+            arr = encoding.encode(arr)
+            profile.update(dtype=encoding.dtype, nodata=encoding.nodata)
+        pth = os.path.join(src_folder, f"product_{k}.tif")
+        with rasterio.open(pth, "w", **profile) as dst:
+            dst.write(arr, 1)
+            if encoding:
+                write_encoding(dst, encoding)
+        paths.append(pth)
+    return paths
+
+
+def mosaic_products(paths, out_folder, sparse):
+    """Mosaics each product onto the grid of BOUNDS (as slc_week does),
+    returns list of paths."""
+    os.makedirs(out_folder, exist_ok=True)
+    out_paths = []
+    with Mosaic(BOUNDS, res=10) as mosaic:
+        for pth in paths:
+            with rasterio.open(pth) as src:
+                dtype = src.dtypes[0]
+                encoding = encoding_from_tags(src.tags())
+            out_pth = os.path.join(out_folder, os.path.basename(pth))
+            mosaic.merge([pth], dst_path=out_pth,
+                         dst_kwds=creation_options(dtype), sparse=sparse)
+            if encoding:
+                with rasterio.open(out_pth, "r+") as dst:
+                    write_encoding(dst, encoding)
+            out_paths.append(out_pth)
+    return out_paths
+
+
+def check_composite(work_dir, quantize=False, methods=None, strip_rows=37):
+    """Composites full-grid and sparse products, returns dictionary with the
+    number of differing pixels for each method (differences of the mean
+    within the rounding are not counted)."""
+    if methods is None:
+        methods = METHODS
+    name = "uint16" if quantize else "float32"
+    paths = make_products(os.path.join(work_dir, f"src_{name}"),
+                          quantize=quantize)
+    dense = mosaic_products(paths, os.path.join(work_dir, f"dense_{name}"),
+                            sparse=False)
+    sparse = mosaic_products(paths, os.path.join(work_dir, f"sparse_{name}"),
+                             sparse=True)
+
+    strip_rows_before = composite_dask.STRIP_ROWS
+    composite_dask.STRIP_ROWS = strip_rows
+    out = {}
+    try:
+        for method in methods:
+            out_folder = os.path.join(work_dir, f"out_{name}")
+            pth_a = composite(dense, out_folder, f"dense_{method}", method)
+            pth_b = composite(sparse, out_folder, f"sparse_{method}", method)
+            with rasterio.open(pth_a) as src_a, rasterio.open(pth_b) as src_b:
+                if src_a.transform != src_b.transform or \
+                        src_a.shape != src_b.shape or \
+                        src_a.dtypes != src_b.dtypes:
+                    raise Exception(f"{pth_a} and {pth_b} are not on the "
+                                    f"same grid!")
+                arr_a, arr_b = src_a.read(1), src_b.read(1)
+            if arr_a.dtype.kind == "f":
+                rtol = MEAN_RTOL if method == "mean" else 0
+                same = np.isclose(arr_a, arr_b, rtol=rtol, atol=0,
+                                  equal_nan=True)
+            else:
+                steps = 1 if method == "mean" else 0
+                same = np.abs(arr_a.astype("int64") - arr_b) <= steps
+            out[method] = int((~same).sum())
+    finally:
+        composite_dask.STRIP_ROWS = strip_rows_before
+    return out
+
+
+if __name__ == "__main__":
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for in_quantize in (False, True):
+            results.append((in_quantize, check_composite(tmp_dir,
+                                                         in_quantize)))
+
+    print("\nSparse (strips) vs. full-grid (Dask) composites:")
+    for in_quantize, diff in results:
+        for method, n_diff in diff.items():
+            print(f" {'uint16' if in_quantize else 'float32'}, {method}: "
+                  + (f"{n_diff} pixels differ" if n_diff else "same"))
+    assert not any(n for _, diff in results for n in diff.values())
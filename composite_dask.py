@@ -6,25 +6,131 @@ Created on Fri Oct 2 11:10:03 2020
 
 A modified version of the compositing algorithm for creation of temporal mosaics
 using the Dask Array package.
+
+Sparse sources (products stored only over their footprint window, see
+mosaic.py) are composited strip by strip instead, each source is read and
+accumulated only over its window, so the work scales with the area covered by
+the products and not with the size of the grid.
 """
 
 import os
 import pickle
 import time
+import warnings
+from contextlib import ExitStack
 
 import dask.array as da
 import numpy as np
 import rasterio
 import xarray as xr
+from rasterio.windows import Window
+
+from gdal_config import with_gdal_env
+from mosaic import GRID_TAGS, grid_window
+from output_profile import update_profile
+from quantize import encoded_profile, encoding_from_tags, write_encoding
 
 # from tif2jpg import plot_preview
 
+# Rows of the grid composited at once from sparse sources
+STRIP_ROWS = 1024
+
+
+def _read_strip(src, window, encoding, row_start, row_end):
+    """Returns (rows, values) of the sparse source inside the rows row_start:
+    row_end of the grid (None if it does not cover them). Values are decoded
+    float32, missing data (nodata or zero) is NaN."""
+    top = max(row_start, window.row_off)
+    bottom = min(row_end, window.row_off + window.height)
+    if top >= bottom:
+        return None
+    arr = src.read(1, window=Window(
+        0, top - window.row_off, window.width, bottom - top))
+    if encoding:
+        arr = encoding.decode(arr)
+    else:
+        arr = arr.astype("float32")
+        if src.nodata is not None and not np.isnan(src.nodata):
+            arr[arr == src.nodata] = np.nan
+    arr[arr == 0] = np.nan
+    return slice(top - row_start, bottom - row_start), arr
+
+
+def composite_strip(sources, method, row_start, row_end, width):
+    """Composites rows row_start:row_end of the grid from sparse sources.
+
+    Parameters
+    ----------
+    sources : list(tuple)
+        Opened dataset, its window on the grid and its encoding (None if
+        values are not quantized) of each source.
+    method : str
+        Compositing method, either "mean", "min", "max" or "median".
+    row_start, row_end : int
+        Rows of the grid.
+    width : int
+        Width of the grid.
+
+    Returns
+    -------
+    strip : numpy.ndarray
+        Float32 composite of the rows (NaN where no source has data).
+    """
+    shape = (row_end - row_start, width)
+    if method == "mean":
+        total = np.zeros(shape, dtype="float64")
+        count = np.zeros(shape, dtype="uint32")
+    elif method in ("min", "max"):
+        strip = np.full(shape, np.nan, dtype="float32")
+    elif method == "median":
+        stack = []
+    else:
+        raise Exception('{} is not a valid compositing '
+                        'method!'.format(method))
+
+    for src, window, encoding in sources:
+        found = _read_strip(src, window, encoding, row_start, row_end)
+        if found is None:
+            continue
+        rows, arr = found
+        cols = slice(window.col_off, window.col_off + window.width)
+        if method == "mean":
+            valid = ~np.isnan(arr)
+            total[rows, cols] += np.where(valid, arr, 0)
+            count[rows, cols] += valid
+        elif method == "min":
+            np.fmin(strip[rows, cols], arr, out=strip[rows, cols])
+        elif method == "max":
+            np.fmax(strip[rows, cols], arr, out=strip[rows, cols])
+        else:
+            layer = np.full(shape, np.nan, dtype="float32")
+            layer[rows, cols] = arr
+            stack.append(layer)
+
+    if method == "mean":
+        strip = np.full(shape, np.nan, dtype="float32")
+        np.divide(total, count, out=strip, where=count > 0, casting="unsafe")
+    elif method == "median":
+        if not stack:
+            return np.full(shape, np.nan, dtype="float32")
+        # Pixels without data are NaN (not a warning)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            strip = np.nanmedian(np.stack(stack), axis=0).astype("float32")
+    return strip
 
+
+@with_gdal_env
 def composite(src_fps, save_loc, save_nam, method="mean", dt="default"):
     """Creates a composite from multiple rasters. Individual rasters have to be
     of the same size (extents, pixel size, data type). Multiple compositing
     are available, including mean, min, max, median etc.
 
+    Quantized sources (see quantize.py) are decoded for compositing and the
+    composite is saved with the same encoding. If any of the sources is sparse
+    (stored only over its footprint window, see mosaic.py), the composite is
+    made with composite_strip() over the whole grid of the sources.
+
     Parameters
     ----------
     src_fps : list(str)
@@ -50,12 +156,23 @@ def composite(src_fps, save_loc, save_nam, method="mean", dt="default"):
     # Save TIFF metadata for output
     with rasterio.open(src_fps[0]) as rst:
         out_meta = rst.profile.copy()
+        encoding = encoding_from_tags(rst.tags())
+
+    sparse = False
+    for fp in src_fps:
+        with rasterio.open(fp) as rst:
+            sparse = sparse or GRID_TAGS[0] in rst.tags()
+    if sparse:
+        return _composite_sparse(src_fps, save_loc, save_nam, method,
+                                 out_meta, encoding)
 
     # Lazily load files into DASK ARRAYS
     print(f"#\n# Preparing Dask arrays...")
     chunks = {'band': 1, 'x': 1024, 'y': 1024}
     lazy_arrays = [xr.open_rasterio(fp, chunks=chunks) for fp in src_fps]
     stacked = da.concatenate(lazy_arrays, axis=0)
+    if encoding:
+        stacked = encoding.decode(stacked)
     stacked[stacked == 0] = np.nan
     # Calculate composite for selected method with dask
     print(f"# Compositing ({method}) using Dask...")
@@ -80,10 +197,16 @@ def composite(src_fps, save_loc, save_nam, method="mean", dt="default"):
 
     out_nam = save_nam + ".tif"
     out_pth = os.path.join(save_loc, out_nam)
-    out_meta.update(bigtiff="yes", compress='lzw')
+    if encoding:
+        comp_out = encoding.encode(comp_out)
+        encoded_profile(out_meta, encoding)
+    update_profile(out_meta, comp_out.dtype)
+    out_meta.update(bigtiff="yes")
 
     with rasterio.open(out_pth, "w", **out_meta) as dest:
         dest.write(comp_out)
+        if encoding:
+            write_encoding(dest, encoding)
 
     tif_time = time.time() - tif_time
     print(f"#  Time (TIFF): {tif_time:.2f} seconds")
@@ -110,6 +233,59 @@ def composite(src_fps, save_loc, save_nam, method="mean", dt="default"):
     return out_pth
 
 
+def _composite_sparse(src_fps, save_loc, save_nam, method, out_meta, encoding):
+    """Creates composite of sparse sources strip by strip (see composite())."""
+    tif_time = time.time()
+    print(f"#\n# Compositing ({method}) over footprint windows...")
+    out_nam = save_nam + ".tif"
+    out_pth = os.path.join(save_loc, out_nam)
+
+    with ExitStack() as stack:
+        sources = []
+        grid = None
+        for fp in src_fps:
+            src = stack.enter_context(rasterio.open(fp))
+            window, transform, width, height = grid_window(src)
+            if grid is None:
+                grid = (transform, width, height)
+            elif (width, height) != grid[1:] or \
+                    not transform.almost_equals(grid[0]):
+                raise Exception(f"{fp} is not on the same grid as "
+                                f"{src_fps[0]}!")
+            sources.append((src, window, encoding_from_tags(src.tags())))
+        transform, width, height = grid
+        covered = sum(a[1].width * a[1].height for a in sources)
+        print(f"#  {len(sources)} sources cover "
+              f"{covered / (width * height * len(sources)):.0%} of the grid")
+
+        out_meta.update(transform=transform, width=width, height=height,
+                        count=1)
+        if encoding:
+            encoded_profile(out_meta, encoding)
+            update_profile(out_meta, encoding.dtype)
+        else:
+            out_meta.update(dtype="float32")
+            update_profile(out_meta)
+        out_meta.update(bigtiff="yes")
+
+        with rasterio.open(out_pth, "w", **out_meta) as dest:
+            for row_start in range(0, height, STRIP_ROWS):
+                row_end = min(row_start + STRIP_ROWS, height)
+                strip = composite_strip(sources, method, row_start, row_end,
+                                        width)
+                if encoding:
+                    strip = encoding.encode(strip)
+                dest.write(strip, 1, window=Window(
+                    0, row_start, width, row_end - row_start))
+            if encoding:
+                write_encoding(dest, encoding)
+
+    tif_time = time.time() - tif_time
+    print(f"#  Time (composite + TIFF): {tif_time:.2f} seconds")
+
+    return out_pth
+
+
 if __name__ == "__main__":
     # ========================================================================
     # TEMPORARY INPUT
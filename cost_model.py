@@ -0,0 +1,357 @@
+"""
+Dry run of loop_weeks(): work volume and predicted runtime of every week and
+combo, without reading any pixel data.
+
+dry_run() walks the week plan and the source tree with the same search as
+loop_weeks() and only reads raster headers (burst extents through a burst
+index, resolution and data type of the overlapping bursts). For each week and
+combo it reports the number of products and bursts (all and overlapping the
+bbox), bytes to read (burst windows inside the bbox) and the pixel work of the
+processing stages:
+
+- read: bytes of the burst windows,
+- clean: burst pixels inside the bbox (nodata handling, edge erosion),
+- mosaic: pixels of the footprint window of each product (merge to the 10 m
+  grid, products are stored only over their footprint window),
+- composite: footprint window pixels of all products and output pixels.
+
+The predicted runtime is the sum of work / throughput of the stages.
+Throughput is measured on real data with measure_throughput() (a short run of
+the first products of the period) and can be saved to a JSON file, so other
+periods and AOIs on the same host can be planned without measuring again.
+DEFAULT_THROUGHPUT are rough numbers for a workstation reading from a network
+share. Predicted times are for one worker (tiles of a week run in parallel
+with tile_workers), start-up of the tile workers is not included.
+"""
+import csv
+import json
+import math
+import os
+import time
+from shutil import rmtree
+
+import numpy as np
+import rasterio
+from shapely.geometry import box
+
+from burst_index import BurstIndex
+from composite_dask import composite
+from local_cache import get_burst_cache, set_burst_cache
+from slc_week import (COMBINATIONS, WeekList, add_timing, align_bounds,
+                      find_week_images, make_individual_rasters, make_tiles,
+                      week_name)
+
+# Work per second of each stage (read: bytes, others: pixels)
+DEFAULT_THROUGHPUT = {
+    "read": 100e6,
+    "clean": 20e6,
+    "mosaic": 30e6,
+    "composite": 50e6
+}
+
+# Work of each stage in the dry run report
+STAGE_WORK = {
+    "read": "read_bytes",
+    "clean": "clean_pixels",
+    "mosaic": "mosaic_pixels",
+    "composite": "composite_pixels"
+}
+
+# Columns of the dry run report (CSV)
+REPORT_FIELDS = ["week", "direct", "polar", "products", "bursts",
+                 "overlapping", "read_bytes", "clean_pixels", "mosaic_pixels",
+                 "composite_pixels", "seconds"]
+
+
+def _header(path, headers):
+    """Returns (pixel area, bytes per pixel) of the raster (header is read
+    once)."""
+    if path not in headers:
+        with rasterio.open(path) as src:
+            headers[path] = (abs(src.res[0] * src.res[1]),
+                             np.dtype(src.dtypes[0]).itemsize)
+    return headers[path]
+
+
+def _union_bounds(bounds, other):
+    """Returns extents containing both extents (bounds can be None)."""
+    if bounds is None:
+        return list(other)
+    return [min(bounds[0], other[0]), min(bounds[1], other[1]),
+            max(bounds[2], other[2]), max(bounds[3], other[3])]
+
+
+def combo_work(to_aggregate, polar, areas, index, headers=None, res=10):
+    """Returns work volume of one week and combo.
+
+    Parameters
+    ----------
+    to_aggregate : list(tuple(str, list))
+        Products and their burst folders (see find_week_images()).
+    polar : str
+        Polarization (VV or VH).
+    areas : list(tuple)
+        (bbox, bounds) of each processed area, the whole bbox or all tiles
+        (overlapping bursts of tiles are counted for each tile).
+    index : burst_index.BurstIndex
+        Index of the burst footprints.
+    headers : dict (optional)
+        Cache of raster headers (kept between calls).
+    res : float
+        Output resolution.
+
+    Returns
+    -------
+    work : dict
+        Number of products, bursts and overlapping bursts and work of each
+        stage (read_bytes, clean_pixels, mosaic_pixels, composite_pixels).
+    """
+    if headers is None:
+        headers = {}
+    index.update_products(to_aggregate)
+    work = {"products": len(to_aggregate),
+            "bursts": sum(len(a[1]) for a in to_aggregate),
+            "overlapping": 0, "read_bytes": 0, "clean_pixels": 0,
+            "mosaic_pixels": 0, "composite_pixels": 0}
+    for bbox, bounds in areas:
+        out_bounds = align_bounds(bounds, res)
+        out_pixels = round((out_bounds[2] - out_bounds[0]) / res) * \
+            round((out_bounds[3] - out_bounds[1]) / res)
+        with_data = False
+        for _, bursts in to_aggregate:
+            overlapping = index.query(bbox, bursts)
+            window = None
+            for folder in overlapping:
+                pixel_area, itemsize = _header(
+                    index.burst_file(folder, polar), headers)
+                overlap = index.footprint(folder).intersection(box(*bbox))
+                pixels = math.ceil(overlap.area / pixel_area)
+                work["read_bytes"] += pixels * itemsize
+                work["clean_pixels"] += pixels
+                if not overlap.is_empty:
+                    window = _union_bounds(window, overlap.bounds)
+            work["overlapping"] += len(overlapping)
+            if window is not None:
+                with_data = True
+                window = align_bounds(window, res)
+                pixels = round((min(window[2], out_bounds[2]) -
+                                max(window[0], out_bounds[0])) / res) * \
+                    round((min(window[3], out_bounds[3]) -
+                           max(window[1], out_bounds[1])) / res)
+                work["mosaic_pixels"] += pixels
+                work["composite_pixels"] += pixels
+        if with_data:
+            work["composite_pixels"] += out_pixels
+    return work
+
+
+def predict_seconds(work, throughput=None):
+    """Returns predicted runtime (seconds) of the work volume."""
+    throughput = throughput or DEFAULT_THROUGHPUT
+    return sum(work[key] / throughput[stage]
+               for stage, key in STAGE_WORK.items())
+
+
+def dry_run(
+        dt_start,
+        dt_end,
+        dt_step,
+        bbox,
+        data_type,
+        src_folder,
+        combinations=None,
+        tile_size=None,
+        tile_margin=None,
+        throughput=None,
+        burst_index=None,
+        report_path=None
+):
+    """Reports work volume and predicted runtime of loop_weeks() with the
+    same parameters, without reading pixel data.
+
+    Parameters
+    ----------
+    dt_start, dt_end, dt_step, bbox, data_type, src_folder, combinations,
+    tile_size, tile_margin
+        Same as in loop_weeks().
+    throughput : dict or str (optional)
+        Work per second of each stage or path to a JSON file saved by
+        measure_throughput(), default is DEFAULT_THROUGHPUT.
+    burst_index : burst_index.BurstIndex (optional)
+        Index of burst footprints (can be passed to loop_weeks() afterwards,
+        so the headers are not read again).
+    report_path : str (optional)
+        Path to the CSV report (one row per week and combo).
+
+    Returns
+    -------
+    rows : list(dict)
+        Work and predicted seconds of each week and combo (REPORT_FIELDS).
+    """
+    if isinstance(throughput, str):
+        throughput = load_throughput(throughput)
+    throughput = throughput or DEFAULT_THROUGHPUT
+    if burst_index is None:
+        burst_index = BurstIndex()
+    if combinations is None:
+        combinations = COMBINATIONS
+    if tile_size:
+        areas = [(a["bbox"], a["bounds"])
+                 for a in make_tiles(bbox, tile_size, tile_margin)]
+    else:
+        areas = [(bbox, bbox)]
+
+    t_dry = time.time()
+    headers = {}
+    rows = []
+    my_weeks = WeekList(dt_start, dt_end, dt_step)
+    for this_week in my_weeks.week_list:
+        for direct, polar in combinations:
+            to_aggregate = find_week_images(this_week, direct, polar,
+                                            src_folder, data_type)
+            work = combo_work(to_aggregate, polar, areas, burst_index,
+                              headers)
+            rows.append({"week": week_name(this_week, data_type),
+                         "direct": direct, "polar": polar, **work,
+                         "seconds": predict_seconds(work, throughput)})
+    t_dry = time.time() - t_dry
+
+    # Print report
+    print(f"Dry run of {my_weeks.number_of_weeks} weeks x "
+          f"{len(combinations)} combos in {t_dry:.2f} sec. "
+          f"({len(headers)} headers read)")
+    print(f"Throughput: " + ", ".join(
+        f"{k} {v / 1e6:.1f} {'MB' if k == 'read' else 'Mpx'}/s"
+        for k, v in throughput.items()))
+    print(f"\n{'Week':<45} {'Combo':<7} {'Prod':>4} {'Burst':>5} "
+          f"{'Over':>5} {'Read GB':>8} {'Clean Mpx':>10} {'Mosaic Mpx':>10} "
+          f"{'Comp Mpx':>9} {'Time':>9}")
+    for row in rows:
+        print(f"{row['week']:<45} {row['direct'] + ' ' + row['polar']:<7} "
+              f"{row['products']:>4} {row['bursts']:>5} "
+              f"{row['overlapping']:>5} {row['read_bytes'] / 1e9:>8.2f} "
+              f"{row['clean_pixels'] / 1e6:>10.1f} "
+              f"{row['mosaic_pixels'] / 1e6:>10.1f} "
+              f"{row['composite_pixels'] / 1e6:>9.1f} "
+              f"{row['seconds'] / 60:>7.1f} m")
+    total = sum(a["seconds"] for a in rows)
+    print(f"\nTotal: {sum(a['products'] for a in rows)} products, "
+          f"{sum(a['read_bytes'] for a in rows) / 1e9:.2f} GB to read, "
+          f"predicted {total / 3600:.2f} h")
+    heavy = sorted(rows, key=lambda a: -a["seconds"])[:5]
+    print("Heaviest: " + ", ".join(
+        f"{a['week'][:8]} {a['direct']} {a['polar']} "
+        f"({a['seconds'] / 60:.1f} m)" for a in heavy if a["seconds"]))
+
+    if report_path:
+        with open(report_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return rows
+
+
+def measure_throughput(
+        dt_start,
+        dt_end,
+        dt_step,
+        bbox,
+        data_type,
+        src_folder,
+        tmp_folder=".\\tmp_throughput",
+        combinations=None,
+        max_products=2,
+        path=None
+):
+    """Measures throughput of the processing stages on real data.
+
+    The first max_products products of the first week and combo with data
+    are processed (without burst cache, output is removed) and work of each
+    stage is divided by its time.
+
+    Parameters
+    ----------
+    dt_start, dt_end, dt_step, bbox, data_type, src_folder, combinations
+        Same as in loop_weeks().
+    tmp_folder : str
+        Folder for the test output.
+    max_products : int
+        Number of processed products.
+    path : str (optional)
+        Path to the JSON file where the throughput is saved.
+
+    Returns
+    -------
+    throughput : dict
+        Work per second of each stage (read: bytes, others: pixels).
+    """
+    if combinations is None:
+        combinations = COMBINATIONS
+    to_aggregate = []
+    for this_week in WeekList(dt_start, dt_end, dt_step).week_list:
+        for direct, polar in combinations:
+            to_aggregate = find_week_images(this_week, direct, polar,
+                                            src_folder, data_type)
+            if to_aggregate:
+                break
+        if to_aggregate:
+            break
+    if not to_aggregate:
+        raise Exception("No products found for measuring throughput")
+
+    burst_cache = get_burst_cache()
+    set_burst_cache(None)
+    timings = {}
+    try:
+        paths = make_individual_rasters(to_aggregate[:max_products], direct,
+                                        polar, tmp_folder, data_type,
+                                        bbox=bbox, timings=timings)
+        if paths:
+            t_comp = time.time()
+            tif = composite(paths, tmp_folder, "throughput_test",
+                            dt=data_type)
+            with rasterio.open(tif) as src:
+                pixels = src.width * src.height
+            for pth in paths:
+                with rasterio.open(pth) as src:
+                    pixels += src.width * src.height
+            add_timing(timings, "composite", time.time() - t_comp, pixels)
+    finally:
+        set_burst_cache(burst_cache)
+        rmtree(tmp_folder, ignore_errors=True)
+
+    throughput = dict(DEFAULT_THROUGHPUT)
+    for stage, entry in timings.items():
+        if entry["seconds"] > 0 and entry["work"] > 0:
+            throughput[stage] = entry["work"] / entry["seconds"]
+    print(f"\nMeasured throughput: {throughput}")
+    if path:
+        with open(path, "w") as f:
+            json.dump(throughput, f, indent=2)
+    return throughput
+
+
+def load_throughput(path):
+    """Returns throughput saved by measure_throughput()."""
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    # ----- INPUT --------------------------------------------------------------
+    in_start = "20170101"
+    in_end = "20171231"
+    in_step = 6
+    in_type = "SIG"  # COH or SIG
+    in_bbox = [0, 305400, 287100, 625100]  # NL full
+    in_src = "q:\\_S1_SLC_products_NL_sig_10m_Amersfoort"
+    in_throughput = "d:\\aitlas_slc_test_NL_2\\throughput.json"
+    # --------------------------------------------------------------------------
+
+    if not os.path.isfile(in_throughput):
+        measure_throughput(in_start, in_end, in_step, in_bbox, in_type,
+                           in_src, path=in_throughput)
+    dry_run(in_start, in_end, in_step, in_bbox, in_type, in_src,
+            throughput=in_throughput,
+            report_path="d:\\aitlas_slc_test_NL_2\\dry_run_2017.csv")
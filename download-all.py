@@ -16,6 +16,25 @@
 #
 #    If downloading from a trusted source with invalid SSL Certs, use --insecure to ignore
 #
+#    To download several files at once, set the number of parallel transfers with --parallel=N
+#
+#    To reserve disk space for each file before downloading it, use --preallocate
+#
+#    Each download is checked against the MD5 checksum from the Metalink/CSV (if given) and
+#    recorded in download_manifest.csv, so existing files are never hashed twice
+#
+#    Existing files are compared with download_manifest.csv first, the remaining ones are
+#    checked on ASF with N concurrent HEAD requests (--check-parallel=N, default 16)
+#
+#    To download by acquisition date in N-day weeks (the weeks of slc_week.py), use --weeks=N.
+#    A marker <week>.complete is written to the 'weeks' folder as soon as all files of a week
+#    are downloaded, so processing of the week can start
+#
+#    To download large files over several connections, set the maximum number of segments
+#    per file with --segments=N (and the minimum segment size in MB with --min-segment-size=MB)
+#
+#    To test against a local server (mock_asf.py), set the Earthdata login server with --urs=URL
+#
 #    For more information on bulk downloads, navigate to:
 #        https://asf.alaska.edu/how-to/data-tools/data-tools/#bulk_download
 #
@@ -28,17 +47,20 @@
 
 import sys, csv
 import os, os.path
-import tempfile, shutil
 import re
 
 import base64
+import hashlib
+import json
 import time
 import getpass
 import ssl
 import signal
 import socket
+import threading
 
 import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
 
 #############
 # This next block is a bunch of Python 2/3 compatability
@@ -50,6 +72,8 @@ try:
 
    from cookielib import MozillaCookieJar
    from StringIO import StringIO
+   from Queue import Queue, Empty
+   from httplib import HTTPException
 
 except ImportError as e:
 
@@ -60,6 +84,8 @@ except ImportError as e:
 
    from http.cookiejar import MozillaCookieJar
    from io import StringIO
+   from queue import Queue, Empty
+   from http.client import HTTPException
 
 ###
 # Global variables intended for cross-thread modification
@@ -69,7 +95,7 @@ abort = False
 # A routine that handles trapped signals
 def signal_handler(sig, frame):
     global abort
-    sys.stderr.output("\n > Caught Signal. Exiting!\n")
+    sys.stderr.write("\n > Caught Signal. Exiting!\n")
     abort = True # necessary to cause the program to stop
     raise SystemExit  # this will only abort the thread that the ctrl+c was caught in
 
@@ -82,7 +108,10 @@ class bulk_downloader:
         self.cookie_jar_path = os.path.join( os.path.expanduser('~'), ".bulk_download_cookiejar.txt")
         self.cookie_jar = None
 
-        self.asf_urs4 = { 'url': 'https://urs.earthdata.nasa.gov/oauth/authorize',
+        # Earthdata login (URS) server, can be replaced with a local test server (--urs=URL)
+        self.urs = 'https://urs.earthdata.nasa.gov'
+
+        self.asf_urs4 = { 'url': self.urs + '/oauth/authorize',
                  'client': 'BO_n7nTIlMljdvU6kRRB3g',
                  'redir': 'https://auth.asf.alaska.edu/login'}
 
@@ -94,6 +123,44 @@ class bulk_downloader:
         # For SSL
         self.context = {}
 
+        # Expected MD5 checksum of each URL (from the Metalink/CSV files)
+        self.checksums = {}
+
+        # Record of completed (and verified) downloads in the download folder
+        self.manifest_path = 'download_manifest.csv'
+        self.manifest_fields = ['file', 'url', 'size', 'md5', 'verified', 'timestamp']
+        self.manifest_lock = threading.Lock()
+        self.manifest = self.load_manifest()
+
+        # Number of files downloaded at once (--parallel=N)
+        self.parallel = 1
+
+        # Number of existing files checked at once before downloading (--check-parallel=N)
+        # and file sizes reported by ASF for these files
+        self.check_parallel = 16
+        self.remote_sizes = {}
+
+        # Download in order of acquisition date, grouped into N-day weeks (--weeks=N),
+        # a marker is written to week_folder when all files of a week are downloaded
+        self.week_step = None
+        self.week_folder = 'weeks'
+        # (files not downloaded yet and names of all files of each week)
+        self.week_files = {}
+        self.week_members = {}
+        self.week_failed = set()
+        self.weeks_complete = []
+
+        # Reserve disk space before downloading (--preallocate)
+        self.preallocate = False
+
+        # Size of the (reused) read buffer of each download
+        self.chunk_size = 1024*1024
+
+        # Maximum number of segments (connections) per file (--segments=N) and
+        # minimum size of one segment (--min-segment-size=MB)
+        self.segments = 1
+        self.min_segment_size = 64*1024*1024
+
         # Check if user handed in a Metalink or CSV:
         if len(sys.argv) > 0:
             download_files = []
@@ -109,6 +176,43 @@ class bulk_downloader:
                         # Python 2.6 won't complain about SSL Validation
                         pass
 
+                elif arg == '--preallocate':
+                    self.preallocate = True
+
+                elif arg.startswith('--segments='):
+                    try:
+                        self.segments = max(1, int(arg.split('=', 1)[1]))
+                    except ValueError:
+                        print (" > Could not parse '{0}', downloading each file over one connection.".format(arg))
+
+                elif arg.startswith('--min-segment-size='):
+                    try:
+                        self.min_segment_size = max(1, int(float(arg.split('=', 1)[1])*1024*1024))
+                    except ValueError:
+                        print (" > Could not parse '{0}', ignoring.".format(arg))
+
+                elif arg.startswith('--check-parallel='):
+                    try:
+                        self.check_parallel = max(1, int(arg.split('=', 1)[1]))
+                    except ValueError:
+                        print (" > Could not parse '{0}', ignoring.".format(arg))
+
+                elif arg.startswith('--weeks='):
+                    try:
+                        self.week_step = max(1, int(arg.split('=', 1)[1]))
+                    except ValueError:
+                        print (" > Could not parse '{0}', downloading in list order.".format(arg))
+
+                elif arg.startswith('--urs='):
+                    self.urs = arg.split('=', 1)[1].rstrip('/')
+                    self.asf_urs4['url'] = self.urs + '/oauth/authorize'
+
+                elif arg.startswith('--parallel='):
+                    try:
+                        self.parallel = max(1, int(arg.split('=', 1)[1]))
+                    except ValueError:
+                        print (" > Could not parse '{0}', downloading one file at a time.".format(arg))
+
                 elif arg.endswith('.metalink') or arg.endswith('.csv'):
                     if os.path.isfile( arg ):
                         input_files.append( arg )
@@ -139,11 +243,22 @@ class bulk_downloader:
          # summary
         self.total_bytes = 0
         self.total_time = 0
+        self.cpu_time = 0
         self.cnt = 0
         self.success = []
         self.failed = []
         self.skipped = []
 
+        # Locks for summary/progress (stats_lock) and cookie jar (cookie_lock)
+        # shared by the download threads
+        self.stats_lock = threading.Lock()
+        self.cookie_lock = threading.Lock()
+        # Incremented whenever the cookie jar is refreshed
+        self.cookie_generation = 0
+        # Bytes downloaded so far for each active download (parallel mode)
+        self.progress = {}
+        self.last_report = 0
+
 
     # Get and validate a cookie
     def get_cookie(self):
@@ -176,7 +291,7 @@ class bulk_downloader:
           return False
 
        # File we know is valid, used to validate cookie
-       file_check = 'https://urs.earthdata.nasa.gov/profile'
+       file_check = self.urs + '/profile'
 
        # Apply custom Redirect Hanlder
        opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(), HTTPSHandler(**self.context))
@@ -291,24 +406,41 @@ class bulk_downloader:
 
 
     # Download the file
-    def download_file_with_cookiejar(self, url, file_count, total, recursion=False):
+    def download_file_with_cookiejar(self, url, file_count, total, recursion=False, report_hook=None):
        # see if we've already download this file and if it is that it is the correct size
        download_file = os.path.basename(url).split('?')[0]
+       # Partial data is kept here until the download is complete (segmented
+       # downloads also keep the progress of each segment in state_file)
+       part_file = download_file + '.part'
+       state_file = part_file + '.segments'
        if os.path.isfile(download_file):
           try:
-             request = Request(url)
-             request.get_method = lambda : 'HEAD'
-             response = urlopen(request, timeout=30)
-             remote_size = self.get_total_size(response)
+             remote_size = self.head_size(url)
              # Check that we were able to derive a size.
              if remote_size:
                  local_size = os.path.getsize(download_file)
-                 if remote_size < (local_size+(local_size*.01)) and remote_size > (local_size-(local_size*.01)):
-                     print (" > Download file {0} exists! \n > Skipping download of {1}. ".format(download_file, url))
-                     return None,None
-                 #partial file size wasn't full file size, lets blow away the chunk and start again
-                 print (" > Found {0} but it wasn't fully downloaded. Removing file and downloading again.".format(download_file))
-                 os.remove(download_file)
+                 if remote_size == local_size:
+                     if self.check_existing(download_file, url, local_size):
+                         print (" > Download file {0} exists! \n > Skipping download of {1}. ".format(download_file, url))
+                         for old_file in (part_file, state_file):
+                             if os.path.isfile(old_file):
+                                 os.remove(old_file)
+                         return None,None
+                     # Corrupt file, download it again from the start
+                     print (" > Found {0} but its checksum is wrong. Removing file and downloading again.".format(download_file))
+                     for old_file in (download_file, part_file, state_file):
+                         if os.path.isfile(old_file):
+                             os.remove(old_file)
+                 else:
+                     #file size isn't exactly the full file size, keep the chunk and resume the download
+                     print (" > Found {0} but it wasn't fully downloaded. Resuming download.".format(download_file))
+                     if os.path.isfile(part_file) and os.path.getsize(part_file) >= local_size:
+                         os.remove(download_file)
+                     else:
+                         for old_file in (part_file, state_file):
+                             if os.path.isfile(old_file):
+                                 os.remove(old_file)
+                         os.rename(download_file, part_file)
 
           except ssl.CertificateError as e:
              print (" > ERROR: {0}".format(e))
@@ -327,16 +459,26 @@ class bulk_downloader:
                  print ("IMPORTANT: Remote location may not be accepting your SSL configuration. This is a terminal error.")
              return False,None
 
-       # attempt https connection
+       if report_hook is None:
+          report_hook = self.chunk_report
+
+       # attempt https connection (continue partial download with a Range request)
+       cookie_generation = self.cookie_generation
+       resume_segments = os.path.isfile(state_file)
+       offset = 0
+       if os.path.isfile(part_file) and not resume_segments:
+          offset = os.path.getsize(part_file)
        try:
           request = Request(url)
+          if offset > 0 or self.segments > 1 or resume_segments:
+             request.add_header('Range', 'bytes={0}-'.format(offset))
           response = urlopen(request, timeout=30)
 
           # Watch for redirect
           if response.geturl() != url:
 
              # See if we were redirect BACK to URS for re-auth.
-             if 'https://urs.earthdata.nasa.gov/oauth/authorize' in response.geturl():
+             if self.asf_urs4['url'] in response.geturl():
 
                  if recursion:
                      print (" > Entering seemingly endless auth loop. Aborting. ")
@@ -347,48 +489,96 @@ class bulk_downloader:
                  if "app_type" not in new_auth_url:
                      new_auth_url += "&app_type=401"
 
-                 print (" > While attempting to download {0}....".format(url))
-                 print (" > Need to obtain new cookie from {0}".format(new_auth_url))
-                 old_cookies = [cookie.name for cookie in self.cookie_jar]
-                 opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(), HTTPSHandler(**self.context))
-                 request = Request(new_auth_url)
-                 try:
-                     response = opener.open(request)
-                     for cookie in self.cookie_jar:
-                         if cookie.name not in old_cookies:
-                              print (" > Saved new cookie: {0}".format(cookie.name))
-
-                              # A little hack to save session cookies
-                              if cookie.discard:
-                                   cookie.expires = int(time.time()) + 60*60*24*30
-                                   print (" > Saving session Cookie that should have been discarded! ")
-
-                     self.cookie_jar.save(self.cookie_jar_path, ignore_discard=True, ignore_expires=True)
-                 except HTTPError as e:
-                     print ("HTTP Error: {0}, {1}".format( e.code, url))
-                     return False,None
+                 # Only one thread refreshes the cookie jar, the others just retry
+                 with self.cookie_lock:
+                     if cookie_generation == self.cookie_generation:
+                         print (" > While attempting to download {0}....".format(url))
+                         print (" > Need to obtain new cookie from {0}".format(new_auth_url))
+                         old_cookies = [cookie.name for cookie in self.cookie_jar]
+                         opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(), HTTPSHandler(**self.context))
+                         request = Request(new_auth_url)
+                         try:
+                             response = opener.open(request)
+                             for cookie in self.cookie_jar:
+                                 if cookie.name not in old_cookies:
+                                      print (" > Saved new cookie: {0}".format(cookie.name))
+
+                                      # A little hack to save session cookies
+                                      if cookie.discard:
+                                           cookie.expires = int(time.time()) + 60*60*24*30
+                                           print (" > Saving session Cookie that should have been discarded! ")
+
+                             self.cookie_jar.save(self.cookie_jar_path, ignore_discard=True, ignore_expires=True)
+                         except HTTPError as e:
+                             print ("HTTP Error: {0}, {1}".format( e.code, url))
+                             return False,None
+                         self.cookie_generation += 1
 
                  # Okay, now we have more cookies! Lets try again, recursively!
                  print (" > Attempting download again with new cookies!")
-                 return self.download_file_with_cookiejar(url, file_count, total, recursion=True)
+                 return self.download_file_with_cookiejar(url, file_count, total, recursion=True, report_hook=report_hook)
 
              print (" > 'Temporary' Redirect download @ Remote archive:\n > {0}".format(response.geturl()))
 
+          # Large files are split into segments downloaded over several connections
+          segments = None
+          if offset == 0 and response.getcode() == 206:
+             segments = self.plan_segments(state_file, self.get_total_size(response))
+          elif resume_segments:
+             # Server ignored the range, start again
+             os.remove(state_file)
+          if segments:
+             file_size = self.get_total_size(response)
+             response.close()
+             print ("({0}/{1}) Downloading {2} in {3} segments".format(file_count, total, url, len(segments)))
+             if not self.download_segments(response.geturl(), part_file, state_file, file_size, segments, report_hook):
+                 print (" > Download of {0} is incomplete, finished segments are kept in {1} for resuming.".format(url, part_file))
+                 return False,None
+             if self.parallel == 1:
+                sys.stdout.write('\n')
+             return self.finish_download(url, part_file, download_file, file_size)
+
           # seems to be working
-          print ("({0}/{1}) Downloading {2}".format(file_count, total, url))
+          if offset > 0 and response.getcode() == 206:
+             print ("({0}/{1}) Resuming {2} from byte {3}".format(file_count, total, url, offset))
+             mode = 'r+b'
+          else:
+             if offset > 0:
+                print (" > Server does not support resuming, downloading {0} from the start".format(url))
+             print ("({0}/{1}) Downloading {2}".format(file_count, total, url))
+             offset = 0
+             mode = 'wb'
+
+          # MD5 is computed while writing (data of a resumed download is hashed first)
+          hasher = hashlib.md5()
+          if offset > 0:
+             self.hash_file(part_file, hasher, length=offset)
 
           # Open our local file for writing and build status bar
-          tf = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir='.')
-          self.chunk_read(response, tf, report_hook=self.chunk_report)
+          with open(part_file, mode) as pf:
+             remote_size = self.get_total_size(response)
+             if self.preallocate and remote_size:
+                self.preallocate_file(pf, remote_size)
+             pf.seek(offset)
+             try:
+                self.chunk_read(response, pf, report_hook=report_hook, offset=offset, hasher=hasher)
+             finally:
+                # Cut the preallocated space that was not written (incomplete
+                # or aborted download), so the next run resumes from here
+                pf.truncate()
 
           # Reset download status
-          sys.stdout.write('\n')
-
-          tempfile_name = tf.name
-          tf.close()
+          if self.parallel == 1:
+             sys.stdout.write('\n')
 
        #handle errors
        except HTTPError as e:
+          if e.code == 416 and offset > 0:
+             # Partial file does not fit the remote file, start again
+             print (" > Could not resume {0}, downloading from the start".format(url))
+             os.remove(part_file)
+             return self.download_file_with_cookiejar(url, file_count, total, recursion=recursion, report_hook=report_hook)
+
           print ("HTTP Error: {0}, {1}".format( e.code, url))
 
           if e.code == 401:
@@ -416,15 +606,278 @@ class bulk_downloader:
           return False,None
 
        # Return the file size
-       shutil.copy(tempfile_name, download_file)
-       os.remove(tempfile_name)
-       file_size = self.get_total_size(response)
-       actual_size = os.path.getsize(download_file)
+       return self.finish_download(url, part_file, download_file, self.get_total_size(response), hasher.hexdigest())
+
+    # Check size and checksum of the downloaded data and move it to the final name
+    # (segments are written out of order, so their MD5 is computed here)
+    def finish_download(self, url, part_file, download_file, file_size, md5=None):
+       actual_size = os.path.getsize(part_file)
        if file_size is None:
            # We were unable to calculate file size.
            file_size = actual_size
+       if actual_size != file_size:
+           print (" > Download of {0} is incomplete, {1} of {2} bytes are kept in {3} for resuming.".format(url, actual_size, file_size, part_file))
+           return False,None
+
+       if md5 is None:
+           md5 = self.hash_file(part_file).hexdigest()
+       expected = self.checksums.get(url)
+       if expected and md5 != expected:
+           print (" > Checksum of {0} is {1} instead of {2}, removing the corrupt download.".format(url, md5, expected))
+           os.remove(part_file)
+           return False,None
+
+       # Download is complete, replace the old file
+       try:
+           os.replace(part_file, download_file)
+       except AttributeError:
+           # Python 2 (rename does not replace existing files on Windows)
+           if os.path.isfile(download_file):
+               os.remove(download_file)
+           os.rename(part_file, download_file)
+       self.record_download(download_file, url, actual_size, md5, expected is not None)
        return actual_size,file_size
 
+    # MD5 of the file (or of its first length bytes)
+    def hash_file(self, path, hasher=None, length=None):
+       if hasher is None:
+          hasher = hashlib.md5()
+       buf = memoryview(bytearray(self.chunk_size))
+       remaining = length
+       with open(path, 'rb') as f:
+          while remaining is None or remaining > 0:
+             n = f.readinto(buf)
+             if not n:
+                break
+             if remaining is not None:
+                n = min(n, remaining)
+                remaining -= n
+             hasher.update(buf[:n])
+       return hasher
+
+    # Size of the remote file from a HEAD request (or from the check before downloading)
+    def head_size(self, url):
+       if url not in self.remote_sizes:
+          request = Request(url)
+          request.get_method = lambda : 'HEAD'
+          response = urlopen(request, timeout=30)
+          self.remote_sizes[url] = self.get_total_size(response)
+       return self.remote_sizes[url]
+
+    # Check existing file (with the correct size) against the expected checksum.
+    # Files recorded in the manifest with the same checksum are not hashed again.
+    def check_existing(self, download_file, url, size):
+       expected = self.checksums.get(url)
+       if not expected:
+          return True
+       entry = self.manifest.get(download_file)
+       if entry and entry['md5'] == expected and int(entry['size']) == size:
+          return True
+       print (" > Verifying checksum of {0}".format(download_file))
+       md5 = self.hash_file(download_file).hexdigest()
+       if md5 != expected:
+          return False
+       self.record_download(download_file, url, size, md5, True)
+       return True
+
+    # Existing file is recorded in the manifest with the same size (and checksum)
+    def in_manifest(self, download_file, url):
+       entry = self.manifest.get(download_file)
+       if entry is None or int(entry['size']) != os.path.getsize(download_file):
+          return False
+       expected = self.checksums.get(url)
+       return not expected or entry['md5'] == expected
+
+    # Existing file is complete (same size as on ASF and correct checksum). Errors
+    # are ignored here, the file is checked again when it is downloaded.
+    def check_complete(self, url):
+       download_file = os.path.basename(url).split('?')[0]
+       try:
+          remote_size = self.head_size(url)
+       except Exception:
+          return False
+       local_size = os.path.getsize(download_file)
+       if not remote_size or remote_size != local_size:
+          return False
+       if not self.check_existing(download_file, url, local_size):
+          return False
+       if download_file not in self.manifest:
+          self.record_download(download_file, url, local_size, '', False)
+       return True
+
+    # Check existing files from a queue (one check thread)
+    def check_worker(self, queue, complete):
+       while abort == False:
+          try:
+             file_name = queue.get_nowait()
+          except Empty:
+             return
+          if self.check_complete(file_name):
+             with self.stats_lock:
+                complete.add(file_name)
+
+    # Remove files that are already complete from the download list: files in the
+    # manifest are skipped without any request, the other existing files are
+    # checked with self.check_parallel concurrent HEAD requests
+    def plan_downloads(self):
+       start = time.time()
+       complete = set()
+       queue = Queue()
+       from_manifest = 0
+       for file_name in self.files:
+          download_file = os.path.basename(file_name).split('?')[0]
+          if not os.path.isfile(download_file):
+             continue
+          if self.in_manifest(download_file, file_name):
+             complete.add(file_name)
+             from_manifest += 1
+          else:
+             queue.put(file_name)
+
+       checked = queue.qsize()
+       if checked > 0:
+          print (" > Checking {0} existing files with {1} parallel requests".format(checked, self.check_parallel))
+          workers = [threading.Thread(target=self.check_worker, args=(queue, complete)) for _ in range(min(self.check_parallel, checked))]
+          for worker in workers:
+             worker.daemon = True
+             worker.start()
+          while any(worker.is_alive() for worker in workers):
+             for worker in workers:
+                worker.join(0.5)
+          if abort == True:
+             raise SystemExit
+
+       self.skipped.extend(f for f in self.files if f in complete)
+       self.files = [f for f in self.files if f not in complete]
+       print (" > {0} files already downloaded ({1} from {2}, {3} checked on ASF), {4} to download. Planning took {5:.2f}secs".format(
+              len(complete), from_manifest, self.manifest_path, len(complete) - from_manifest, len(self.files), time.time() - start))
+
+    # Read record of completed downloads (last entry of each file)
+    def load_manifest(self):
+       manifest = {}
+       if os.path.isfile(self.manifest_path):
+          with open(self.manifest_path, 'r') as mf:
+             for row in csv.DictReader(mf):
+                manifest[row['file']] = row
+       return manifest
+
+    # Add completed download to the manifest (verified: checksum was compared with ASF)
+    def record_download(self, download_file, url, size, md5, verified):
+       row = {'file': download_file, 'url': url, 'size': str(size), 'md5': md5,
+              'verified': 'yes' if verified else 'no', 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+       with self.manifest_lock:
+          new = not os.path.isfile(self.manifest_path)
+          with open(self.manifest_path, 'a') as mf:
+             if new:
+                mf.write(','.join(self.manifest_fields) + '\n')
+             mf.write(','.join(row[a] for a in self.manifest_fields) + '\n')
+          self.manifest[download_file] = row
+
+    # Split file into segments (None if the file is too small), or continue
+    # the segments of an interrupted download
+    def plan_segments(self, state_file, file_size):
+       if os.path.isfile(state_file):
+          try:
+             with open(state_file, 'r') as sf:
+                state = json.load(sf)
+             if state['size'] == file_size:
+                return state['segments']
+          except (IOError, ValueError, KeyError):
+             pass
+          os.remove(state_file)
+
+       if file_size is None:
+          return None
+       count = min(self.segments, file_size // self.min_segment_size)
+       if count < 2:
+          return None
+       bounds = [file_size * i // count for i in range(count + 1)]
+       # [start, end, bytes done] for each segment
+       return [[bounds[i], bounds[i+1], 0] for i in range(count)]
+
+    # Download segments in parallel, each written at its offset of part_file.
+    # Returns True if all segments are complete.
+    def download_segments(self, url, part_file, state_file, file_size, segments, report_hook, attempts=3):
+       lock = threading.Lock()
+
+       # File has its final size from the start
+       with open(part_file, 'r+b' if os.path.isfile(part_file) else 'wb') as pf:
+          if self.preallocate:
+             self.preallocate_file(pf, file_size)
+          elif os.path.getsize(part_file) < file_size:
+             pf.truncate(file_size)
+
+       saved = [time.time()]
+       def save_state():
+          with open(state_file, 'w') as sf:
+             json.dump({'size': file_size, 'segments': segments}, sf)
+          saved[0] = time.time()
+
+       # Progress is saved about every second (data of the segments is
+       # flushed before), so a killed download does not start all over
+       def update(i, pos):
+          with lock:
+             segments[i][2] = pos - segments[i][0]
+             done = sum(a[2] for a in segments)
+             if time.time() - saved[0] >= 1:
+                save_state()
+          report_hook(done, file_size)
+
+       todo = Queue()
+       for i, (start, end, done) in enumerate(segments):
+          if start + done < end:
+             todo.put((i, 1))
+       with lock:
+          save_state()
+
+       def worker():
+          with open(part_file, 'r+b') as pf:
+             while abort == False:
+                try:
+                   i, attempt = todo.get_nowait()
+                except Empty:
+                   return
+                start, end, done = segments[i]
+                request = Request(url)
+                request.add_header('Range', 'bytes={0}-{1}'.format(start + done, end - 1))
+                def progress(pos, size, i=i):
+                   pf.flush()
+                   update(i, pos)
+                try:
+                   response = urlopen(request, timeout=30)
+                   if response.getcode() != 206:
+                      raise URLError("server did not return the requested range")
+                   pf.seek(start + done)
+                   self.chunk_read(response, pf, report_hook=progress, offset=start + done)
+                # Any failure of the connection (also reset or closed before the
+                # response) is retried, the progress of the segment is kept
+                except (HTTPError, URLError, socket.timeout, ssl.CertificateError, IOError, OSError, HTTPException) as e:
+                   print (" > Segment {0} of {1} failed: {2}".format(i + 1, len(segments), e))
+                with lock:
+                   save_state()
+                   incomplete = segments[i][0] + segments[i][2] < segments[i][1]
+                if incomplete and attempt < attempts:
+                   todo.put((i, attempt + 1))
+
+       workers = [threading.Thread(target=worker) for _ in range(max(1, min(self.segments, todo.qsize())))]
+       for w in workers:
+          w.daemon = True
+          w.start()
+       try:
+          for w in workers:
+             while w.is_alive():
+                w.join(0.5)
+       finally:
+          # On Ctrl+C the workers stop after their current chunk, let them
+          # save the progress of their segments
+          for w in workers:
+             w.join(5)
+
+       if any(start + done != end for start, end, done in segments):
+          return False
+       os.remove(state_file)
+       return True
+
     def get_redirect_url_from_error(self, error):
        find_redirect = re.compile(r"id=\"redir_link\"\s+href=\"(\S+)\"")
        print ("error file was: {}".format(error))
@@ -447,33 +900,77 @@ class bulk_downloader:
            # We couldn't figure out the size.
            sys.stdout.write(" > Downloaded %d of unknown Size\r" % (bytes_so_far))
 
+    # Progress of all active downloads (parallel mode), printed at most twice per second
+    def parallel_report(self, file_name, bytes_so_far, file_size):
+       with self.stats_lock:
+          self.progress[file_name] = (bytes_so_far, file_size)
+          now = time.time()
+          if now - self.last_report < 0.5:
+             return
+          self.last_report = now
+          done = sum(a[0] for a in self.progress.values())
+          sizes = [a[1] for a in self.progress.values()]
+          if None in sizes:
+             sys.stdout.write(" > {0} active downloads, {1:.1f} MB\r".format(len(sizes), done/1024.0**2))
+          else:
+             sys.stdout.write(" > {0} active downloads, {1:.1f} of {2:.1f} MB\r".format(len(sizes), done/1024.0**2, sum(sizes)/1024.0**2))
+          sys.stdout.flush()
+
     #  chunk_read modified from http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
-    def chunk_read(self, response, local_file, chunk_size=8192, report_hook=None):
+    #  Data is read into one reused buffer (readinto), if the response supports it
+    def chunk_read(self, response, local_file, chunk_size=None, report_hook=None, offset=0, hasher=None):
        file_size = self.get_total_size(response)
-       bytes_so_far = 0
+       bytes_so_far = offset
+       if chunk_size is None:
+          chunk_size = self.chunk_size
 
-       while 1:
+       buf = memoryview(bytearray(chunk_size))
+       readinto = getattr(response, 'readinto', None)
+
+       # Stops after the current chunk on Ctrl+C (the file position is kept
+       # for resuming)
+       while abort == False:
           try:
-             chunk = response.read(chunk_size)
-          except:
+             if readinto is not None:
+                n = readinto(buf)
+                chunk = buf[:n]
+             else:
+                chunk = response.read(chunk_size)
+                n = len(chunk)
+          except (IOError, OSError, HTTPException):
              sys.stdout.write("\n > There was an error reading data. \n")
              break
 
-          try:
-             local_file.write(chunk)
-          except TypeError:
-             local_file.write(chunk.decode(local_file.encoding))
-          bytes_so_far += len(chunk)
-
-          if not chunk:
+          if not n:
              break
 
+          local_file.write(chunk)
+          if hasher is not None:
+             hasher.update(chunk)
+          bytes_so_far += n
+
           if report_hook:
              report_hook(bytes_so_far, file_size)
 
        return bytes_so_far
 
+    # Reserve disk space for the whole file (keeps large files unfragmented)
+    def preallocate_file(self, local_file, size):
+       try:
+          os.posix_fallocate(local_file.fileno(), 0, size)
+       except (AttributeError, OSError):
+          # Windows / Python 2 / file systems without fallocate
+          local_file.truncate(size)
+
     def get_total_size(self, response):
+       # Size of the whole file for partial content (Content-Range: bytes 100-199/1000)
+       try:
+          content_range = response.info().getheader('Content-Range')
+       except AttributeError:
+          content_range = response.getheader('Content-Range')
+       if content_range and '/' in content_range and not content_range.endswith('*'):
+          return int(content_range.split('/')[-1])
+
        try:
           file_size = response.info().getheader('Content-Length').strip()
        except AttributeError:
@@ -502,7 +999,14 @@ class bulk_downloader:
        dl_urls = []
        ml_files = root.find('files')
        for dl in ml_files:
-          dl_urls.append(dl.find('resources').find('url').text)
+          dl_url = dl.find('resources').find('url').text
+          dl_urls.append(dl_url)
+          # <verification><hash type="md5">...</hash></verification>
+          verification = dl.find('verification')
+          if verification is not None:
+             for dl_hash in verification.findall('hash'):
+                if dl_hash.get('type', '').lower() == 'md5' and dl_hash.text:
+                   self.checksums[dl_url] = dl_hash.text.strip().lower()
 
        if len(dl_urls) > 0:
           return dl_urls
@@ -519,6 +1023,10 @@ class bulk_downloader:
              csvr = csv.DictReader(csvf)
              for row in csvr:
                 dl_urls.append(row['URL'])
+                # Newer search results have a checksum column
+                for key in row:
+                   if key and key.lower() in ('md5', 'md5sum') and row[key]:
+                      self.checksums[row['URL']] = row[key].strip().lower()
           except csv.Error as e:
              print ("WARNING: Could not parse file %s, line %d: %s. Skipping." % (csv_file, csvr.line_num, e))
              return None
@@ -532,6 +1040,89 @@ class bulk_downloader:
 
     # Download all the files in the list
     def download_files(self):
+        cpu_start = self.process_time()
+        try:
+            if self.week_step:
+                self.group_weeks()
+            self.plan_downloads()
+            for file_name in self.skipped:
+                self.week_done(file_name, True)
+            if self.parallel > 1:
+                self.download_files_parallel()
+            else:
+                self.download_files_sequential()
+        finally:
+            self.cpu_time += self.process_time() - cpu_start
+
+    # Week of the acquisition date in the file name, named like the weekly products of
+    # slc_week.py: N-day weeks counted from 1 January, the last week ends on 31 December
+    def week_of(self, file_name):
+        match = re.search(r'_(\d{8})T\d{6}_', os.path.basename(file_name))
+        if match is None:
+            return None
+        day = datetime.strptime(match.group(1), '%Y%m%d')
+        week_no = (day.timetuple().tm_yday - 1) // self.week_step
+        start = datetime(day.year, 1, 1) + timedelta(days=week_no*self.week_step)
+        end = min(start + timedelta(days=self.week_step - 1), datetime(day.year, 12, 31))
+        return 'yr{0}wk{1:02d}_SLC_{2}_{3}'.format(start.strftime('%y'), week_no + 1, start.strftime('%Y%m%d'), end.strftime('%Y%m%d'))
+
+    # Sort download list by acquisition date (files without a date last) and group it into weeks
+    def group_weeks(self):
+        def acquisition(file_name):
+            match = re.search(r'_(\d{8}T\d{6})_', os.path.basename(file_name))
+            return match.group(1) if match else '99999999'
+        self.files = sorted(self.files, key=acquisition)
+        for file_name in self.files:
+            week = self.week_of(file_name)
+            if week is not None:
+                self.week_files.setdefault(week, set()).add(file_name)
+        for week in self.week_files:
+            self.week_members[week] = sorted(set(os.path.basename(a).split('?')[0] for a in self.week_files[week]))
+        print (" > Downloading {0} weeks of {1} days in order of acquisition".format(len(self.week_files), self.week_step))
+
+    # Remove finished file from its week, write the marker when the week is complete
+    def week_done(self, file_name, ok):
+        week = self.week_of(file_name) if self.week_step else None
+        if week is None or week not in self.week_files:
+            return
+        with self.stats_lock:
+            if not ok:
+                self.week_failed.add(week)
+            pending = self.week_files[week]
+            if file_name not in pending:
+                return
+            pending.discard(file_name)
+            if pending or week in self.week_failed:
+                return
+            self.weeks_complete.append(week)
+        files = self.week_members[week]
+        if not os.path.isdir(self.week_folder):
+            try:
+                os.makedirs(self.week_folder)
+            except OSError:
+                pass
+        marker = os.path.join(self.week_folder, week + '.complete')
+        with open(marker + '.tmp', 'w') as mf:
+            mf.write('\n'.join(files) + '\n')
+        try:
+            os.replace(marker + '.tmp', marker)
+        except AttributeError:
+            # Python 2
+            if os.path.isfile(marker):
+                os.remove(marker)
+            os.rename(marker + '.tmp', marker)
+        print (" > Week {0} is complete ({1} files), wrote {2}".format(week, len(files), marker))
+
+    # CPU time of this process (download threads included)
+    def process_time(self):
+        try:
+            return time.process_time()
+        except AttributeError:
+            # Python 2
+            return time.clock()
+
+    # Download all the files in the list, one at a time
+    def download_files_sequential(self):
         for file_name in self.files:
 
             # make sure we haven't ctrl+c'd or some other abort trap
@@ -551,26 +1142,89 @@ class bulk_downloader:
             end = time.time()
 
             # stats:
-            if size is None:
+            self.add_result(file_name, size, total_size, end - start)
+
+    # Add result of one download to the summary
+    def add_result(self, file_name, size, total_size, elapsed):
+        self.week_done(file_name, size is None or (size is not False and total_size == size))
+        if size is None:
+            with self.stats_lock:
                 self.skipped.append(file_name)
-            # Check to see that the download didn't error and is the correct size
-            elif size is not False and (total_size < (size+(size*.01)) and total_size > (size-(size*.01))):
-                # Download was good!
-                elapsed = end - start
-                elapsed = 1.0 if elapsed < 1 else elapsed
-                rate = (size/1024**2)/elapsed
+        # Check to see that the download didn't error and is the correct size
+        elif size is not False and total_size == size:
+            # Download was good!
+            elapsed = 1.0 if elapsed < 1 else elapsed
+            rate = (size/1024**2)/elapsed
 
-                print ("Downloaded {0}b in {1:.2f}secs, Average Rate: {2:.2f}MB/sec".format(size, elapsed, rate))
+            print ("Downloaded {0}b in {1:.2f}secs, Average Rate: {2:.2f}MB/sec".format(size, elapsed, rate))
 
-                # add up metrics
+            # add up metrics
+            with self.stats_lock:
                 self.total_bytes += size
                 self.total_time += elapsed
                 self.success.append( {'file':file_name, 'size':size } )
 
-            else:
-                print ("There was a problem downloading {0}".format(file_name))
+        else:
+            print ("There was a problem downloading {0}".format(file_name))
+            with self.stats_lock:
                 self.failed.append(file_name)
 
+    # Download files from the queue until it is empty (one download thread)
+    def download_worker(self, queue):
+        while abort == False:
+            try:
+                file_count, file_name = queue.get_nowait()
+            except Empty:
+                return
+
+            start = time.time()
+            report_hook = lambda done, size: self.parallel_report(file_name, done, size)
+            try:
+                size,total_size = self.download_file_with_cookiejar(file_name, file_count, len(self.files), report_hook=report_hook)
+            except Exception as e:
+                print (" > Unexpected error downloading {0}: {1}".format(file_name, e))
+                size,total_size = False,None
+            with self.stats_lock:
+                self.progress.pop(file_name, None)
+            self.add_result(file_name, size, total_size, time.time() - start)
+
+    # Download all the files in the list with self.parallel threads
+    def download_files_parallel(self):
+        queue = Queue()
+        seen = set()
+        for file_name in self.files:
+            # The same file is never downloaded by two threads at once
+            if os.path.basename(file_name).split('?')[0] in seen:
+                self.skipped.append(file_name)
+                self.week_done(file_name, True)
+                continue
+            seen.add(os.path.basename(file_name).split('?')[0])
+            self.cnt += 1
+            queue.put((self.cnt, file_name))
+
+        print (" > Downloading {0} files with {1} parallel transfers".format(queue.qsize(), self.parallel))
+        start = time.time()
+        workers = [threading.Thread(target=self.download_worker, args=(queue,)) for _ in range(min(self.parallel, queue.qsize()))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Join with timeout, so the main thread still catches Ctrl+C
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(0.5)
+        finally:
+            # On Ctrl+C the workers stop after their current chunk, let them
+            # cut the preallocated .part files before the program exits
+            for worker in workers:
+                worker.join(5)
+        if abort == True:
+            raise SystemExit
+
+        # Transfers overlap, the average rate is based on the wall time
+        self.total_time = time.time() - start
+
     def print_summary(self):
         # Print summary:
         print ("\n\nDownload Summary ")
@@ -586,8 +1240,12 @@ class bulk_downloader:
            print ("  Skipped: {0} files".format(len(self.skipped)))
            for skipped_file in self.skipped:
               print ("          - {0}".format(skipped_file))
-        if len(self.success) > 0:
+        if len(self.success) > 0 and self.total_time > 0:
            print ("  Average Rate: {0:.2f}MB/sec".format( (self.total_bytes/1024.0**2)/self.total_time))
+        if self.week_step:
+           print ("  Weeks complete: {0} of {1} (markers in {2})".format(len(self.weeks_complete), len(self.week_files), self.week_folder))
+        if self.total_bytes > 0:
+           print ("  CPU time: {0:.2f}secs/GB".format(self.cpu_time/(self.total_bytes/1024.0**3)))
         print ("--------------------------------------------------------------------------------")
 
 
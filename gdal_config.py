@@ -0,0 +1,115 @@
+"""
+GDAL runtime configuration (block cache, VSI cache, threads, raw reads) for
+all modules of the processing chain.
+
+Without it, every rasterio.open() runs with default GDAL settings: a small
+block cache (5 % of RAM, shared by all datasets), no VSI cache in front of the
+network share and single-threaded compression. The active configuration is set
+once per process with set_gdal_config() (slc_week passes it to the tile
+workers as well) and applied with gdal_env() or the with_gdal_env decorator
+around every open/read/write of the pipeline.
+"""
+import functools
+
+import rasterio
+
+
+class GdalConfig:
+    """GDAL configuration options used by the processing routines.
+
+    Parameters
+    ----------
+    cache_mb : int
+        Size of the GDAL block cache in MB (GDAL_CACHEMAX).
+    num_threads : str or int
+        Threads used by GDAL for compression and warping (GDAL_NUM_THREADS,
+        "ALL_CPUS" or int).
+    vsi_cache : bool
+        Cache file reads in memory (VSI_CACHE), reduces the number of small
+        reads sent to the network share.
+    vsi_cache_mb : int
+        Size of the VSI cache per opened file in MB (VSI_CACHE_SIZE).
+    one_big_read : bool
+        Read raw rasters (ENVI .img bursts) in one request instead of line by
+        line (GDAL_ONE_BIG_READ), the read-ahead for SMB shares. Only pays off
+        if most of the burst is read (no or large bbox).
+    swath_mb : int
+        Size of the swath buffer in MB for copying data between datasets
+        (GDAL_SWATH_SIZE).
+    extra : dict (optional)
+        Any other GDAL configuration options.
+    """
+    def __init__(self, cache_mb=1024, num_threads="ALL_CPUS", vsi_cache=True,
+                 vsi_cache_mb=64, one_big_read=False, swath_mb=256,
+                 extra=None):
+        self.cache_mb = cache_mb
+        self.num_threads = num_threads
+        self.vsi_cache = vsi_cache
+        self.vsi_cache_mb = vsi_cache_mb
+        self.one_big_read = one_big_read
+        self.swath_mb = swath_mb
+        self.extra = extra or {}
+
+    def __repr__(self):
+        return (f"GdalConfig(cache_mb={self.cache_mb}, "
+                f"num_threads={self.num_threads!r}, "
+                f"vsi_cache={self.vsi_cache}, "
+                f"vsi_cache_mb={self.vsi_cache_mb}, "
+                f"one_big_read={self.one_big_read}, "
+                f"swath_mb={self.swath_mb}, extra={self.extra})")
+
+    def options(self):
+        """Returns GDAL configuration options (for rasterio.Env)."""
+        opts = {
+            "GDAL_CACHEMAX": self.cache_mb,
+            "GDAL_NUM_THREADS": self.num_threads,
+            "VSI_CACHE": self.vsi_cache,
+            "GDAL_ONE_BIG_READ": self.one_big_read,
+            "GDAL_SWATH_SIZE": self.swath_mb * 1024 ** 2
+        }
+        if self.vsi_cache:
+            opts["VSI_CACHE_SIZE"] = self.vsi_cache_mb * 1024 ** 2
+        opts.update(self.extra)
+        return opts
+
+
+# GDAL configuration used by the processing routines
+_gdal_config = GdalConfig()
+
+
+def set_gdal_config(config):
+    """Sets the GDAL configuration for this process (GdalConfig or dict of
+    GdalConfig parameters, None for the default configuration)."""
+    global _gdal_config
+    if config is None:
+        config = GdalConfig()
+    elif isinstance(config, dict):
+        config = GdalConfig(**config)
+    _gdal_config = config
+
+
+def get_gdal_config():
+    return _gdal_config
+
+
+def gdal_env():
+    """Returns rasterio.Env with the active GDAL configuration."""
+    return rasterio.Env(**_gdal_config.options())
+
+
+def with_gdal_env(func):
+    """Decorator, runs the function inside gdal_env() (nested calls only
+    re-apply the same options)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with gdal_env():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def report():
+    """Returns active GDAL configuration and versions (for printing and
+    logs)."""
+    opts = ", ".join(f"{k}={v}" for k, v in _gdal_config.options().items())
+    return (f"GDAL {rasterio.__gdal_version__} (rasterio "
+            f"{rasterio.__version__}): {opts}")
@@ -0,0 +1,586 @@
+"""
+Persistent inventory of downloaded SLC products (zip files) for comparing the
+download archive with ASF search results.
+
+The inventory is an SQLite database with one row per product file (full
+granule name, folder, size, modification time, MD5 checksum and acquisition
+time parsed from the name), indexed by granule name and acquisition time.
+update() walks the archive with os.scandir and only lists folders whose
+modification time changed since the last scan (downloads and moves add or
+remove directory entries, so they always change it); rows are only written
+for new, changed and removed files. Checksums are taken from the
+download_manifest.csv files written by download-all.py.
+
+Missing and surplus products are computed with a join of the search results
+(in a temporary table) against the indexed inventory, so comparisons on
+archives with hundreds of thousands of files need no glob and no list scans.
+
+index_contents() adds the contents of the products (zip members, manifest
+fields, swaths, polarizations and bursts, see safe_zip.py), read in parallel
+from the zip central directory and the small XML members. Queries on swaths
+and polarizations (find_swaths()) then need no access to the archive, and
+extract() unpacks only the members of the requested swaths and polarizations.
+"""
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import safe_zip
+
+# Default name of the inventory database (in the archive folder)
+INVENTORY_FILE = "product_inventory.sqlite"
+
+# Manifest of completed downloads written by download-all.py
+MANIFEST_FILE = "download_manifest.csv"
+
+# Acquisition start time in S1 product names
+_ACQUIRED = re.compile(r"^S1[A-D]_\w\w_\w{4}_\w{4}_(\d{8}T\d{6})_")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    granule TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    md5 TEXT,
+    acquired TEXT
+);
+CREATE INDEX IF NOT EXISTS products_granule ON products (granule);
+CREATE INDEX IF NOT EXISTS products_acquired ON products (acquired);
+CREATE INDEX IF NOT EXISTS products_folder ON products (folder);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+CREATE TABLE IF NOT EXISTS contents (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    start TEXT,
+    stop TEXT,
+    pass TEXT,
+    absolute_orbit INTEGER,
+    relative_orbit INTEGER,
+    polarizations TEXT,
+    footprint TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS swaths (
+    path TEXT NOT NULL,
+    swath TEXT NOT NULL,
+    polarization TEXT NOT NULL,
+    bursts INTEGER,
+    lines_per_burst INTEGER,
+    samples_per_burst INTEGER,
+    start TEXT,
+    stop TEXT,
+    annotation TEXT,
+    measurement TEXT,
+    measurement_size INTEGER,
+    PRIMARY KEY (path, swath, polarization)
+);
+CREATE TABLE IF NOT EXISTS members (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    compressed INTEGER NOT NULL,
+    crc INTEGER NOT NULL,
+    PRIMARY KEY (path, name)
+);
+"""
+
+# Columns of find_swaths() results
+_SWATH_COLUMNS = ("granule", "path", "swath", "polarization", "bursts",
+                  "lines_per_burst", "samples_per_burst", "start", "stop",
+                  "pass", "relative_orbit", "measurement_size")
+
+
+def acquisition_time(granule):
+    """Returns acquisition start (YYYYmmddTHHMMSS) from the product name
+    (None if it is not an S1 product name)."""
+    match = _ACQUIRED.match(granule)
+    return match.group(1) if match else None
+
+
+class Inventory:
+    """Indexed inventory of product files in one or more archive folders.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the SQLite database (created if it does not exist).
+    extension : str
+        Extension of the product files.
+    """
+    def __init__(self, db_path, extension=".zip"):
+        self.db_path = db_path
+        self.extension = extension
+        self._con = sqlite3.connect(db_path, check_same_thread=False)
+        # Keep the journal file, so writing the inventory does not change the
+        # modification time of the (archive) folder that contains it
+        self._con.execute("PRAGMA journal_mode=PERSIST")
+        self._con.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+        # Statistics of the last update
+        self.stats = {}
+
+    def __repr__(self):
+        return f"Inventory({self.db_path!r})"
+
+    def close(self):
+        self._con.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute(
+                "SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def update(self, folder, recursive=True, full=False):
+        """Brings the inventory of folder up to date.
+
+        Parameters
+        ----------
+        folder : str
+            Archive folder.
+        recursive : bool
+            Include sub-folders.
+        full : bool
+            Check size and modification time of every file, also in folders
+            that did not change (e.g. after files were overwritten in place).
+
+        Returns
+        -------
+        stats : dict
+            Number of scanned and skipped folders, added, changed and removed
+            files and time of the update.
+        """
+        t_update = time.time()
+        self.stats = {"folders": 0, "unchanged_folders": 0, "files": 0,
+                      "added": 0, "changed": 0, "removed": 0}
+        folder = os.path.abspath(folder)
+        with self._lock, self._con:
+            self._scan(folder, os.path.dirname(folder), recursive, full)
+        self.stats["time"] = time.time() - t_update
+        return self.stats
+
+    def refresh_folder(self, folder):
+        """Stores the current modification time of a scanned folder after
+        other files (logs, reports) were written to it, so the next update()
+        skips it. Nothing is stored if the product files or sub-folders in
+        the folder differ from the inventory (names are listed, files are
+        not stat'ed). Returns True if the modification time was stored."""
+        folder = os.path.abspath(folder)
+        mtime = os.stat(folder).st_mtime
+        files = set()
+        sub_folders = set()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_folders.add(entry.path)
+                elif entry.name.endswith(self.extension):
+                    files.add(entry.path)
+        with self._lock, self._con:
+            con = self._con
+            if con.execute("SELECT mtime FROM folders WHERE path = ?",
+                           (folder,)).fetchone() is None:
+                return False
+            known_files = {a[0] for a in con.execute(
+                "SELECT path FROM products WHERE folder = ?", (folder,))}
+            known_folders = {a[0] for a in con.execute(
+                "SELECT path FROM folders WHERE parent = ?", (folder,))}
+            if files != known_files or sub_folders != known_folders:
+                return False
+            con.execute("UPDATE folders SET mtime = ? WHERE path = ?",
+                        (mtime, folder))
+        return True
+
+    def _scan(self, folder, parent, recursive, full):
+        con = self._con
+        try:
+            mtime = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            self._remove_folder(folder)
+            return
+        row = con.execute("SELECT mtime FROM folders WHERE path = ?",
+                          (folder,)).fetchone()
+
+        if row is not None and row[0] == mtime and not full:
+            # Nothing was added or removed, only visit the sub-folders
+            self.stats["unchanged_folders"] += 1
+            sub_folders = [a[0] for a in con.execute(
+                "SELECT path FROM folders WHERE parent = ?", (folder,))]
+        else:
+            self.stats["folders"] += 1
+            files = {}
+            sub_folders = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append(entry.path)
+                    elif entry.name.endswith(self.extension):
+                        st = entry.stat()
+                        files[entry.path] = (st.st_size, st.st_mtime)
+            self.stats["files"] += len(files)
+            self._update_files(folder, files)
+
+            # Forget removed sub-folders
+            known = [a[0] for a in con.execute(
+                "SELECT path FROM folders WHERE parent = ?", (folder,))]
+            for old in set(known) - set(sub_folders):
+                self._remove_folder(old)
+            con.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+                        (folder, parent, mtime))
+
+        if recursive:
+            for sub_folder in sub_folders:
+                self._scan(sub_folder, folder, recursive, full)
+
+    def _update_files(self, folder, files):
+        con = self._con
+        known = {a[0]: (a[1], a[2]) for a in con.execute(
+            "SELECT path, size, mtime FROM products WHERE folder = ?",
+            (folder,))}
+        checksums = self._read_manifest(folder)
+
+        new_rows = []
+        for path, (size, mtime) in files.items():
+            if known.get(path) == (size, mtime):
+                continue
+            self.stats["changed" if path in known else "added"] += 1
+            name = os.path.basename(path)
+            granule = name[:-len(self.extension)]
+            md5 = checksums.get((name, size))
+            new_rows.append((path, folder, granule, size, mtime, md5,
+                             acquisition_time(granule)))
+        con.executemany("INSERT OR REPLACE INTO products VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?)", new_rows)
+
+        removed = [(a,) for a in set(known) - set(files)]
+        self.stats["removed"] += len(removed)
+        con.executemany("DELETE FROM products WHERE path = ?", removed)
+
+    def _remove_folder(self, folder):
+        con = self._con
+        for sub_folder in [a[0] for a in con.execute(
+                "SELECT path FROM folders WHERE parent = ?", (folder,))]:
+            self._remove_folder(sub_folder)
+        self.stats["removed"] = self.stats.get("removed", 0) + \
+            con.execute("DELETE FROM products WHERE folder = ?",
+                        (folder,)).rowcount
+        con.execute("DELETE FROM folders WHERE path = ?", (folder,))
+
+    @staticmethod
+    def _read_manifest(folder):
+        """Returns MD5 checksums from the download manifest of the folder,
+        keyed by (file name, size)."""
+        manifest = os.path.join(folder, MANIFEST_FILE)
+        checksums = {}
+        if os.path.isfile(manifest):
+            with open(manifest, newline="") as mf:
+                for row in csv.DictReader(mf):
+                    if row.get("md5"):
+                        checksums[(row["file"], int(row["size"]))] = row["md5"]
+        return checksums
+
+    def granules(self, start=None, end=None, folder=None):
+        """Returns set of granule names acquired in [start, end) (datetime or
+        YYYYmmdd) in folder (and its sub-folders)."""
+        sql, params = self._where(start, end, folder)
+        with self._lock:
+            return {a[0] for a in self._con.execute(
+                f"SELECT granule FROM products{sql}", params)}
+
+    def find(self, granule):
+        """Returns list of (path, size, mtime, md5) of the granule."""
+        with self._lock:
+            return self._con.execute(
+                "SELECT path, size, mtime, md5 FROM products "
+                "WHERE granule = ?", (granule,)).fetchall()
+
+    def compare(self, granules, start=None, end=None, folder=None):
+        """Compares granule names (e.g. ASF search results) with the
+        inventory.
+
+        Parameters
+        ----------
+        granules : iterable(str)
+            Full granule names that should be in the archive.
+        start, end : datetime or str (optional)
+            Acquisition period [start, end) of the search (YYYYmmdd), products
+            outside of it are never surplus.
+        folder : str (optional)
+            Only compare with products in this folder (and sub-folders).
+
+        Returns
+        -------
+        present : set(str)
+            Granules that are in the archive.
+        missing : set(str)
+            Granules that are not in the archive.
+        surplus : dict
+            Paths of products in the period that are not in granules (keyed
+            by granule name).
+        """
+        sql, params = self._where(start, end, folder, prefix="p.")
+        with self._lock, self._con:
+            con = self._con
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS query "
+                        "(granule TEXT PRIMARY KEY)")
+            con.execute("DELETE FROM query")
+            con.executemany("INSERT OR IGNORE INTO query VALUES (?)",
+                            ((a,) for a in granules))
+            folder_sql, folder_params = self._where(None, None, folder,
+                                                    prefix="p.")
+            folder_sql = folder_sql.replace(" WHERE ", " AND ")
+            present = set()
+            missing = set()
+            for granule, found in con.execute(
+                    "SELECT q.granule, EXISTS (SELECT 1 FROM products p "
+                    f"WHERE p.granule = q.granule{folder_sql}) FROM query q",
+                    folder_params):
+                (present if found else missing).add(granule)
+            surplus = {a[0]: a[1] for a in con.execute(
+                "SELECT p.granule, p.path FROM products p LEFT JOIN query q "
+                f"ON q.granule = p.granule{sql} "
+                f"{'AND' if sql else 'WHERE'} q.granule IS NULL", params)}
+            con.execute("DELETE FROM query")
+        return present, missing, surplus
+
+    def index_contents(self, folder=None, workers=8, full=False):
+        """Adds contents of the products (zip index, manifest and annotation
+        fields) to the inventory.
+
+        Only products that are new or changed since they were indexed are
+        read (call update() first), workers products at a time.
+
+        Parameters
+        ----------
+        folder : str (optional)
+            Only index products in this folder (and sub-folders).
+        workers : int
+            Number of products read in parallel.
+        full : bool
+            Index all products again.
+
+        Returns
+        -------
+        stats : dict
+            Number of indexed, failed (unreadable, not read again until they
+            change) and removed (stale) products and time.
+        """
+        t_index = time.time()
+        stats = {"indexed": 0, "failed": 0, "removed": 0}
+        sql, params = self._where(None, None, folder, prefix="p.")
+        with self._lock, self._con:
+            con = self._con
+            # Forget contents of removed and changed products
+            stale = [a for a in con.execute(
+                "SELECT c.path FROM contents c LEFT JOIN products p "
+                "ON p.path = c.path AND p.size = c.size AND p.mtime = c.mtime "
+                "WHERE p.path IS NULL")]
+            stats["removed"] = len(stale)
+            if full:
+                stale += [a for a in con.execute(
+                    f"SELECT p.path FROM products p{sql}", params)]
+            for table in ("contents", "swaths", "members"):
+                con.executemany(f"DELETE FROM {table} WHERE path = ?", stale)
+            where = " AND ".join(["c.path IS NULL"] + (
+                [sql[len(" WHERE "):]] if sql else []))
+            todo = con.execute(
+                "SELECT p.path, p.size, p.mtime FROM products p "
+                f"LEFT JOIN contents c ON c.path = p.path WHERE {where}",
+                params).fetchall()
+
+        def read(path):
+            try:
+                return safe_zip.read_product(path), None
+            except Exception as err:
+                return None, f"{type(err).__name__}: {err}"
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (path, size, mtime), (product, error) in zip(
+                    todo, executor.map(read, (a[0] for a in todo))):
+                if error is not None:
+                    print(f"Cannot index {path}: {error}")
+                    stats["failed"] += 1
+                else:
+                    stats["indexed"] += 1
+                with self._lock, self._con:
+                    self._add_contents(path, size, mtime, product, error)
+        stats["time"] = time.time() - t_index
+        return stats
+
+    def _add_contents(self, path, size, mtime, product, error):
+        con = self._con
+        if product is None:
+            con.execute("INSERT OR REPLACE INTO contents (path, size, mtime, "
+                        "error) VALUES (?, ?, ?, ?)",
+                        (path, size, mtime, error))
+            return
+        con.execute("INSERT OR REPLACE INTO contents VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (path, size, mtime, product["start"], product["stop"],
+                     product["pass"], product["absolute_orbit"],
+                     product["relative_orbit"],
+                     " ".join(product["polarizations"]),
+                     product["footprint"]))
+        con.executemany("INSERT OR REPLACE INTO swaths VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        ((path, a["swath"], a["polarization"],
+                          a.get("bursts"), a.get("lines_per_burst"),
+                          a.get("samples_per_burst"), a.get("start"),
+                          a.get("stop"), a["annotation"], a["measurement"],
+                          a["measurement_size"]) for a in product["swaths"]))
+        con.executemany("INSERT OR REPLACE INTO members VALUES "
+                        "(?, ?, ?, ?, ?)",
+                        ((path,) + tuple(a) for a in product["members"]))
+
+    def find_swaths(self, start=None, end=None, folder=None,
+                    polarizations=None, swaths=None):
+        """Returns indexed swaths of products acquired in [start, end).
+
+        Parameters
+        ----------
+        start, end : datetime or str (optional)
+            Acquisition period (YYYYmmdd).
+        folder : str (optional)
+            Only products in this folder (and sub-folders).
+        polarizations : list(str) (optional)
+            Polarizations (e.g. ["VV", "VH"]), default is all.
+        swaths : list(str) (optional)
+            Swaths (e.g. ["IW1"]), default is all.
+
+        Returns
+        -------
+        rows : list(dict)
+            Granule, path, swath, polarization, bursts, lines_per_burst,
+            samples_per_burst, start, stop, pass, relative_orbit and
+            measurement_size of each swath.
+        """
+        sql, params = self._where(start, end, folder, prefix="p.")
+        conditions = [sql[len(" WHERE "):]] if sql else []
+        for column, values in (("s.polarization", polarizations),
+                               ("s.swath", swaths)):
+            if values is not None:
+                conditions.append(f"{column} IN "
+                                  f"({', '.join('?' * len(values))})")
+                params += [a.upper() for a in values]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            return [dict(zip(_SWATH_COLUMNS, a)) for a in self._con.execute(
+                "SELECT p.granule, p.path, s.swath, s.polarization, s.bursts, "
+                "s.lines_per_burst, s.samples_per_burst, s.start, s.stop, "
+                "c.pass, c.relative_orbit, s.measurement_size "
+                "FROM swaths s JOIN products p ON p.path = s.path "
+                f"JOIN contents c ON c.path = s.path{where} "
+                "ORDER BY p.acquired, s.swath, s.polarization", params)]
+
+    def members(self, granule):
+        """Returns list of (name, size, compressed size, CRC) of the members
+        of the product (from the index)."""
+        with self._lock:
+            return self._con.execute(
+                "SELECT m.name, m.size, m.compressed, m.crc FROM members m "
+                "JOIN products p ON p.path = m.path WHERE p.granule = ? "
+                "ORDER BY m.name", (granule,)).fetchall()
+
+    def extract(self, granule, dest, polarizations=None, swaths=None,
+                kinds=safe_zip.EXTRACT_KINDS):
+        """Extracts members of the requested polarizations and swaths of the
+        product to dest (see safe_zip.extract()), returns the paths."""
+        found = self.find(granule)
+        if not found:
+            raise Exception(f"{granule} is not in the inventory")
+        return safe_zip.extract(found[0][0], dest, polarizations, swaths,
+                                kinds)
+
+    @staticmethod
+    def _where(start, end, folder, prefix=""):
+        """Builds WHERE clause for the acquisition period and folder."""
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append(f"{prefix}acquired >= ?")
+            params.append(_stamp(start))
+        if end is not None:
+            conditions.append(f"{prefix}acquired < ?")
+            params.append(_stamp(end))
+        if folder is not None:
+            folder = os.path.abspath(folder)
+            conditions.append(f"({prefix}folder = ? OR {prefix}folder "
+                              f"LIKE ? ESCAPE '!')")
+            like = folder.replace("!", "!!").replace("%", "!%")
+            like = like.replace("_", "!_")
+            params += [folder, like + os.sep + "%"]
+        if not conditions:
+            return "", params
+        return " WHERE " + " AND ".join(conditions), params
+
+
+def _stamp(date):
+    """Returns datetime or YYYYmmdd as YYYYmmddTHHMMSS (for comparing with
+    the acquisition time)."""
+    if hasattr(date, "strftime"):
+        return date.strftime("%Y%m%dT%H%M%S")
+    return date if "T" in date else date + "T000000"
+
+
+if __name__ == "__main__":
+    # Local test: build an inventory of a generated archive, then change it
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_names = [f"S1A_IW_SLC__1SDV_2017{m:02}{d:02}T053235_"
+                    f"2017{m:02}{d:02}T053302_015510_019735_{m:02}{d:02}"
+                    for m in range(1, 13) for d in range(1, 29)]
+        for i, name in enumerate(in_names):
+            sub = os.path.join(tmp_dir, name[17:23])
+            os.makedirs(sub, exist_ok=True)
+            with open(os.path.join(sub, name + ".zip"), "wb") as f:
+                f.write(b"x" * i)
+
+        inv = Inventory(os.path.join(tmp_dir, INVENTORY_FILE))
+        print(inv.update(tmp_dir))
+        assert len(inv) == len(in_names)
+        inv.update(tmp_dir)
+        in_stats = inv.update(tmp_dir)
+        print(in_stats)
+        assert in_stats["folders"] == 0, in_stats
+
+        # Logs written to a scanned folder do not cause a rescan, products
+        # added after the update are still found
+        with open(os.path.join(tmp_dir, "check.txt"), "w") as f:
+            f.write("log")
+        assert inv.refresh_folder(tmp_dir)
+        assert inv.update(tmp_dir)["folders"] == 0
+        with open(os.path.join(tmp_dir, in_names[0] + ".zip"), "wb") as f:
+            f.write(b"")
+        assert not inv.refresh_folder(tmp_dir)
+        assert inv.update(tmp_dir)["added"] == 1
+        os.remove(os.path.join(tmp_dir, in_names[0] + ".zip"))
+        inv.update(tmp_dir)
+
+        os.remove(os.path.join(tmp_dir, "201703", in_names[60] + ".zip"))
+        with open(os.path.join(tmp_dir, "201703", "extra.zip"), "wb") as f:
+            f.write(b"")
+        print(inv.update(tmp_dir))
+
+        in_query = in_names[56:84] + ["S1B_IW_SLC__1SDV_20170315T053235_"
+                                      "20170315T053302_015510_019735_XXXX"]
+        in_present, in_missing, in_surplus = inv.compare(
+            in_query, "20170301", "20170401")
+        assert in_missing == {in_names[60], in_query[-1]}, in_missing
+        assert len(in_present) == 27 and not in_surplus, in_surplus
+        in_present, in_missing, in_surplus = inv.compare(
+            in_query[:10], "20170301", "20170401")
+        assert len(in_surplus) == 18, len(in_surplus)
+        print(f"{inv}: {len(inv)} products, comparison OK")
+        inv.close()
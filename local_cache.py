@@ -0,0 +1,589 @@
+"""
+Local (SSD) cache for source rasters that are read from network shares.
+
+StagingCache is a read-through cache: the first time a source raster is
+opened, it is copied (together with its sidecar files, e.g. the ENVI .hdr
+header of the .img files) to the local cache folder and all later reads use
+the local copy. Entries are keyed by the path, size and modification time of
+the source files, so a changed source gets a new entry and the outdated one
+is removed with the least recently used entries when the cache grows over the
+size limit.
+
+The cache folder can be shared by several processes on the same host (tile
+workers). Each entry is a sub-folder with a meta.json file, whose
+modification time marks the last use of the entry. An entry is copied to a
+temporary folder and renamed when it is complete, while it is being copied
+its lock file (<entry>.lock, created with O_EXCL, same as the lock files of
+work_queue.py) makes other processes wait for it instead of copying the same
+source again. Processes never remove entries they did not create, except
+when evicting entries that were not used for the grace period.
+
+BurstCache uses the same folder structure for keeping cleaned bursts (output
+of slc_week.pre_process_bursts) between runs, keyed by the source files and all
+parameters of the cleaning.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Seconds after which a lock of an entry is abandoned (its owner died while
+# copying) and can be removed by another process
+LOCK_TIMEOUT = 600
+
+# Seconds between checks while another process is copying the same entry
+LOCK_POLL = 0.2
+
+# Fraction of the size limit that is freed at once when the cache is full, so
+# the cache folder is not scanned for every new entry
+EVICT_FRACTION = 0.1
+
+
+def _folder_size(folder):
+    """Returns total size and last modification time of files in folder."""
+    size = 0
+    mtime = os.path.getmtime(folder)
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+
+class StagingCache:
+    """Read-through cache of source rasters on a local drive.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache folder on a local drive.
+    max_size_gb : float
+        Size limit of the cache in GB.
+    grace : float
+        Entries used in the last grace seconds are never evicted, because they
+        can still be read by this or another process (the cache can therefore
+        temporarily exceed the size limit).
+    lock_timeout : float
+        Seconds after which a lock of an entry is considered abandoned.
+    """
+    def __init__(self, cache_dir, max_size_gb=100, grace=600,
+                 lock_timeout=LOCK_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_gb * 1024 ** 3)
+        self.grace = grace
+        self.lock_timeout = lock_timeout
+        os.makedirs(cache_dir, exist_ok=True)
+        self.stats = self._empty_stats()
+        self._lock = threading.Lock()
+
+        # Total size at the last scan of the cache folder plus entries added
+        # by this process since then (None before the first scan), and size
+        # up to which it is not scanned again if it could not be reduced below
+        # the limit (entries in the grace period)
+        self._size = None
+        self._scan_at = 0
+
+    # Cache is passed to tile workers (stats are collected separately, each
+    # worker scans the cache folder for its own size estimate)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["stats"] = self._empty_stats()
+        state["_size"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_stats():
+        return {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_fetched": 0}
+
+    def _entry_dir(self, path, src_stat):
+        """Each version of the source raster has its own sub-folder (hash of
+        the source path and the size and modification time of its files +
+        file name for easier browsing)."""
+        norm = os.path.normcase(os.path.abspath(path))
+        desc = json.dumps([norm, src_stat], sort_keys=True)
+        key = hashlib.sha1(desc.encode("utf-8")).hexdigest()[:16]
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.cache_dir, f"{key}_{stem}")
+
+    @staticmethod
+    def _source_files(path):
+        """Returns source file and all sidecar files with the same stem."""
+        folder = os.path.dirname(path)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        files = [os.path.join(folder, a) for a in os.listdir(folder)
+                 if a.startswith(stem + ".")]
+        if path not in files:
+            files.append(path)
+        return sorted(files)
+
+    @staticmethod
+    def _read_meta(entry):
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _try_lock(self, entry):
+        """Atomically creates the lock file of the entry, returns False if
+        another process (or thread) holds it. An abandoned lock is removed
+        first."""
+        lock_pth = entry + ".lock"
+        for _ in range(2):
+            try:
+                fd = os.open(lock_pth, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._steal_lock(lock_pth):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{os.getpid()}-{threading.get_ident()}")
+            return True
+        return False
+
+    def _steal_lock(self, lock_pth):
+        """Removes an abandoned lock, returns True if the lock is gone.
+
+        The lock is first renamed to a name unique to this thread, so only one
+        of the processes that found it can remove it, and put back if it
+        turns out to be fresh.
+        """
+        try:
+            age = time.time() - os.path.getmtime(lock_pth)
+        except OSError:
+            return True
+        if age < self.lock_timeout:
+            return False
+        stale_pth = f"{lock_pth}.stale-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.rename(lock_pth, stale_pth)
+        except OSError:
+            return False
+        if time.time() - os.path.getmtime(stale_pth) < self.lock_timeout:
+            try:
+                os.rename(stale_pth, lock_pth)
+            except OSError:
+                os.remove(stale_pth)
+            return False
+        os.remove(stale_pth)
+        return True
+
+    @staticmethod
+    def _unlock(entry):
+        """Removes the lock of the entry if it is held by this thread (it can
+        be stolen if copying took longer than lock_timeout)."""
+        lock_pth = entry + ".lock"
+        try:
+            with open(lock_pth) as f:
+                if f.read() != f"{os.getpid()}-{threading.get_ident()}":
+                    return
+            os.remove(lock_pth)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _publish(tmp, entry):
+        """Renames the complete temporary folder to the entry, returns False
+        (and removes the temporary folder) if the entry name is taken."""
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        return True
+
+    def _is_complete(self, entry, src_stat, local):
+        meta = self._read_meta(entry)
+        return bool(meta and meta["files"] == src_stat and
+                    os.path.isfile(local))
+
+    def _hit(self, entry, size):
+        """Marks entry as recently used and counts the hit."""
+        try:
+            os.utime(os.path.join(entry, "meta.json"))
+        except OSError:
+            pass
+        with self._lock:
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += size
+
+    def fetch(self, path):
+        """Returns path to the valid local copy of the source raster (copies
+        source to the cache if needed)."""
+        files = self._source_files(path)
+        src_stat = {}
+        for fp in files:
+            st = os.stat(fp)
+            src_stat[os.path.basename(fp)] = [st.st_size, st.st_mtime]
+        size = sum(a[0] for a in src_stat.values())
+
+        entry = self._entry_dir(path, src_stat)
+        local = os.path.join(entry, os.path.basename(path))
+        while not self._try_lock(entry):
+            # Another process is copying the same source, wait for it
+            if self._is_complete(entry, src_stat, local):
+                self._hit(entry, size)
+                return local
+            time.sleep(LOCK_POLL)
+
+        try:
+            # HIT: entry could have been published before the lock was taken
+            if self._is_complete(entry, src_stat, local):
+                self._hit(entry, size)
+                return local
+
+            # MISS: copy to a temporary folder, then rename to the entry
+            tmp = f"{entry}.tmp-{os.getpid()}-{threading.get_ident()}"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            for fp in files:
+                shutil.copyfile(fp, os.path.join(tmp, os.path.basename(fp)))
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"source": path, "size": size, "files": src_stat}, f)
+            published = self._publish(tmp, entry)
+        finally:
+            self._unlock(entry)
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["bytes_fetched"] += size
+
+        if not published:
+            # Name is taken by a broken entry (left by a process that died
+            # while it was removed), read the source until it is evicted
+            return path
+        self.evict(keep=entry, added=size)
+        return local
+
+    def entries(self):
+        """Returns list of (last used, size, path) for all cache entries.
+
+        Folders without a valid meta.json (unfinished copies and partly
+        removed entries) are listed with their size on disk and time of the
+        last modification, so they are evicted as well.
+        """
+        out = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry):
+                continue
+            meta = None if ".tmp-" in name else self._read_meta(entry)
+            try:
+                if meta is None:
+                    size, last_used = _folder_size(entry)
+                else:
+                    size = meta["size"]
+                    last_used = os.path.getmtime(
+                        os.path.join(entry, "meta.json"))
+            except OSError:
+                continue
+            out.append((last_used, size, entry))
+        return out
+
+    def evict(self, keep=None, added=0):
+        """Removes least recently used entries if the cache is over the size
+        limit.
+
+        The total size is estimated from the last scan of the cache folder and
+        the entries added since then (added bytes of each call), the folder is
+        only scanned when the estimate is over the limit. Entries are then
+        removed until the cache is EVICT_FRACTION of the limit below it.
+        Entries added by other processes are counted with the next scan.
+        """
+        with self._lock:
+            if self._size is not None:
+                self._size += added
+                if self._size <= max(self.max_bytes, self._scan_at):
+                    return
+
+        entries = sorted(self.entries())
+        total = sum(a[1] for a in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * (1 - EVICT_FRACTION)
+            for last_used, size, entry in entries:
+                if total <= target:
+                    break
+                if entry == keep or time.time() - last_used < self.grace:
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+        with self._lock:
+            self._size = total
+            # Entries in the grace period can keep the cache over the limit,
+            # scan again after another EVICT_FRACTION of it was added
+            self._scan_at = total + self.max_bytes * EVICT_FRACTION \
+                if total > self.max_bytes else 0
+
+    def add_stats(self, stats):
+        """Adds statistics collected by another process (tile worker)."""
+        with self._lock:
+            for key, val in stats.items():
+                self.stats[key] += val
+
+    def pop_stats(self):
+        """Returns statistics and resets them."""
+        with self._lock:
+            stats, self.stats = self.stats, self._empty_stats()
+        return stats
+
+    def report(self):
+        """Returns statistics as a string (for printing and logs)."""
+        st = self.stats
+        return (f"Staging cache: {st['hits']} hits, {st['misses']} misses, "
+                f"{st['bytes_saved'] / 1024 ** 3:.2f} GB saved, "
+                f"{st['bytes_fetched'] / 1024 ** 3:.2f} GB fetched")
+
+
+class BurstCache(StagingCache):
+    """Persistent cache of cleaned bursts.
+
+    Entries are content-addressed: the key is a hash of the source files
+    (path, size and modification time of the burst and its sidecar files) and
+    all parameters that determine the cleaned burst, so changed sources or
+    parameters never return a stale entry. Paths returned by get() point into
+    the cache and stay valid for the grace period.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache folder on a local drive.
+    max_size_gb : float
+        Size limit of the cache in GB.
+    grace : float
+        Entries used in the last grace seconds are never evicted.
+    lock_timeout : float
+        Seconds after which a lock of an entry is considered abandoned.
+    """
+    def __init__(self, cache_dir, max_size_gb=50, grace=600,
+                 lock_timeout=LOCK_TIMEOUT):
+        super().__init__(cache_dir, max_size_gb, grace, lock_timeout)
+
+    def key(self, path, **params):
+        """Returns key for the source raster and cleaning parameters (have to
+        be JSON serializable)."""
+        files = {}
+        for fp in self._source_files(path):
+            st = os.stat(fp)
+            files[os.path.basename(fp)] = [st.st_size, st.st_mtime]
+        desc = {
+            "source": os.path.normcase(os.path.abspath(path)),
+            "files": files,
+            "params": params
+        }
+        desc = json.dumps(desc, sort_keys=True)
+        return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns path to the cached burst (None if it is not cached)."""
+        entry = os.path.join(self.cache_dir, key)
+        meta = self._read_meta(entry)
+        local = os.path.join(entry, meta["file"]) if meta else None
+        if local is None or not os.path.isfile(local):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        try:
+            os.utime(os.path.join(entry, "meta.json"))
+        except OSError:
+            pass
+        with self._lock:
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += meta["size"]
+        return local
+
+    def valid_pixels(self, key):
+        """Returns estimate of valid pixels stored with the cached burst
+        (None if it is not cached or was stored without the estimate)."""
+        meta = self._read_meta(os.path.join(self.cache_dir, key))
+        return meta.get("valid") if meta else None
+
+    def put(self, key, path, valid=None):
+        """Copies the cleaned burst to the cache (nothing is done if another
+        process is storing or has stored the same key). The estimate of valid
+        pixels (valid) is stored with it if given."""
+        entry = os.path.join(self.cache_dir, key)
+        if not self._try_lock(entry):
+            return
+        try:
+            if self._read_meta(entry) is not None:
+                return
+            tmp = f"{entry}.tmp-{os.getpid()}-{threading.get_ident()}"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            name = os.path.basename(path)
+            shutil.copyfile(path, os.path.join(tmp, name))
+            size = os.path.getsize(path)
+            meta = {"file": name, "size": size}
+            if valid is not None:
+                meta["valid"] = valid
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            published = self._publish(tmp, entry)
+        finally:
+            self._unlock(entry)
+        if not published:
+            return
+        with self._lock:
+            self.stats["bytes_fetched"] += size
+
+        self.evict(keep=entry, added=size)
+
+    def report(self):
+        st = self.stats
+        return (f"Burst cache: {st['hits']} hits, {st['misses']} misses, "
+                f"{st['bytes_saved'] / 1024 ** 3:.2f} GB reused, "
+                f"{st['bytes_fetched'] / 1024 ** 3:.2f} GB stored")
+
+
+# Caches used by the processing routines (None = read from source / clean
+# all bursts)
+_staging_cache = None
+_burst_cache = None
+
+
+def set_staging_cache(cache):
+    """Sets the staging cache for this process (None to disable it)."""
+    global _staging_cache
+    _staging_cache = cache
+
+
+def get_staging_cache():
+    return _staging_cache
+
+
+def set_burst_cache(cache):
+    """Sets the burst cache for this process (None to disable it)."""
+    global _burst_cache
+    _burst_cache = cache
+
+
+def get_burst_cache():
+    return _burst_cache
+
+
+def stage(path):
+    """Returns path that should be used for reading the source raster (local
+    copy if staging cache is set)."""
+    if _staging_cache is None:
+        return path
+    return _staging_cache.fetch(path)
+
+
+def _fetch_worker(cache, path):
+    """Fetches path in a separate process (used by the check below)."""
+    local = cache.fetch(path)
+    with open(local, "rb") as f:
+        return local, f.read(), cache.pop_stats()
+
+
+if __name__ == "__main__":
+    # Several processes fetching the same source at once copy it only once
+    # and all of them get the complete copy
+    import multiprocessing
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_dir = os.path.join(tmp_dir, "share")
+        os.makedirs(src_dir)
+        src = os.path.join(src_dir, "Sigma0_VV.img")
+        data = os.urandom(32 * 1024 ** 2)
+        with open(src, "wb") as f:
+            f.write(data)
+        with open(os.path.join(src_dir, "Sigma0_VV.hdr"), "w") as f:
+            f.write("ENVI")
+        cache = StagingCache(os.path.join(tmp_dir, "cache"))
+
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(4, mp_context=ctx) as pool:
+            results = list(pool.map(_fetch_worker, [cache] * 8, [src] * 8))
+        assert len({a[0] for a in results}) == 1
+        assert all(a[1] == data for a in results)
+        misses = sum(a[2]["misses"] for a in results)
+        assert misses == 1, misses
+        names = os.listdir(cache.cache_dir)
+        assert len(names) == 1 and os.path.isfile(
+            os.path.join(cache.cache_dir, names[0], "Sigma0_VV.hdr")), names
+        print(f"8 concurrent fetches: {misses} copy, "
+              f"{sum(a[2]['hits'] for a in results)} hits")
+
+        # Changed source gets a new entry, the old one is evicted
+        time.sleep(0.01)
+        with open(src, "ab") as f:
+            f.write(b"x")
+        cache.max_bytes = 0
+        cache.grace = 0
+        local = cache.fetch(src)
+        with open(local, "rb") as f:
+            assert f.read() == data + b"x"
+        assert os.listdir(cache.cache_dir) == [os.path.basename(
+            os.path.dirname(local))]
+
+        # Abandoned lock (owner died while copying) is taken over
+        os.utime(src)
+        entry = cache._entry_dir(src, {
+            os.path.basename(a): [os.stat(a).st_size, os.stat(a).st_mtime]
+            for a in cache._source_files(src)})
+        with open(entry + ".lock", "w") as f:
+            f.write("dead")
+        os.utime(entry + ".lock", (0, 0))
+        cache.fetch(src)
+        assert not os.path.exists(entry + ".lock")
+        print("Changed source and abandoned lock: OK")
+
+        # Burst cache key changes with the source files and the parameters
+        bursts = BurstCache(os.path.join(tmp_dir, "bursts"))
+        params = {"polarity": "VV", "bbox": [0, 0, 10, 10], "dt": "SIG"}
+        key = bursts.key(src, **params)
+        assert key == bursts.key(src, **dict(reversed(list(params.items()))))
+        assert key != bursts.key(src, **dict(params, bbox=[0, 0, 10, 20]))
+        assert key != bursts.key(src, **dict(params, edge_erosion=11))
+        with open(os.path.join(src_dir, "Sigma0_VV.hdr"), "a") as f:
+            f.write("\n")
+        hdr_key = bursts.key(src, **params)
+        assert hdr_key != key
+        time.sleep(0.01)
+        with open(src, "ab") as f:
+            f.write(b"y")
+        assert bursts.key(src, **params) != hdr_key
+
+        # Stored burst is returned for its key only, a locked or stored key
+        # is not stored again
+        cleaned = os.path.join(tmp_dir, "cleaned_VV.tif")
+        with open(cleaned, "wb") as f:
+            f.write(b"cleaned")
+        assert bursts.get(key) is None
+        bursts.put(key, cleaned)
+        with open(bursts.get(key), "rb") as f:
+            assert f.read() == b"cleaned"
+        assert bursts.get(hdr_key) is None
+        bursts.put(key, src)
+        with open(bursts.get(key), "rb") as f:
+            assert f.read() == b"cleaned"
+        entry = os.path.join(bursts.cache_dir, hdr_key)
+        assert bursts._try_lock(entry)
+        bursts.put(hdr_key, cleaned)
+        bursts._unlock(entry)
+        assert bursts.get(hdr_key) is None
+        stats = bursts.pop_stats()
+        assert (stats["hits"], stats["misses"]) == (2, 3), stats
+        assert stats["bytes_fetched"] == len(b"cleaned"), stats
+
+        # Entries of changed sources are evicted when the cache is full
+        bursts.max_bytes = 0
+        bursts.grace = 0
+        time.sleep(0.01)
+        bursts.put(hdr_key, cleaned)
+        assert os.listdir(bursts.cache_dir) == [hdr_key]
+        print("Burst cache keys, get/put and eviction: OK")
@@ -0,0 +1,768 @@
+"""
+Local stand-in for the ASF services used by download-all.py and check_asf.py,
+for testing and benchmarking the downloads without the real ASF and Earthdata
+servers.
+
+The server (MockASF) provides:
+    - search API (/services/search/param) with JSON, CSV and METALINK output
+      for a list of generated Sentinel-1 SLC products (start, end,
+      granule_list and maxResults are applied, the AOI is ignored)
+    - Earthdata login: /oauth/authorize accepts basic auth or the URS session
+      cookie and redirects to /login, which sets the download cookie and
+      redirects back to the file; /profile for checking the cookie jar
+    - downloads (/download/<granule>.zip) with HEAD and Range requests, files
+      requested without a valid download cookie are redirected to
+      /oauth/authorize
+    - latency, bandwidth limits (per connection and in total) and injected
+      failures (HTTP 503 and connections dropped during the transfer)
+
+File contents are generated from the product name, so long product lists need
+neither memory nor disk space. benchmark_downloads() runs download-all.py
+against the server with different settings and reports files/s and MB/s.
+"""
+import base64
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.cookiejar import MozillaCookieJar
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+from xml.sax.saxutils import escape
+
+# Credentials accepted by the mock Earthdata login
+USERNAME = "mock"
+PASSWORD = "mock"
+
+# File contents are slices of one random block (shifted for each product)
+_BLOCK = 1024 ** 2
+
+# Bytes sent at once (bandwidth limits and failures are applied per chunk)
+_CHUNK = 64 * 1024
+
+# Columns of the CSV output (subset of the ASF search results)
+CSV_COLUMNS = ["Granule Name", "Platform", "Sensor", "Beam Mode",
+               "Beam Mode Description", "Orbit", "Path Number",
+               "Frame Number", "Acquisition Date", "Processing Date",
+               "Processing Level", "Start Time", "End Time",
+               "Ascending or Descending?", "URL", "Size (MB)", "MD5"]
+
+
+class _Throttle:
+    """Limits the total rate of sent bytes (shared by all connections)."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._free = 0
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        with self._lock:
+            now = time.time()
+            self._free = max(self._free, now) + nbytes / self.rate
+            delay = self._free - now
+        time.sleep(delay)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.mock.handle(self, head=True)
+
+    def do_GET(self):
+        self.server.mock.handle(self, head=False)
+
+
+class MockASF:
+    """Local HTTP server that imitates ASF search, Earthdata login and the
+    ASF download server.
+
+    Parameters
+    ----------
+    products : int
+        Number of generated SLC products (two acquisitions per day,
+        alternating descending and ascending, from start on).
+    size_mb : float
+        Size of each product in MB.
+    start : str
+        YYYYmmdd date of the first acquisition.
+    latency : float
+        Seconds added before each response.
+    bandwidth_mb : float (optional)
+        Maximum rate of one transfer in MB/s (ASF limits single transfers).
+    total_bandwidth_mb : float (optional)
+        Maximum rate of all transfers together in MB/s.
+    error_rate : float
+        Probability that a download request is answered with HTTP 503.
+    drop_rate : float
+        Probability that the connection of a download is closed during the
+        transfer.
+    cookie_ttl : float (optional)
+        Seconds after which the download cookie expires (the next download
+        goes through the login redirects again).
+    seed : int
+        Seed for file contents and injected failures.
+    host : str
+        Address the server listens on.
+    port : int
+        Port of the server (0 selects a free port).
+    """
+    def __init__(self, products=20, size_mb=16, start="20170301", latency=0.0,
+                 bandwidth_mb=None, total_bandwidth_mb=None, error_rate=0.0,
+                 drop_rate=0.0, cookie_ttl=None, seed=0, host="127.0.0.1",
+                 port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth_mb * 1024 ** 2 if bandwidth_mb else None
+        self.throttle = (_Throttle(total_bandwidth_mb * 1024 ** 2)
+                         if total_bandwidth_mb else None)
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.cookie_ttl = cookie_ttl
+        self.host = host
+        self.port = port
+
+        rng = random.Random(seed)
+        block = rng.getrandbits(8 * _BLOCK).to_bytes(_BLOCK, "little")
+        self._block = block + block
+        self._rng = rng
+        self._lock = threading.Lock()
+
+        self.products = self._make_products(products, size_mb, start)
+        self._by_file = {a["file"]: a for a in self.products}
+
+        # Valid tokens of URS sessions, download cookies and login codes
+        self._sessions = {}
+        self._downloads = {}
+        self._codes = set()
+
+        self.stats = {"requests": 0, "search": 0, "login": 0, "head": 0,
+                      "get": 0, "range": 0, "redirects": 0, "errors": 0,
+                      "drops": 0, "bytes": 0}
+        self._server = None
+
+    def __repr__(self):
+        return f"MockASF({len(self.products)} products, url={self.url})"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @staticmethod
+    def _make_products(number, size_mb, start):
+        """Generates names and metadata of S1 SLC products."""
+        first = datetime.strptime(start, "%Y%m%d")
+        products = []
+        for i in range(number):
+            ascending = i % 2 == 1
+            t_start = first + timedelta(days=i // 2, hours=17 if ascending else 5,
+                                        minutes=i % 60, seconds=(7 * i) % 60)
+            t_end = t_start + timedelta(seconds=27)
+            platform = "S1A" if i % 4 < 2 else "S1B"
+            orbit = 15500 + i
+            granule = (f"{platform}_IW_SLC__1SDV_{t_start:%Y%m%dT%H%M%S}_"
+                       f"{t_end:%Y%m%dT%H%M%S}_{orbit:06}_"
+                       f"{0x19735 + i:06X}_{(0xA1B3 * (i + 1)) % 0x10000:04X}")
+            products.append({
+                "granule": granule,
+                "file": granule + ".zip",
+                "platform": f"Sentinel-1{platform[-1]}",
+                "start": t_start,
+                "end": t_end,
+                "orbit": orbit,
+                "path": orbit % 175 + 1,
+                "direction": "ASCENDING" if ascending else "DESCENDING",
+                "size": int(size_mb * 1024 ** 2) + i,
+                "shift": int(hashlib.md5(granule.encode()).hexdigest()[:8],
+                             16) % _BLOCK
+            })
+        return products
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def search_url(self):
+        return f"{self.url}/services/search/param"
+
+    def start(self):
+        """Starts the server in a background thread."""
+        self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def download_url(self, product):
+        return f"{self.url}/download/{product['file']}"
+
+    def data(self, product, start=0, end=None):
+        """Returns bytes start:end of the product file."""
+        end = product["size"] if end is None else min(end, product["size"])
+        out = []
+        pos = start
+        while pos < end:
+            offset = (pos + product["shift"]) % _BLOCK
+            n = min(end - pos, _BLOCK)
+            out.append(self._block[offset:offset + n])
+            pos += n
+        return b"".join(out)
+
+    def md5(self, product):
+        """MD5 checksum of the product file (computed once)."""
+        if "md5" not in product:
+            hasher = hashlib.md5()
+            for pos in range(0, product["size"], _BLOCK):
+                hasher.update(self.data(product, pos, pos + _BLOCK))
+            product["md5"] = hasher.hexdigest()
+        return product["md5"]
+
+    def login(self, cookie_jar_path):
+        """Logs in with the mock credentials and saves the cookie jar (the
+        one download-all.py reads from the home folder)."""
+        jar = MozillaCookieJar(cookie_jar_path)
+        opener = build_opener(HTTPCookieProcessor(jar))
+        user_pass = base64.b64encode(f"{USERNAME}:{PASSWORD}".encode())
+        request = Request(f"{self.url}/oauth/authorize?client_id=mock&"
+                          f"redirect_uri={self.url}/login&response_type=code"
+                          f"&state=", headers={
+                              "Authorization": f"Basic {user_pass.decode()}"})
+        opener.open(request).read()
+        jar.save(ignore_discard=True, ignore_expires=True)
+        return jar
+
+    def save_search(self, path, output="metalink", **params):
+        """Queries the search API (same as the ASF query with curl) and saves
+        the result to path."""
+        query = "&".join(f"{k}={quote(str(v))}" for k, v in params.items())
+        request = Request(f"{self.search_url}?platform=Sentinel-1&"
+                          f"processingLevel=SLC&output={output}&{query}")
+        with build_opener().open(request) as response:
+            with open(path, "wb") as f:
+                f.write(response.read())
+        return path
+
+    # ------------------------------------------------------------------------
+    # Request handling
+    # ------------------------------------------------------------------------
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def _token(self, store, ttl):
+        token = uuid.uuid4().hex
+        with self._lock:
+            store[token] = time.time() + ttl if ttl else None
+        return token
+
+    def _valid(self, store, token):
+        with self._lock:
+            if token not in store:
+                return False
+            expires = store[token]
+            return expires is None or expires > time.time()
+
+    @staticmethod
+    def _send(req, code, body=b"", headers=None, head=False,
+              content_type="text/plain"):
+        req.send_response(code)
+        req.send_header("Content-Type", content_type)
+        req.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or []):
+            req.send_header(key, value)
+        req.end_headers()
+        if not head:
+            req.wfile.write(body)
+
+    def handle(self, req, head=False):
+        """Dispatches one request of the handler."""
+        self._count("requests")
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(req.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        cookies = SimpleCookie(req.headers.get("Cookie", ""))
+        cookies = {k: v.value for k, v in cookies.items()}
+        try:
+            if parts.path == "/services/search/param":
+                self._search(req, query, head)
+            elif parts.path == "/oauth/authorize":
+                self._authorize(req, query, cookies, head)
+            elif parts.path == "/login":
+                self._login(req, query, head)
+            elif parts.path == "/profile":
+                logged_in = self._valid(self._sessions,
+                                        cookies.get("urs_session"))
+                self._send(req, 200, b"Profile" if logged_in else b"Login",
+                           head=head)
+            elif parts.path.startswith("/download/"):
+                self._download(req, parts.path.split("/")[-1], cookies, head)
+            else:
+                self._send(req, 404, b"Not found", head=head)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client closed the connection (e.g. end of a segment)
+            req.close_connection = True
+
+    def _authorize(self, req, query, cookies, head):
+        self._count("login")
+        expected = base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+        auth = req.headers.get("Authorization", "")
+        session = cookies.get("urs_session")
+        if auth != f"Basic {expected}" and not self._valid(self._sessions,
+                                                           session):
+            self._send(req, 401, b"Unauthorized", head=head, headers=[(
+                "WWW-Authenticate", 'Basic realm="Please enter your '
+                                    'Earthdata Login credentials"')])
+            return
+        if not self._valid(self._sessions, session):
+            session = self._token(self._sessions, None)
+        code = uuid.uuid4().hex
+        with self._lock:
+            self._codes.add(code)
+        location = (f"{query.get('redirect_uri', self.url + '/login')}?"
+                    f"code={code}&state={quote(query.get('state', ''))}")
+        self._send(req, 302, head=head, headers=[
+            ("Location", location),
+            ("Set-Cookie", f"urs_session={session}; Path=/; "
+                           f"Max-Age=2592000"),
+            ("Set-Cookie", "urs_user_already_logged=yes; Path=/; "
+                           "Max-Age=2592000")])
+
+    def _login(self, req, query, head):
+        with self._lock:
+            valid = query.get("code") in self._codes
+            self._codes.discard(query.get("code"))
+        if not valid:
+            self._send(req, 401, b"Invalid code", head=head)
+            return
+        token = self._token(self._downloads, self.cookie_ttl)
+        headers = [("Set-Cookie", f"asf-urs={token}; Path=/; "
+                                  f"Max-Age=2592000")]
+        if query.get("state"):
+            self._count("redirects")
+            headers.append(("Location", query["state"]))
+            self._send(req, 302, head=head, headers=headers)
+        else:
+            self._send(req, 200, b"Logged in", head=head, headers=headers)
+
+    def _search(self, req, query, head):
+        self._count("search")
+        products = self.products
+        if "start" in query:
+            start = datetime.strptime(query["start"][:19], "%Y-%m-%dT%H:%M:%S")
+            products = [a for a in products if a["start"] >= start]
+        if "end" in query:
+            end = datetime.strptime(query["end"][:19], "%Y-%m-%dT%H:%M:%S")
+            products = [a for a in products if a["start"] <= end]
+        if "granule_list" in query:
+            granules = set(query["granule_list"].split(","))
+            products = [a for a in products if a["granule"] in granules]
+        if "maxResults" in query:
+            products = products[:int(query["maxResults"])]
+
+        output = query.get("output", "metalink").lower()
+        if output == "json":
+            body = self._to_json(products)
+            content_type = "application/json"
+        elif output == "csv":
+            body = self._to_csv(products)
+            content_type = "text/csv"
+        elif output == "metalink":
+            body = self._to_metalink(products)
+            content_type = "application/metalink+xml"
+        else:
+            self._send(req, 400, f"Invalid output: {output}".encode(),
+                       head=head)
+            return
+        self._send(req, 200, body.encode(), head=head,
+                   content_type=content_type)
+
+    def _to_json(self, products):
+        records = [{
+            "granuleName": a["granule"],
+            "sceneId": a["granule"],
+            "fileName": a["file"],
+            "downloadUrl": self.download_url(a),
+            "platform": a["platform"],
+            "beamMode": "IW",
+            "processingLevel": "SLC",
+            "flightDirection": a["direction"],
+            "polarization": "VV+VH",
+            "absoluteOrbit": str(a["orbit"]),
+            "relativeOrbit": str(a["path"]),
+            "startTime": f"{a['start']:%Y-%m-%dT%H:%M:%S}.000000",
+            "stopTime": f"{a['end']:%Y-%m-%dT%H:%M:%S}.000000",
+            "sceneDate": f"{a['start']:%Y-%m-%dT%H:%M:%S}.000000",
+            "bytes": str(a["size"]),
+            "sizeMB": f"{a['size'] / 1024 ** 2:.4f}",
+            "md5sum": self.md5(a)
+        } for a in products]
+        return json.dumps([records])
+
+    def _to_csv(self, products):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(CSV_COLUMNS)
+        for a in products:
+            writer.writerow([
+                a["granule"], a["platform"], "C-SAR", "IW",
+                "Interferometric Wide. 250 km swath, 5 m x 20 m spatial "
+                "resolution and burst synchronization for interferometry.",
+                a["orbit"], a["path"], 160,
+                f"{a['start']:%Y-%m-%dT%H:%M:%S}.000000",
+                f"{a['start']:%Y-%m-%dT%H:%M:%S}.000000", "SLC",
+                f"{a['start']:%Y-%m-%dT%H:%M:%S}.000000",
+                f"{a['end']:%Y-%m-%dT%H:%M:%S}.000000", a["direction"],
+                self.download_url(a), f"{a['size'] / 1024 ** 2:.4f}",
+                self.md5(a)])
+        return out.getvalue()
+
+    def _to_metalink(self, products):
+        files = "".join(
+            f'<file name="{escape(a["file"])}"><resources>'
+            f'<url type="http">{escape(self.download_url(a))}</url>'
+            f'</resources><verification><hash type="md5">{self.md5(a)}'
+            f'</hash></verification><size>{a["size"]}</size></file>\n'
+            for a in products)
+        return ('<?xml version="1.0"?>\n<metalink '
+                'xmlns="http://www.metalinker.org/" version="3.0">\n'
+                '<publisher><name>Alaska Satellite Facility</name>'
+                '<url>http://www.asf.alaska.edu/</url></publisher>\n'
+                f'<files>\n{files}</files>\n</metalink>\n')
+
+    def _download(self, req, file_name, cookies, head):
+        product = self._by_file.get(file_name)
+        if product is None:
+            self._send(req, 404, b"Not found", head=head)
+            return
+        if not self._valid(self._downloads, cookies.get("asf-urs")):
+            # Send the client through the login and back to the file
+            self._count("redirects")
+            state = quote(f"{self.url}{req.path}", safe="")
+            self._send(req, 302, head=head, headers=[(
+                "Location", f"{self.url}/oauth/authorize?client_id=mock&"
+                            f"redirect_uri={self.url}/login&"
+                            f"response_type=code&state={state}")])
+            return
+        if not head and self._random() < self.error_rate:
+            self._count("errors")
+            self._send(req, 503, b"Service unavailable")
+            return
+
+        size = product["size"]
+        start, end = 0, size
+        code = 200
+        headers = [("Accept-Ranges", "bytes")]
+        rng = req.headers.get("Range")
+        if rng and rng.startswith("bytes=") and not head:
+            first, _, last = rng[6:].partition("-")
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+            if start >= size:
+                self._send(req, 416, headers=[("Content-Range",
+                                               f"bytes */{size}")])
+                return
+            code = 206
+            headers.append(("Content-Range", f"bytes {start}-{end - 1}/{size}"))
+            self._count("range")
+        self._count("head" if head else "get")
+
+        req.send_response(code)
+        req.send_header("Content-Type", "application/zip")
+        req.send_header("Content-Length", str(end - start))
+        for key, value in headers:
+            req.send_header(key, value)
+        req.end_headers()
+        if head:
+            return
+
+        # Position at which the connection is dropped
+        drop_at = None
+        if self._random() < self.drop_rate:
+            drop_at = start + int(self._random() * (end - start))
+        t_start = time.time()
+        pos = start
+        while pos < end:
+            chunk = self.data(product, pos, min(pos + _CHUNK, end))
+            if drop_at is not None and pos + len(chunk) > drop_at:
+                self._count("drops")
+                req.close_connection = True
+                req.connection.shutdown(socket.SHUT_RDWR)
+                return
+            if self.throttle:
+                self.throttle.wait(len(chunk))
+            req.wfile.write(chunk)
+            pos += len(chunk)
+            self._count("bytes", len(chunk))
+            if self.bandwidth:
+                delay = t_start + (pos - start) / self.bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def _intact(server, product, folder):
+    """Returns True if the downloaded product file has the size and MD5
+    checksum of the generated contents."""
+    pth = os.path.join(folder, product["file"])
+    if not os.path.isfile(pth) or os.path.getsize(pth) != product["size"]:
+        return False
+    hasher = hashlib.md5()
+    with open(pth, "rb") as f:
+        for chunk in iter(lambda: f.read(_BLOCK), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest() == server.md5(product)
+
+
+def _logged_in_env(server, tmp_dir):
+    """Returns environment for running download-all.py with a valid cookie
+    jar of the server (download-all.py reads it from the home folder)."""
+    home = os.path.join(tmp_dir, "home")
+    os.makedirs(home)
+    server.login(os.path.join(home, ".bulk_download_cookiejar.txt"))
+    return dict(os.environ, HOME=home, USERPROFILE=home)
+
+
+def benchmark_downloads(settings=None, products=20, size_mb=16,
+                        list_format="metalink", script=None, timeout=3600,
+                        rounds=1,
+                        **server_kwargs):
+    """Runs download-all.py against a MockASF server once for each setting
+    and reports files/s and MB/s.
+
+    Every run starts in an empty folder with a download list from the search
+    API and a valid cookie jar, the downloaded files are checked against the
+    generated contents (size and MD5 checksum), only intact files are
+    counted.
+
+    Parameters
+    ----------
+    settings : list(list(str))
+        Command line arguments of download-all.py for each run (default:
+        sequential, 2, 4 and 8 parallel transfers and segmented downloads).
+    products : int
+        Number of files in the download list.
+    size_mb : float
+        Size of each file in MB.
+    list_format : str
+        Format of the download list, "metalink" or "csv".
+    script : str (optional)
+        Path to the download script, default is download-all.py next to this
+        module.
+    timeout : float
+        Maximum time of one run in seconds.
+    rounds : int
+        Maximum number of times download-all.py is run in the same folder
+        until all files are intact (as a user would rerun it after failed
+        downloads, which resumes the partial files).
+    **server_kwargs
+        Latency, bandwidth and failure injection (see MockASF).
+
+    Returns
+    -------
+    results : list(dict)
+        Settings, number of intact files, rounds, time, files/s, MB/s and
+        server statistics of each run.
+    """
+    if settings is None:
+        settings = [[], ["--parallel=2"], ["--parallel=4"], ["--parallel=8"],
+                    ["--segments=4", "--min-segment-size=4"],
+                    ["--parallel=4", "--segments=4", "--min-segment-size=4"]]
+    if script is None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "download-all.py")
+
+    results = []
+    with MockASF(products, size_mb, **server_kwargs) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"{server}: {products} x {size_mb} MB, {server_kwargs}")
+        env = _logged_in_env(server, tmp_dir)
+
+        for i, args in enumerate(settings):
+            run_dir = os.path.join(tmp_dir, f"run{i:02}")
+            os.makedirs(run_dir)
+            list_file = server.save_search(
+                os.path.join(run_dir, f"list.{list_format}"), list_format)
+            stats = dict(server.stats)
+
+            t_run = 0
+            for n_rounds in range(1, rounds + 1):
+                t_round = time.time()
+                proc = subprocess.run(
+                    [sys.executable, script, os.path.basename(list_file),
+                     f"--urs={server.url}"] + args,
+                    cwd=run_dir, env=env, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    universal_newlines=True, timeout=timeout)
+                t_run += time.time() - t_round
+
+                complete = [a for a in server.products
+                            if _intact(server, a, run_dir)]
+                if len(complete) == products:
+                    break
+            mb = sum(a["size"] for a in complete) / 1024 ** 2
+            result = {
+                "args": args,
+                "files": len(complete),
+                "rounds": n_rounds,
+                "time": t_run,
+                "files_s": len(complete) / t_run,
+                "mb_s": mb / t_run,
+                "returncode": proc.returncode,
+                "server": {k: server.stats[k] - stats[k] for k in stats}
+            }
+            results.append(result)
+
+            name = " ".join(args) or "(sequential)"
+            print(f"  {name:<50} {len(complete):>4}/{products} files "
+                  f"({n_rounds} run{'s' if n_rounds > 1 else ''}) "
+                  f"{t_run:7.2f} s {result['files_s']:7.2f} files/s "
+                  f"{result['mb_s']:8.2f} MB/s  "
+                  f"requests: {result['server']['requests']}, "
+                  f"injected errors/drops: {result['server']['errors']}/"
+                  f"{result['server']['drops']}")
+            if proc.returncode != 0:
+                print("\n".join(proc.stdout.splitlines()[-20:]))
+    return results
+
+
+def check_resume(args, stop="interrupt", products=2, size_mb=32, stop_at=0.4,
+                 script=None, timeout=600, **server_kwargs):
+    """Stops download-all.py after a part of the data has been sent, runs it
+    again in the same folder and checks the files.
+
+    Parameters
+    ----------
+    args : list(str)
+        Command line arguments of download-all.py.
+    stop : str
+        "interrupt" (Ctrl+C, not on Windows) or "kill" (process is killed,
+        e.g. by a crash or power loss).
+    products : int
+        Number of files in the download list.
+    size_mb : float
+        Size of each file in MB.
+    stop_at : float
+        Fraction of all data sent before the download is stopped.
+    script : str (optional)
+        Path to the download script, default is download-all.py next to this
+        module.
+    timeout : float
+        Maximum time of each run in seconds.
+    **server_kwargs
+        Latency, bandwidth and failure injection (see MockASF), the bandwidth
+        has to be limited for stopping the download in time.
+
+    Returns
+    -------
+    result : dict
+        Number of intact files, MB of all files and MB sent by the server
+        before and after stopping.
+    """
+    if script is None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "download-all.py")
+
+    with MockASF(products, size_mb, **server_kwargs) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        env = _logged_in_env(server, tmp_dir)
+        run_dir = os.path.join(tmp_dir, "run")
+        os.makedirs(run_dir)
+        list_file = server.save_search(os.path.join(run_dir, "list.metalink"))
+        cmd = [sys.executable, script, os.path.basename(list_file),
+               f"--urs={server.url}"] + args
+        total = sum(a["size"] for a in server.products)
+
+        proc = subprocess.Popen(cmd, cwd=run_dir, env=env,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        t_start = time.time()
+        while server.stats["bytes"] < stop_at * total and \
+                proc.poll() is None and time.time() - t_start < timeout:
+            time.sleep(0.01)
+        if stop == "interrupt":
+            proc.send_signal(signal.SIGINT)
+        else:
+            proc.kill()
+        proc.wait(timeout)
+        sent = server.stats["bytes"]
+
+        subprocess.run(cmd, cwd=run_dir, env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                       timeout=timeout)
+        return {
+            "files": sum(_intact(server, a, run_dir) for a in server.products),
+            "mb": total / 1024 ** 2,
+            "mb_before": sent / 1024 ** 2,
+            "mb_after": (server.stats["bytes"] - sent) / 1024 ** 2
+        }
+
+
+if __name__ == "__main__":
+    # ASF limits the rate of a single transfer, the link is faster
+    runs = benchmark_downloads(products=24, size_mb=8, latency=0.02,
+                               bandwidth_mb=10, total_bandwidth_mb=80)
+
+    # Unreliable server
+    runs += benchmark_downloads([["--parallel=4"],
+                                 ["--parallel=4", "--segments=4",
+                                  "--min-segment-size=2"]],
+                                products=24, size_mb=8, latency=0.02,
+                                bandwidth_mb=10, total_bandwidth_mb=80,
+                                error_rate=0.05, drop_rate=0.05,
+                                cookie_ttl=2, rounds=5)
+    # Sequential, parallel and segmented downloads give all files intact
+    assert all(a["files"] == 24 for a in runs), \
+        [(a["args"], a["files"]) for a in runs]
+
+    # Stopped downloads are resumed with intact files: after Ctrl+C only the
+    # missing part is sent again, after a kill also the data of about the
+    # last second (progress of the segments is saved every second)
+    print("Stopped and resumed downloads:")
+    for in_args in (["--parallel=2"],
+                    ["--segments=4", "--min-segment-size=2"]):
+        for in_stop in ("interrupt", "kill") if os.name != "nt" else ("kill",):
+            res = check_resume(in_args, in_stop, bandwidth_mb=2)
+            print(f"  {' '.join(in_args):<36} {in_stop:<9} {res['files']}/2 "
+                  f"files intact, {res['mb_before']:.1f} + "
+                  f"{res['mb_after']:.1f} MB sent for {res['mb']:.0f} MB")
+            assert res["files"] == 2, res
+            limit = 1.1 if in_stop == "interrupt" else 1.25
+            assert res["mb_before"] + res["mb_after"] < limit * res["mb"], res
+
+    # check_asf.py against the mock search API
+    from check_asf import check_asf
+
+    with MockASF(products=10, size_mb=0.01) as in_server, \
+            tempfile.TemporaryDirectory() as in_dir:
+        print(check_asf("0,0,1,0,1,1,0,0", in_dir, os.path.join(in_dir, "x"),
+                        2017, 3, api_url=in_server.search_url))
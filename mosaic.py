@@ -0,0 +1,460 @@
+"""
+Windowed mosaicking of bursts into a preallocated canvas.
+
+Mosaic produces the same output as rasterio.merge.merge(sources, bounds=...,
+res=..., target_aligned_pixels=True) with the default "first" method (the
+first valid pixel of the sources in their listed order), but:
+
+- the target grid and the canvas (output array) are set up once and reused
+  for all products with the same bounds (e.g. all products of a week),
+- the source and canvas window of each burst are computed once for the whole
+  output (merge computes them for each output chunk),
+- bursts are read (cropped and resampled to the target grid) in parallel
+  threads and pasted into the canvas in their listed order.
+
+Window rounding, nodata handling and resampling follow rasterio.merge, so
+outputs are identical pixel for pixel for sources on the target grid (same
+resolution, origin shifted by whole pixels), e.g. cleaned bursts of the 10 m
+products.
+
+Sources off the target grid (e.g. 13.91 m coherence) are resampled with
+merge by scaling the source window to the canvas window, so the value of an
+output pixel depends on the extents of the cropped burst and of the canvas,
+and tiles (see slc_week.make_tiles()) would differ from the untiled product
+by a pixel shift. With nearest resampling (default) these sources are
+instead resampled geometrically: each output pixel takes the source pixel
+under its center (see center_window() and Mosaic._read_nearest()). This only
+depends on the source grid, so tiled and untiled products are identical.
+
+With sparse=True only the footprint window of the sources (union of their
+canvas windows) is allocated and written, a product covering a third of the
+AOI is stored over that third instead of over the whole bbox. The position of
+the window on the grid is written to the dataset tags (see
+write_grid_window()), so readers (the composite) can place it on the grid
+without reading the nodata around it.
+"""
+import cmath
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio import windows
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+
+from gdal_config import with_gdal_env
+
+# Number of bursts read in parallel
+MOSAIC_WORKERS = 4
+
+# Tolerance (in pixels) for comparing grids and for placing output pixel
+# centers that fall on a source pixel edge (the same source pixel is chosen
+# for a burst cropped to a tile and to the whole bbox)
+GRID_TOLERANCE = 1e-6
+
+# Dataset tags with the position of a sparse raster on its grid
+GRID_TAGS = ("GRID_COL_OFF", "GRID_ROW_OFF", "GRID_WIDTH", "GRID_HEIGHT")
+
+
+def target_grid(bounds, res, target_aligned_pixels=True):
+    """Returns (transform, width, height) of the output grid (same as
+    rasterio.merge)."""
+    dst_w, dst_s, dst_e, dst_n = bounds
+    if target_aligned_pixels:
+        dst_w = math.floor(dst_w / res[0]) * res[0]
+        dst_e = math.ceil(dst_e / res[0]) * res[0]
+        dst_s = math.floor(dst_s / res[1]) * res[1]
+        dst_n = math.ceil(dst_n / res[1]) * res[1]
+    width = int(round((dst_e - dst_w) / res[0]))
+    height = int(round((dst_n - dst_s) / res[1]))
+    transform = Affine.translation(dst_w, dst_n) * Affine.scale(res[0],
+                                                                -res[1])
+    return transform, width, height
+
+
+def win_align(window):
+    """Rounds offsets and lengths of the window (same as rasterio.merge)."""
+    row_off = math.floor(window.row_off + 0.1)
+    col_off = math.floor(window.col_off + 0.1)
+    height = math.floor(window.height + 0.5)
+    width = math.floor(window.width + 0.5)
+    return windows.Window(col_off, row_off, width, height)
+
+
+def burst_windows(src_bounds, src_transform, transform, width, height):
+    """Returns (source window, canvas window) of the part of the burst inside
+    the canvas (None if it does not overlap)."""
+    out_bounds = windows.bounds(windows.Window(0, 0, width, height),
+                                transform)
+    int_w = max(src_bounds[0], out_bounds[0])
+    int_e = min(src_bounds[2], out_bounds[2])
+    int_s = max(src_bounds[1], out_bounds[1])
+    int_n = min(src_bounds[3], out_bounds[3])
+    if int_w >= int_e or int_s >= int_n:
+        return None
+    try:
+        src_window = windows.from_bounds(int_w, int_s, int_e, int_n,
+                                         src_transform)
+        canvas_window = windows.from_bounds(int_w, int_s, int_e, int_n,
+                                            transform)
+    except WindowError:
+        return None
+    return src_window, win_align(canvas_window)
+
+
+def on_grid(src_transform, transform, tol=GRID_TOLERANCE):
+    """Checks if the source pixels coincide with the pixels of the target
+    grid (same resolution, origin shifted by whole pixels)."""
+    if src_transform.b or src_transform.d:
+        return False
+    if abs(src_transform.a - transform.a) > tol * abs(transform.a) or \
+            abs(src_transform.e - transform.e) > tol * abs(transform.e):
+        return False
+    col = (src_transform.c - transform.c) / transform.a
+    row = (src_transform.f - transform.f) / transform.e
+    return abs(col - round(col)) < tol and abs(row - round(row)) < tol
+
+
+def center_window(src_bounds, transform, width, height):
+    """Returns window of the canvas pixels whose centers are inside the source
+    extents (None if there are none)."""
+    left, bottom, right, top = src_bounds
+    col_start = max(0, math.ceil((left - transform.c) / transform.a - 0.5))
+    col_end = min(width, math.ceil((right - transform.c) / transform.a - 0.5))
+    row_start = max(0, math.ceil((top - transform.f) / transform.e - 0.5))
+    row_end = min(height, math.ceil((bottom - transform.f) / transform.e -
+                                    0.5))
+    if col_start >= col_end or row_start >= row_end:
+        return None
+    return windows.Window(col_start, row_start, col_end - col_start,
+                          row_end - row_start)
+
+
+def union_window(wins):
+    """Returns the smallest window containing all windows."""
+    col_off = min(a.col_off for a in wins)
+    row_off = min(a.row_off for a in wins)
+    return windows.Window(
+        col_off,
+        row_off,
+        max(a.col_off + a.width for a in wins) - col_off,
+        max(a.row_off + a.height for a in wins) - row_off
+    )
+
+
+def write_grid_window(dst, window, width, height):
+    """Writes position (window) of the opened (writable) raster on the grid of
+    width x height pixels to its tags."""
+    dst.update_tags(**dict(zip(GRID_TAGS, (
+        window.col_off, window.row_off, width, height))))
+
+
+def grid_window(src):
+    """Returns position of the opened raster on its grid.
+
+    Returns
+    -------
+    window : rasterio.windows.Window
+        Window of the raster on the grid (whole grid if the raster has no
+        grid tags, i.e. it is not sparse).
+    transform : affine.Affine
+        Transform of the grid.
+    width, height : int
+        Size of the grid.
+    """
+    tags = src.tags()
+    if GRID_TAGS[0] not in tags:
+        return (windows.Window(0, 0, src.width, src.height), src.transform,
+                src.width, src.height)
+    col_off, row_off, width, height = [int(tags[a]) for a in GRID_TAGS]
+    transform = src.transform * Affine.translation(-col_off, -row_off)
+    return (windows.Window(col_off, row_off, src.width, src.height),
+            transform, width, height)
+
+
+def _nodata_in_range(nodata, dtype):
+    """Checks if nodata can be stored in dtype (same as rasterio.merge)."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return bool(info.min <= nodata <= info.max)
+    if cmath.isfinite(nodata):
+        info = np.finfo(dtype)
+        return bool(info.min <= nodata <= info.max and
+                    np.can_cast(np.min_scalar_type(nodata), dtype))
+    return True
+
+
+class Mosaic:
+    """Mosaics rasters onto a fixed target grid.
+
+    Parameters
+    ----------
+    bounds : list
+        Output extents [x_min, y_min, x_max, y_max] (snapped outwards to the
+        grid), None to use the extents of the sources of each merge.
+    res : float or tuple
+        Output resolution.
+    workers : int
+        Number of rasters read in parallel.
+    resampling : rasterio.enums.Resampling
+        Resampling of the sources (same as in rasterio.merge, except that
+        with nearest the sources off the target grid are resampled
+        geometrically).
+    """
+    def __init__(self, bounds=None, res=10, workers=MOSAIC_WORKERS,
+                 resampling=Resampling.nearest):
+        self.bounds = bounds
+        self.res = (res, res) if np.isscalar(res) else tuple(res)
+        self.workers = workers
+        self.resampling = resampling
+        self.canvas = None
+        self.grid = None
+        if bounds is not None:
+            self.grid = target_grid(bounds, self.res)
+        self._executor = None
+
+    def __repr__(self):
+        return f"Mosaic({self.bounds}, res={self.res})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stops the reading threads and releases the canvas."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.canvas = None
+
+    def _canvas(self, shape, dtype, fill):
+        """Returns the canvas filled with fill (allocated only when shape or
+        dtype change)."""
+        if self.canvas is None or self.canvas.shape != shape or \
+                self.canvas.dtype != np.dtype(dtype):
+            self.canvas = np.empty(shape, dtype=dtype)
+        self.canvas.fill(fill)
+        return self.canvas
+
+    @with_gdal_env
+    def _read(self, path, src_window, canvas_window, transform, count):
+        """Reads the source window resampled to the size of the canvas window
+        (geometrically with _read_nearest() if src_window is None). Runs in
+        the reading threads, with the GDAL configuration of the process."""
+        with rasterio.open(path) as src:
+            if src_window is None:
+                return self._read_nearest(src, canvas_window, transform)
+            return src.read(
+                out_shape=(count, canvas_window.height, canvas_window.width),
+                masked=True,
+                window=src_window,
+                resampling=self.resampling
+            )
+
+    @staticmethod
+    def _read_nearest(src, canvas_window, transform):
+        """Returns the source pixels under the centers of the canvas window
+        pixels (nearest neighbour, independent of the extents of the source
+        and of the canvas)."""
+        st = src.transform
+        cols = np.arange(canvas_window.col_off,
+                         canvas_window.col_off + canvas_window.width)
+        rows = np.arange(canvas_window.row_off,
+                         canvas_window.row_off + canvas_window.height)
+        x = transform.c + (cols + 0.5) * transform.a
+        y = transform.f + (rows + 0.5) * transform.e
+        src_cols = np.floor((x - st.c) / st.a + GRID_TOLERANCE).astype(int)
+        src_rows = np.floor((y - st.f) / st.e + GRID_TOLERANCE).astype(int)
+        np.clip(src_cols, 0, src.width - 1, out=src_cols)
+        np.clip(src_rows, 0, src.height - 1, out=src_rows)
+        data = src.read(masked=True, window=windows.Window(
+            src_cols[0], src_rows[0], src_cols[-1] - src_cols[0] + 1,
+            src_rows[-1] - src_rows[0] + 1))
+        return data[:, (src_rows - src_rows[0])[:, None],
+                    (src_cols - src_cols[0])[None, :]]
+
+    @with_gdal_env
+    def merge(self, sources, dst_path=None, dst_kwds=None, sparse=False):
+        """Mosaics sources (paths, first valid pixel wins) and writes them to
+        dst_path.
+
+        Parameters
+        ----------
+        sources : list(str)
+            Paths to the rasters (same CRS, data type and band count).
+        dst_path : str (optional)
+            Path of the output (profile of the first source, updated with
+            dst_kwds). If not given, nothing is written.
+        dst_kwds : dict (optional)
+            Creation options and other parameters of the output profile.
+        sparse : bool
+            Mosaic and write only the footprint window of the sources (its
+            position on the grid is written to the tags), instead of the
+            whole grid.
+
+        Returns
+        -------
+        canvas : numpy.ndarray
+            Mosaic (re-used by the next merge, copy it to keep it).
+        transform : affine.Affine
+            Transform of the mosaic.
+        """
+        with rasterio.open(sources[0]) as first:
+            profile = first.profile
+            count = first.count
+            dtype = first.dtypes[0]
+            nodata = first.nodatavals[0]
+        if self.grid is not None:
+            transform, width, height = self.grid
+        else:
+            bounds = []
+            for path in sources:
+                with rasterio.open(path) as src:
+                    bounds.append(src.bounds)
+            transform, width, height = target_grid(
+                [min(a[0] for a in bounds), min(a[1] for a in bounds),
+                 max(a[2] for a in bounds), max(a[3] for a in bounds)],
+                self.res)
+
+        # Source and canvas window of each source (sources outside the
+        # canvas are not read), sources off the target grid are resampled
+        # geometrically (no source window)
+        found = []
+        for path in sources:
+            with rasterio.open(path) as src:
+                if self.resampling == Resampling.nearest and \
+                        not on_grid(src.transform, transform):
+                    canvas_window = center_window(src.bounds, transform,
+                                                  width, height)
+                    wins = None if canvas_window is None else \
+                        (None, canvas_window)
+                else:
+                    wins = burst_windows(src.bounds, src.transform,
+                                         transform, width, height)
+            if wins is not None:
+                found.append((path, *wins))
+
+        # Sparse canvas covers only the footprint window of the sources
+        grid_win = windows.Window(0, 0, width, height)
+        if sparse and found:
+            grid_win = union_window([a[2] for a in found])
+        shape = (count, grid_win.height, grid_win.width)
+
+        # Same nodata handling as rasterio.merge
+        if nodata is None:
+            nodata = 0
+            canvas = self._canvas(shape, dtype, 0)
+        elif _nodata_in_range(nodata, dtype):
+            canvas = self._canvas(shape, dtype, nodata)
+        else:
+            canvas = self._canvas(shape, dtype, 0)
+
+        # Read in parallel, paste in the listed order (first valid pixel)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        reads = self._executor.map(
+            lambda a: self._read(a[0], a[1], a[2], transform, count), found)
+        for (_, _, canvas_window), data in zip(found, reads):
+            rows, cols = windows.Window(
+                canvas_window.col_off - grid_win.col_off,
+                canvas_window.row_off - grid_win.row_off,
+                canvas_window.width, canvas_window.height).toslices()
+            region = canvas[:, rows, cols]
+            if cmath.isnan(nodata):
+                region_mask = np.isnan(region)
+            elif not np.issubdtype(region.dtype, np.integer):
+                region_mask = np.isclose(region, nodata)
+            else:
+                region_mask = region == nodata
+            region_mask &= ~np.ma.getmaskarray(data)
+            np.copyto(region, data, where=region_mask, casting="unsafe")
+
+        canvas_transform = windows.transform(grid_win, transform)
+        if dst_path is not None:
+            profile.update(**(dst_kwds or {}))
+            profile.update(transform=canvas_transform, width=grid_win.width,
+                           height=grid_win.height, count=count, dtype=dtype)
+            with rasterio.open(dst_path, "w", **profile) as dst:
+                dst.write(canvas)
+                if sparse:
+                    write_grid_window(dst, grid_win, width, height)
+
+        return canvas, canvas_transform
+
+
+if __name__ == "__main__":
+    # Compare with rasterio.merge on random rasters on the target grid
+    # (partial overlaps, float32 with NaN, uint16 with nodata, no nodata),
+    # whole grid and sparse output
+    import os
+    import tempfile
+
+    from rasterio.merge import merge as rio_merge
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    cases = [("float32", np.nan), ("uint16", 65535), ("float32", None)]
+    n_cases = 0
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            Mosaic(res=10, workers=2) as mosaic:
+        for case in range(60):
+            dtype, nodata = cases[case % len(cases)]
+            paths = []
+            for i in range(rng.integers(1, 5)):
+                width, height = rng.integers(5, 120, 2)
+                if dtype == "uint16":
+                    arr = rng.integers(0, 1000, (1, height, width))
+                else:
+                    arr = rng.random((1, height, width))
+                arr = arr.astype(dtype)
+                if nodata is not None:
+                    arr[rng.random(arr.shape) < 0.2] = nodata
+                path = os.path.join(tmp_dir, f"{case}_{i}.tif")
+                with rasterio.open(
+                        path, "w", driver="GTiff", width=width, height=height,
+                        count=1, dtype=dtype, nodata=nodata, crs="EPSG:28992",
+                        transform=from_origin(
+                            10 * rng.integers(0, 100),
+                            10 * rng.integers(100, 200), 10, 10)) as dst:
+                    dst.write(arr)
+                paths.append(path)
+
+            # Random bounds (partly outside the rasters)
+            x = sorted(rng.uniform(-100, 1300, 2))
+            y = sorted(rng.uniform(-100, 2000, 2))
+            bounds = [x[0], y[0], x[1] + 20, y[1] + 20]
+            expected, exp_transform = rio_merge(paths, bounds=bounds, res=10,
+                                                target_aligned_pixels=True)
+            mosaic.bounds = bounds
+            mosaic.grid = target_grid(bounds, mosaic.res)
+            out_path = os.path.join(tmp_dir, f"{case}_mosaic.tif")
+            canvas, transform = mosaic.merge(paths, dst_path=out_path)
+            assert transform == exp_transform, (case, transform)
+            assert np.array_equal(canvas, expected, equal_nan=True), case
+            with rasterio.open(out_path) as src:
+                assert np.array_equal(src.read(), expected, equal_nan=True)
+
+            # Sparse output placed on the grid is the same
+            sparse_path = os.path.join(tmp_dir, f"{case}_sparse.tif")
+            mosaic.merge(paths, dst_path=sparse_path, sparse=True)
+            with rasterio.open(sparse_path) as src:
+                window, grid_transform, width, height = grid_window(src)
+                assert grid_transform == exp_transform, case
+                assert (height, width) == expected.shape[1:], case
+                rows, cols = window.toslices()
+                outside = np.ones(expected.shape, dtype=bool)
+                outside[:, rows, cols] = False
+                assert np.array_equal(src.read(), expected[:, rows, cols],
+                                      equal_nan=True), case
+                fill = 0 if nodata is None else nodata
+                assert np.array_equal(expected[outside],
+                                      np.full(outside.sum(), fill, dtype),
+                                      equal_nan=True), case
+            n_cases += 1
+
+    print(f"Mosaic is identical to rasterio.merge in {n_cases} cases "
+          f"(whole grid and sparse)")
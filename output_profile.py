@@ -0,0 +1,195 @@
+"""
+Output profile (compression, predictor, tiling, threads) for all GeoTIFF
+writers of the processing chain.
+
+All rasters written by slc_week.py and composite_dask.py take their creation
+options from the active output profile, which is set once per process with
+set_output_profile() (slc_week passes it to the tile workers as well).
+
+Running this file benchmarks write time and file size of all codecs on a
+representative raster.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+
+from quantize import ENCODINGS
+
+# Compression level used if level is not set (per codec)
+DEFAULT_LEVELS = {"zstd": 9, "deflate": 6, "lzw": None, "none": None}
+
+# Creation option for the compression level (per codec)
+LEVEL_OPTIONS = {"zstd": "zstd_level", "deflate": "zlevel"}
+
+
+class OutputProfile:
+    """GeoTIFF creation options shared by all writers.
+
+    Parameters
+    ----------
+    codec : str
+        Compression, either "zstd", "deflate", "lzw" or "none".
+    level : int (optional)
+        Compression level (ZSTD 1-22, DEFLATE 1-9), default from
+        DEFAULT_LEVELS.
+    predictor : bool
+        Use floating point predictor (3) for float data and horizontal
+        differencing (2) for integer data.
+    blocksize : int
+        Size of the internal tiles (None for strips).
+    num_threads : str or int
+        Number of threads used by GDAL for compression ("ALL_CPUS" or int).
+    quantize : bool
+        Store COH and SIG values as quantized uint16 instead of float32 (see
+        quantize.py for the encodings and their error bounds).
+    """
+    def __init__(self, codec="deflate", level=None, predictor=True,
+                 blocksize=512, num_threads="ALL_CPUS", quantize=False):
+        codec = codec.lower()
+        if codec not in DEFAULT_LEVELS:
+            raise Exception(f"{codec} is not a valid codec!")
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.predictor = predictor
+        self.blocksize = blocksize
+        self.num_threads = num_threads
+        self.quantize = quantize
+
+    def __repr__(self):
+        return (f"OutputProfile(codec={self.codec!r}, level={self.level}, "
+                f"predictor={self.predictor}, blocksize={self.blocksize}, "
+                f"num_threads={self.num_threads!r}, "
+                f"quantize={self.quantize})")
+
+    def options(self, dtype):
+        """Returns creation options (for updating rasterio profile) for data
+        of the given dtype."""
+        opts = {"driver": "GTiff", "bigtiff": "if_safer"}
+        if self.blocksize:
+            opts.update(tiled=True, blockxsize=self.blocksize,
+                        blockysize=self.blocksize)
+        else:
+            opts.update(tiled=False)
+        if self.codec == "none":
+            opts["compress"] = "none"
+            return opts
+
+        opts.update(compress=self.codec, num_threads=self.num_threads)
+        if self.level is not None:
+            opts[LEVEL_OPTIONS[self.codec]] = self.level
+        if self.predictor:
+            is_float = np.issubdtype(np.dtype(dtype), np.floating)
+            opts["predictor"] = 3 if is_float else 2
+        return opts
+
+
+# Output profile used by the processing routines
+_output_profile = OutputProfile()
+
+
+def set_output_profile(profile):
+    """Sets the output profile for this process (OutputProfile or codec name,
+    None for the default profile)."""
+    global _output_profile
+    if profile is None:
+        profile = OutputProfile()
+    elif isinstance(profile, str):
+        profile = OutputProfile(profile)
+    _output_profile = profile
+
+
+def get_output_profile():
+    return _output_profile
+
+
+def creation_options(dtype):
+    """Returns creation options of the active output profile."""
+    return _output_profile.options(dtype)
+
+
+def encoding_for(data_type):
+    """Returns encoding for storing data type (COH or SIG) with the active
+    output profile (None for float32)."""
+    if not _output_profile.quantize:
+        return None
+    return ENCODINGS[data_type]
+
+
+def update_profile(profile, dtype=None, output_profile=None):
+    """Updates rasterio profile with the options of the output profile
+    (active one if not given) and removes options of the source that do not
+    apply to the output."""
+    if output_profile is None:
+        output_profile = _output_profile
+    for key in ("blockxsize", "blockysize", "tiled", "compress", "predictor",
+                "interleave"):
+        profile.pop(key, None)
+    profile.update(output_profile.options(dtype or profile["dtype"]))
+    return profile
+
+
+def benchmark_codecs(src_fp, profiles=None, out_dir=None):
+    """Writes the source raster with each profile and reports write time and
+    file size.
+
+    Parameters
+    ----------
+    src_fp : str
+        Path to a representative raster (e.g. merged SLC product).
+    profiles : list(OutputProfile) (optional)
+        Profiles to compare, default are all codecs with default settings and
+        single-threaded LZW without predictor (previous behaviour).
+    out_dir : str (optional)
+        Folder for test files (removed afterwards), default is temp folder.
+
+    Returns
+    -------
+    results : list(dict)
+        Profile, write time (sec.), size (MB) and ratio to uncompressed size.
+    """
+    if profiles is None:
+        profiles = [
+            OutputProfile("lzw", predictor=False, blocksize=None,
+                          num_threads=1),
+            OutputProfile("lzw"),
+            OutputProfile("deflate"),
+            OutputProfile("zstd"),
+            OutputProfile("zstd", level=1),
+            OutputProfile("none")
+        ]
+
+    with rasterio.open(src_fp) as src:
+        arr = src.read()
+        profile = src.profile.copy()
+    raw_size = arr.nbytes
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        for i, prof in enumerate(profiles):
+            out_fp = os.path.join(tmp_dir, f"bench_{i:02}.tif")
+            out_profile = update_profile(profile.copy(), arr.dtype, prof)
+            t_write = time.time()
+            with rasterio.open(out_fp, "w", **out_profile) as dst:
+                dst.write(arr)
+            t_write = time.time() - t_write
+            size = os.path.getsize(out_fp)
+            results.append({
+                "profile": repr(prof),
+                "time": t_write,
+                "size_mb": size / 1024 ** 2,
+                "ratio": size / raw_size
+            })
+            print(f"{repr(prof):95} {t_write:7.2f} sec. "
+                  f"{size / 1024 ** 2:9.1f} MB ({size / raw_size:.2f})")
+
+    return results
+
+
+if __name__ == "__main__":
+    # Representative SLC data (e.g. an individual product before compositing)
+    in_fp = "d:\\aitlas_slc_test_NL\\20170301T055251_1C3D_DES_VV.tif"
+
+    benchmark_codecs(in_fp)
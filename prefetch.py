@@ -0,0 +1,106 @@
+"""
+Asynchronous read-ahead of source data.
+
+While the main thread is busy with cleaning and merging of one product, a
+background thread already reads the next products from the (slow) network
+share. Reading stops when the read-ahead depth or the memory budget is
+reached and continues as soon as the main thread takes the next item.
+"""
+import threading
+import time
+
+# Memory budget for data that was read ahead, but not yet used (in GB)
+MAX_READ_AHEAD_GB = 2
+
+
+def _nbytes(data):
+    """Estimates memory size of the returned data (sum of all arrays)."""
+    if hasattr(data, "nbytes"):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(_nbytes(a) for a in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(_nbytes(a) for a in data)
+    return 0
+
+
+class ReadAhead:
+    """Reads items in a background thread, in the same order as they are
+    used by the main thread.
+
+    Parameters
+    ----------
+    items : list(tuple)
+        Arguments of read_fn for each item (in order of use).
+    read_fn : function
+        Function that reads one item.
+    depth : int
+        Maximum number of items read ahead of the one being used.
+    max_gb : float
+        Memory budget for items that were read but not yet used. At least one
+        item is always read ahead, even if it is larger than the budget.
+    """
+    def __init__(self, items, read_fn, depth=2, max_gb=MAX_READ_AHEAD_GB):
+        self.items = items
+        self.read_fn = read_fn
+        self.depth = depth
+        self.max_bytes = max_gb * 1024 ** 3
+
+        self._results = {}
+        self._buffered = 0
+        self._next_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Time spent reading (background) and time main thread was blocked
+        self.read_time = 0
+        self.wait_time = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for idx, args in enumerate(self.items):
+            with self._cond:
+                while not self._closed and self._results and (
+                        idx >= self._next_use + self.depth
+                        or self._buffered >= self.max_bytes):
+                    self._cond.wait()
+                if self._closed:
+                    return
+            t_read = time.time()
+            try:
+                result = (self.read_fn(*args), None)
+            except Exception as err:
+                result = (None, err)
+            t_read = time.time() - t_read
+            with self._cond:
+                self.read_time += t_read
+                self._results[idx] = result
+                self._buffered += _nbytes(result[0])
+                self._cond.notify_all()
+
+    def get(self, idx):
+        """Returns item idx (blocks until it is read). Items have to be taken
+        in order."""
+        t_wait = time.time()
+        with self._cond:
+            while idx not in self._results:
+                self._cond.wait()
+            data, err = self._results.pop(idx)
+            self._buffered -= _nbytes(data)
+            self._next_use = idx + 1
+            self.wait_time += time.time() - t_wait
+            self._cond.notify_all()
+        if err is not None:
+            raise err
+        return data
+
+    def close(self):
+        """Stops reading (items that were not used are discarded)."""
+        with self._cond:
+            self._closed = True
+            self._results.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+        self._thread.join()
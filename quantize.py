@@ -0,0 +1,177 @@
+"""
+Compact (quantized) storage of coherence and sigma rasters.
+
+Instead of float32 with NaN nodata, values are stored as uint16 with a reserved
+nodata value (65535), which halves the size of all intermediates and products
+before compression (and compresses better):
+    - COH: linear encoding, value = stored * 0.0001, absolute quantization
+           error <= 0.00005 (coherence is clipped to [0, 1] anyway), except
+           for values below 0.00005, which are stored as 0.0001 (zero marks
+           missing data)
+    - SIG: log-scaled encoding, value in dB = stored * 0.002 - 50, relative
+           quantization error <= 0.023 % (values below -50 dB, i.e. 1e-5, are
+           stored as -50 dB, the largest value is 81 dB)
+
+Each quantization step adds at most this error. Values are quantized when
+bursts are cleaned (merging copies the stored values, so it adds no error) and
+again when the composite is saved, so the weekly products are within twice the
+bound of the unquantized processing chain.
+
+Scale and offset are written to the GDAL band metadata (for SIG they convert
+to dB) and the encoding is written to the dataset tags, from which the
+readers (composite, previews) decode the values.
+"""
+import numpy as np
+
+# Stored value for nodata (never used for valid data)
+NODATA = 65535
+
+
+class LinearEncoding:
+    """Stores value as round((value - offset) / scale) in uint16.
+
+    Parameters
+    ----------
+    scale : float
+        Quantization step.
+    offset : float
+        Smallest value that can be stored (smaller values are clipped).
+    """
+    name = "linear"
+    dtype = "uint16"
+    nodata = NODATA
+
+    def __init__(self, scale, offset=0.0):
+        self.scale = scale
+        self.offset = offset
+
+    def __repr__(self):
+        return f"{type(self).__name__}(scale={self.scale}, offset={self.offset})"
+
+    @property
+    def max_error(self):
+        """Maximum quantization error (absolute, in units of the value)."""
+        return self.scale / 2
+
+    def _to_stored(self, arr):
+        return arr
+
+    def _from_stored(self, arr):
+        return arr
+
+    def encode(self, arr):
+        """Quantizes array (NaN is stored as nodata)."""
+        valid = ~np.isnan(arr)
+        stored = np.zeros(arr.shape, dtype=self.dtype)
+        q = (self._to_stored(arr[valid]) - self.offset) / self.scale
+        # Zero marks missing data in the processing chain, so (valid) values
+        # are never stored as zero
+        low = 1 if self.offset == 0 else 0
+        stored[valid] = np.clip(np.rint(q), low, self.nodata - 1)
+        stored[~valid] = self.nodata
+        return stored
+
+    def decode(self, arr):
+        """Returns float32 values (NaN for nodata), works with numpy and dask
+        arrays."""
+        values = self._from_stored(arr * self.scale + self.offset)
+        values = values.astype("float32")
+        return np.where(arr == self.nodata, np.float32(np.nan), values)
+
+    def tags(self):
+        """Dataset tags describing the encoding."""
+        return {"QUANTIZATION": self.name, "QUANT_SCALE": repr(self.scale),
+                "QUANT_OFFSET": repr(self.offset)}
+
+
+class LogEncoding(LinearEncoding):
+    """Stores value in dB (10 * log10(value)) with LinearEncoding. Scale and
+    offset are given in dB."""
+    name = "log10"
+
+    @property
+    def max_error(self):
+        """Maximum quantization error (relative to the value)."""
+        return 10 ** (self.scale / 20) - 1
+
+    def _to_stored(self, arr):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            db = 10 * np.log10(arr.astype("float64"))
+        # Zero and negative values are stored as the smallest value
+        return np.where(arr > 0, db, self.offset)
+
+    def _from_stored(self, arr):
+        return np.power(10.0, arr / 10)
+
+
+# Encoding used for each data type if quantization is enabled
+ENCODINGS = {
+    "COH": LinearEncoding(0.0001, 0.0),
+    "SIG": LogEncoding(0.002, -50.0)
+}
+
+# Encoding classes by name (for reading tags)
+_ENCODING_TYPES = {a.name: a for a in (LinearEncoding, LogEncoding)}
+
+
+def encoding_from_tags(tags):
+    """Returns encoding described in the dataset tags (None if values are not
+    quantized)."""
+    name = tags.get("QUANTIZATION")
+    if name is None:
+        return None
+    if name not in _ENCODING_TYPES:
+        raise Exception(f"{name} is not a valid quantization!")
+    return _ENCODING_TYPES[name](float(tags["QUANT_SCALE"]),
+                                 float(tags["QUANT_OFFSET"]))
+
+
+def write_encoding(dst, encoding):
+    """Writes encoding tags and GDAL scale/offset metadata to the opened
+    (writable) rasterio dataset."""
+    dst.update_tags(**encoding.tags())
+    dst.scales = [encoding.scale] * dst.count
+    dst.offsets = [encoding.offset] * dst.count
+
+
+def encoded_profile(profile, encoding):
+    """Updates rasterio profile for storing encoded values."""
+    profile.update(dtype=encoding.dtype, nodata=encoding.nodata)
+    return profile
+
+
+def read_decoded(src, *args, **kwargs):
+    """Reads dataset (same arguments as src.read()) and decodes the values if
+    they are quantized."""
+    arr = src.read(*args, **kwargs)
+    encoding = encoding_from_tags(src.tags())
+    if encoding is None:
+        return arr
+    return encoding.decode(arr)
+
+
+if __name__ == "__main__":
+    # Check quantization error bounds on random data covering the full range
+    # of each data type (including nodata)
+    rng = np.random.default_rng(0)
+
+    coh = rng.uniform(0, 1, (1, 1000, 1000)).astype("float32")
+    coh[0, :10] = np.nan
+    enc = ENCODINGS["COH"]
+    dec = enc.decode(enc.encode(coh))
+    assert np.array_equal(np.isnan(dec), np.isnan(coh))
+    err = np.abs(dec - coh)
+    small = coh < enc.scale / 2
+    assert np.all(err[small] <= enc.scale) and np.all(dec[small] > 0)
+    err = np.nanmax(err[~small])
+    assert err <= enc.max_error + 1e-6, err
+    print(f"{enc}: max abs. error {err:.2e} (bound {enc.max_error:.2e})")
+
+    sig = (10 ** rng.uniform(-4.9, 4, (1, 1000, 1000))).astype("float32")
+    sig[0, :10] = np.nan
+    enc = ENCODINGS["SIG"]
+    dec = enc.decode(enc.encode(sig))
+    assert np.array_equal(np.isnan(dec), np.isnan(sig))
+    err = np.nanmax(np.abs(dec - sig) / sig)
+    assert err <= enc.max_error + 1e-6, err
+    print(f"{enc}: max rel. error {err:.2e} (bound {enc.max_error:.2e})")
@@ -66,7 +66,7 @@ print(result)
 
 # ==============================================================================
 # CHECK ASF
-from check_asf import check_asf
+from check_asf import check_asf, check_asf_batch
 
 # Polygon for Netherlands (AOI)
 netherlands = ("6.525,53.5239,5.1388,53.3312,4.6883,52.9431,3.6671,51.4616,"
@@ -99,6 +99,13 @@ in_month = 2  # Set month to None to search entire year
 out = check_asf(in_polygon, in_src_pth, in_sur_pth, in_year, in_month)
 print(out)
 
+# Several AOIs and periods at once (one report and one download list)
+# in_jobs = [("NL", netherlands, 2019), ("NL", netherlands, (2017, 8)),
+#            ("DK", denmark, ("20190101", "20190630"))]
+#
+# out = check_asf_batch(in_jobs, in_src_pth, workers=4)
+# print(out)
+
 # ==============================================================================
 # COMPOSITE DASK
 from composite_dask import composite
@@ -0,0 +1,303 @@
+"""
+Reading the contents of Sentinel-1 SLC products (SAFE zip files) without
+unpacking them.
+
+read_product() only reads the zip central directory (names, sizes and CRC of
+all members) and the small XML members: manifest.safe (acquisition period,
+orbit, pass, polarizations, footprint) and the annotation file of each swath
+and polarization (number of bursts, burst size). The measurement rasters are
+never read, so indexing a 5 GB product reads well under 1 MB.
+
+extract() unpacks only the members of the requested polarizations and swaths
+(measurement, annotation, calibration and noise files) and manifest.safe.
+
+The index of a whole archive is kept in the product inventory, see
+Inventory.index_contents() in inventory.py.
+"""
+import os
+import re
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+
+# Members of the SAFE product (swath and polarization are in the file names)
+_SWATH_FILE = re.compile(
+    r"(?:^|/)(annotation/calibration/(?:calibration|noise)-|annotation/|"
+    r"measurement/)s1[a-d]-(iw\d|ew\d|s\d|wv\d)-slc-(hh|hv|vv|vh)-",
+    re.IGNORECASE)
+_KINDS = {"annotation/calibration/calibration-": "calibration",
+          "annotation/calibration/noise-": "noise",
+          "annotation/": "annotation",
+          "measurement/": "measurement"}
+
+# Members that are extracted by default
+EXTRACT_KINDS = ("manifest", "annotation", "calibration", "noise",
+                 "measurement")
+
+
+def member_info(name):
+    """Returns (kind, swath, polarization) of a member of the SAFE zip, kind
+    is manifest, annotation, calibration, noise, measurement or other (swath
+    and polarization are None if they are not in the name)."""
+    if name.endswith("/manifest.safe"):
+        return "manifest", None, None
+    match = _SWATH_FILE.search(name)
+    if match is None:
+        return "other", None, None
+    kind = _KINDS[match.group(1).lower()]
+    if kind != "measurement" and not name.lower().endswith(".xml"):
+        return "other", None, None
+    return kind, match.group(2).upper(), match.group(3).upper()
+
+
+def _local(tag):
+    """Returns XML tag without the namespace."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_manifest(f):
+    """Returns acquisition period, orbits, pass, polarizations and footprint
+    from manifest.safe (file object)."""
+    info = {"start": None, "stop": None, "pass": None, "absolute_orbit": None,
+            "relative_orbit": None, "polarizations": [], "footprint": None}
+    for _, elem in ET.iterparse(f):
+        tag = _local(elem.tag)
+        if tag in ("startTime", "stopTime") and elem.text:
+            key = tag[:-4]
+            if info[key] is None:
+                info[key] = elem.text.strip()
+        elif tag == "pass" and elem.text:
+            info["pass"] = elem.text.strip()
+        elif tag == "orbitNumber" and elem.get("type") == "start":
+            info["absolute_orbit"] = int(elem.text)
+        elif tag == "relativeOrbitNumber" and elem.get("type") == "start":
+            info["relative_orbit"] = int(elem.text)
+        elif tag == "transmitterReceiverPolarisation":
+            info["polarizations"].append(elem.text.strip())
+        elif tag == "coordinates" and info["footprint"] is None:
+            info["footprint"] = elem.text.strip()
+    return info
+
+
+def parse_annotation(f):
+    """Returns swath, polarization, period and burst layout from an
+    annotation XML (file object).
+
+    Parsing stops at the burst list, the geolocation grid and the rest of
+    the file are not read.
+    """
+    info = {"swath": None, "polarization": None, "start": None, "stop": None,
+            "lines_per_burst": None, "samples_per_burst": None, "bursts": 0}
+    tags = {"swath": "swath", "polarisation": "polarization",
+            "startTime": "start", "stopTime": "stop",
+            "linesPerBurst": "lines_per_burst",
+            "samplesPerBurst": "samples_per_burst"}
+    for event, elem in ET.iterparse(f, events=("start", "end")):
+        tag = _local(elem.tag)
+        if event == "start":
+            if tag == "burstList":
+                info["bursts"] = int(elem.get("count", 0))
+                break
+        elif tag in tags and info[tags[tag]] is None and elem.text:
+            value = elem.text.strip()
+            if tag in ("linesPerBurst", "samplesPerBurst"):
+                value = int(value)
+            info[tags[tag]] = value
+    return info
+
+
+def read_product(zip_path):
+    """Reads the index of one SAFE zip file.
+
+    Parameters
+    ----------
+    zip_path : str
+        Path to the product (zip).
+
+    Returns
+    -------
+    product : dict
+        Fields of manifest.safe (start, stop, pass, absolute_orbit,
+        relative_orbit, polarizations, footprint), members (list of
+        (name, size, compressed size, CRC)) and swaths (list of dicts with
+        swath, polarization, bursts, lines_per_burst, samples_per_burst,
+        start, stop, annotation, measurement and measurement_size).
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = zf.infolist()
+        product = {"members": [(a.filename, a.file_size, a.compress_size,
+                                a.CRC) for a in infos if not a.is_dir()]}
+        swaths = {}
+        manifest = None
+        for a in infos:
+            kind, swath, polar = member_info(a.filename)
+            if kind == "manifest":
+                manifest = a
+            elif kind in ("annotation", "measurement"):
+                entry = swaths.setdefault((swath, polar), {
+                    "swath": swath, "polarization": polar, "annotation": None,
+                    "measurement": None, "measurement_size": None})
+                entry[kind] = a.filename
+                if kind == "measurement":
+                    entry["measurement_size"] = a.file_size
+
+        if manifest is None:
+            raise Exception(f"No manifest.safe in {zip_path}")
+        with zf.open(manifest) as f:
+            product.update(parse_manifest(f))
+
+        for entry in swaths.values():
+            if entry["annotation"] is None:
+                continue
+            with zf.open(entry["annotation"]) as f:
+                info = parse_annotation(f)
+            for key in ("bursts", "lines_per_burst", "samples_per_burst",
+                        "start", "stop"):
+                entry[key] = info[key]
+    product["swaths"] = sorted(swaths.values(),
+                               key=lambda a: (a["swath"], a["polarization"]))
+    return product
+
+
+def extract(zip_path, dest, polarizations=None, swaths=None,
+            kinds=EXTRACT_KINDS):
+    """Extracts selected members of a SAFE zip file.
+
+    Parameters
+    ----------
+    zip_path : str
+        Path to the product (zip).
+    dest : str
+        Folder where the members are extracted (the SAFE folder structure is
+        kept).
+    polarizations : list(str) (optional)
+        Polarizations to extract (e.g. ["VV"]), default is all.
+    swaths : list(str) (optional)
+        Swaths to extract (e.g. ["IW1", "IW2"]), default is all.
+    kinds : list(str)
+        Kinds of members to extract (see member_info()).
+
+    Returns
+    -------
+    paths : list(str)
+        Paths to the extracted files (files that already exist with the same
+        size are not extracted again).
+    """
+    if polarizations is not None:
+        polarizations = {a.upper() for a in polarizations}
+    if swaths is not None:
+        swaths = {a.upper() for a in swaths}
+    paths = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for a in zf.infolist():
+            kind, swath, polar = member_info(a.filename)
+            if kind not in kinds:
+                continue
+            if swath is not None and (
+                    (polarizations is not None and polar not in polarizations)
+                    or (swaths is not None and swath not in swaths)):
+                continue
+            out_path = os.path.join(dest, *a.filename.split("/"))
+            paths.append(out_path)
+            if os.path.isfile(out_path) and \
+                    os.path.getsize(out_path) == a.file_size:
+                continue
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp_path = out_path + ".part"
+            with zf.open(a) as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmp_path, out_path)
+    return paths
+
+
+def make_test_product(zip_path, swaths=("IW1", "IW2", "IW3"),
+                      polarizations=("VV", "VH"), bursts=9,
+                      measurement_size=1024):
+    """Writes a small SAFE zip with the structure of an IW SLC product (for
+    testing)."""
+    granule = os.path.basename(zip_path)[:-4]
+    start = granule[17:32]
+    stop = granule[33:48]
+    iso = [f"{a[:4]}-{a[4:6]}-{a[6:8]}T{a[9:11]}:{a[11:13]}:{a[13:15]}"
+           for a in (start, stop)]
+    mission = granule[:3].lower()
+    safe = f"{granule}.SAFE"
+    manifest = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" '
+        'xmlns:safe="http://www.esa.int/safe/sentinel-1.0" '
+        'xmlns:s1="http://www.esa.int/safe/sentinel-1.0/sentinel-1" '
+        'xmlns:s1sarl1="http://www.esa.int/safe/sentinel-1.0/sentinel-1/'
+        'sar/level-1" xmlns:gml="http://www.opengis.net/gml">'
+        '<metadataSection>'
+        '<safe:acquisitionPeriod>'
+        f'<safe:startTime>{iso[0]}.000000</safe:startTime>'
+        f'<safe:stopTime>{iso[1]}.000000</safe:stopTime>'
+        '</safe:acquisitionPeriod>'
+        '<safe:orbitReference>'
+        '<safe:orbitNumber type="start">15510</safe:orbitNumber>'
+        '<safe:orbitNumber type="stop">15510</safe:orbitNumber>'
+        '<safe:relativeOrbitNumber type="start">37</safe:relativeOrbitNumber>'
+        '<safe:extension><s1:orbitProperties><s1:pass>DESCENDING</s1:pass>'
+        '</s1:orbitProperties></safe:extension>'
+        '</safe:orbitReference>'
+        '<s1sarl1:standAloneProductInformation>'
+        + "".join(f'<s1sarl1:transmitterReceiverPolarisation>{p}'
+                  f'</s1sarl1:transmitterReceiverPolarisation>'
+                  for p in polarizations) +
+        '</s1sarl1:standAloneProductInformation>'
+        '<safe:frameSet><safe:frame><safe:footPrint>'
+        '<gml:coordinates>52.9,6.8 53.3,3.0 51.6,2.6 51.2,6.4'
+        '</gml:coordinates></safe:footPrint></safe:frame></safe:frameSet>'
+        '</metadataSection></xfdu:XFDU>')
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f"{safe}/manifest.safe", manifest)
+        zf.writestr(f"{safe}/preview/quick-look.png", b"png")
+        for i, swath in enumerate(swaths):
+            for polar in polarizations:
+                name = (f"{mission}-{swath.lower()}-slc-{polar.lower()}-"
+                        f"{start.lower()}-{stop.lower()}-015510-019735-"
+                        f"{i + 1:03}")
+                burst_xml = "".join(f"<burst><azimuthTime>{b}</azimuthTime>"
+                                    f"</burst>" for b in range(bursts))
+                annotation = (
+                    '<?xml version="1.0" encoding="UTF-8"?><product>'
+                    f'<adsHeader><swath>{swath}</swath>'
+                    f'<polarisation>{polar}</polarisation>'
+                    f'<startTime>{iso[0]}</startTime>'
+                    f'<stopTime>{iso[1]}</stopTime></adsHeader>'
+                    '<swathTiming><linesPerBurst>1503</linesPerBurst>'
+                    '<samplesPerBurst>21631</samplesPerBurst>'
+                    f'<burstList count="{bursts}">{burst_xml}</burstList>'
+                    '</swathTiming><geolocationGrid/></product>')
+                zf.writestr(f"{safe}/annotation/{name}.xml", annotation)
+                zf.writestr(f"{safe}/annotation/calibration/calibration-"
+                            f"{name}.xml", "<calibration/>")
+                zf.writestr(f"{safe}/annotation/calibration/noise-"
+                            f"{name}.xml", "<noise/>")
+                zf.writestr(zipfile.ZipInfo(
+                    f"{safe}/measurement/{name}.tiff"),
+                    os.urandom(measurement_size), zipfile.ZIP_STORED)
+    return zip_path
+
+
+if __name__ == "__main__":
+    # Local test: index and partly extract a generated product
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_zip = make_test_product(os.path.join(
+            tmp_dir, "S1A_IW_SLC__1SDV_20170301T053235_20170301T053302_"
+                     "015510_019735_8A6E.zip"))
+        out = read_product(in_zip)
+        print({k: v for k, v in out.items() if k not in ("members",
+                                                         "swaths")})
+        print(len(out["members"]), "members")
+        [print(a) for a in out["swaths"]]
+        assert len(out["swaths"]) == 6 and out["relative_orbit"] == 37
+        assert all(a["bursts"] == 9 for a in out["swaths"])
+
+        out_paths = extract(in_zip, os.path.join(tmp_dir, "out"), ["VV"],
+                            ["IW2"])
+        [print(os.path.relpath(a, tmp_dir)) for a in out_paths]
+        assert len(out_paths) == 5, out_paths
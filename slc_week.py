@@ -26,9 +26,13 @@ vi ) Resample (bilinear) and target aligned pixels to match with S-2 raster
 vii) Create mean weekly mosaic from all resampled images for that week
 """
 
+import copy
 import glob
+import math
+import multiprocessing
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from shutil import rmtree
 
@@ -36,13 +40,41 @@ import numpy as np
 from osgeo import gdal
 import rasterio
 from rasterio.mask import mask
-from rasterio.merge import merge
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window, from_bounds
 from scipy.ndimage import binary_dilation
 from shapely.geometry import box, mapping
 import geopandas as gpd
 
+from burst_index import get_burst_index, set_burst_index
 from composite_dask import composite
+from gdal_config import (get_gdal_config, report as gdal_report,
+                         set_gdal_config, with_gdal_env)
+from local_cache import (get_burst_cache, get_staging_cache, set_burst_cache,
+                         set_staging_cache, stage)
+from mosaic import MOSAIC_WORKERS, Mosaic
+from output_profile import (creation_options, encoding_for,
+                            get_output_profile, set_output_profile,
+                            update_profile)
+from prefetch import ReadAhead
+from quantize import encoded_profile, encoding_from_tags, write_encoding
 from tif2jpg import tif2jpg
+from work_queue import HEARTBEAT, LEASE_TIMEOUT, WorkQueue
+
+# Number of iterations used for removing dark pixels on the edge of each burst
+EDGE_EROSION = 10
+
+# Decimation of the read that estimates valid pixels of a burst (min_valid)
+PROBE_DECIMATION = 8
+
+# All product combinations (orbit direction, polarization)
+COMBINATIONS = [
+    ("DES", "VV"),
+    ("DES", "VH"),
+    ("ASC", "VV"),
+    ("ASC", "VH")
+]
 
 
 class WeekList:
@@ -105,14 +137,18 @@ def days_in_week(one_week):
     return list_of_days
 
 
-def make_save_folder(week_from_dict, dt, save_path):
-    """Creates and returns path to a sub-folder for saving weekly products."""
+def week_name(week_from_dict, dt):
+    """Returns name of the sub-folder for saving weekly products."""
     start_date = week_from_dict["start"].strftime("%Y%m%d")
     end_date = week_from_dict["end"].strftime("%Y%m%d")
     yr = week_from_dict["start"].strftime("%Y")[2:]
     wk = week_from_dict["week"]
-    save_name = f"yr{yr}wk{wk:02}_SLC_{dt}_{start_date}_{end_date}_weekly"
-    save_loc = os.path.join(save_path, save_name)
+    return f"yr{yr}wk{wk:02}_SLC_{dt}_{start_date}_{end_date}_weekly"
+
+
+def make_save_folder(week_from_dict, dt, save_path):
+    """Creates and returns path to a sub-folder for saving weekly products."""
+    save_loc = os.path.join(save_path, week_name(week_from_dict, dt))
     os.makedirs(save_loc, exist_ok=True)
 
     return save_loc
@@ -164,7 +200,151 @@ def find_individual_images(list_of_days, src, direction, dt):
     return out_image_with_list
 
 
-def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None):
+def burst_cache_key(cache, burst_file, polarity, bbox, dt):
+    """Returns burst cache key for all parameters that determine the cleaned
+    burst."""
+    return cache.key(
+        burst_file,
+        polarity=polarity,
+        bbox=list(bbox) if bbox else None,
+        dt=dt,
+        edge_erosion=EDGE_EROSION,
+        encoding=repr(encoding_for(dt))
+    )
+
+
+def probe_valid_pixels(src, poly, decimation=PROBE_DECIMATION):
+    """Estimates number of valid pixels of the burst (open dataset) inside
+    poly that remain after the edge erosion.
+
+    Reads the first band at 1/decimation of the resolution (GDAL uses
+    overviews if the source has them), so the probe reads a fraction of the
+    data of the full read. Narrow overlaps (where the edge erosion decides)
+    are read with less decimation, they are small anyway. Thin nodata lines
+    can be missed by the decimated read, so the estimate is rather too high
+    than too low.
+    """
+    window = from_bounds(*poly.bounds, transform=src.transform)
+    window = window.round_offsets().round_lengths()
+    try:
+        window = window.intersection(Window(0, 0, src.width, src.height))
+    except Exception:
+        return 0
+    if window.width < 1 or window.height < 1:
+        return 0
+    decimation = max(1, min(decimation, int(min(window.width, window.height)
+                                            // (2 * EDGE_EROSION))))
+    out_shape = (max(1, math.ceil(window.height / decimation)),
+                 max(1, math.ceil(window.width / decimation)))
+    arr = src.read(1, window=window, out_shape=out_shape,
+                   resampling=Resampling.nearest)
+    valid = np.isfinite(arr) & (arr != 0)
+    erosion = round(EDGE_EROSION / decimation)
+    if erosion and valid.any():
+        valid &= ~binary_dilation(~valid, iterations=erosion)
+    return int(valid.sum() * window.width * window.height / arr.size)
+
+
+@with_gdal_env
+def read_bursts(bursts_list, polarity, bbox=None, dt=None, min_valid=0):
+    """Reads all bursts of one product (cropped to bbox).
+
+    Returns a list with a dictionary for each burst, containing path to the
+    burst file, its extents and (only if it overlaps with bbox) the cropped
+    array with its transform and profile. Only this step reads source data,
+    so it can run in a background thread (see prefetch.ReadAhead).
+
+    If burst cache is set (and dt is given), bursts that were already cleaned
+    with the same parameters are not read, their dictionary contains path to
+    the "cached" burst instead of the array.
+
+    If burst index is set, extents of the bursts are taken from the index
+    and the overlapping bursts are found with one spatial query.
+
+    If min_valid is given, valid pixels of each overlapping burst inside bbox
+    (after the edge erosion) are first estimated from a decimated read (see
+    probe_valid_pixels()). Bursts with fewer valid pixels are not read, their
+    dictionary contains the estimate ("skipped"). The estimate is stored with
+    the cleaned burst in the burst cache, cached bursts are checked with the
+    stored estimate (or probed if it is missing) and skipped the same way.
+    """
+    cache = get_burst_cache() if dt else None
+    index = get_burst_index()
+    if index is not None:
+        # Footprints of all bursts, overlapping ones with a single query
+        index.update(bursts_list)
+        if bbox:
+            overlapping = index.query(bbox, bursts_list)
+    out = []
+    for burst in bursts_list:
+        if index is not None:
+            # Full file name and extents of the burst from the index
+            burst_file = index.burst_file(burst, polarity)
+            burst_bounds = index.footprint(burst)
+        else:
+            # Determine full file name
+            p = os.path.join(burst, f"*{polarity}*.img")
+            burst_file = glob.glob(p)[0]
+
+            with rasterio.open(burst_file) as src:
+                # Extents of the burst
+                burst_bounds = box(*src.bounds)
+
+        # Check if extents overlap with AOI (if bbox was assigned)
+        # This will make sure all parts of the image that fall out of bounds are cropped
+        if bbox:
+            # Check if bounding boxes overlap
+            if index is not None:
+                is_overlapping = burst in overlapping
+            else:
+                is_overlapping = burst_bounds.intersects(box(*bbox))
+
+            # Get intersection between AOI bbox and burst bbox
+            out_poly = burst_bounds.intersection(box(*bbox))
+        else:
+            # If bbox of AOI was not assigned, do not crop the image
+            is_overlapping = True
+            out_poly = burst_bounds
+
+        one_burst = {"file": burst_file, "bounds": burst_bounds, "array": None}
+        if is_overlapping and cache:
+            key = burst_cache_key(cache, burst_file, polarity, bbox, dt)
+            one_burst.update(key=key, cached=cache.get(key))
+
+        # Estimate valid pixels from a decimated read (or the estimate stored
+        # with the cached burst)
+        if is_overlapping and min_valid:
+            valid = None
+            if one_burst.get("cached"):
+                valid = cache.valid_pixels(one_burst["key"])
+            if valid is None:
+                t_probe = time.time()
+                with rasterio.open(burst_file) as src:
+                    valid = probe_valid_pixels(src, out_poly)
+                one_burst["probe_time"] = time.time() - t_probe
+            one_burst["valid"] = valid
+            if valid < min_valid:
+                one_burst.update(skipped=valid, cached=None)
+                is_overlapping = False
+
+        if is_overlapping and not one_burst.get("cached"):
+            # Crop image to bbox (read from local copy if staging cache is set)
+            mask_poly = [mapping(out_poly)]
+            with rasterio.open(stage(burst_file)) as src:
+                burst_arr, burst_transform = mask(src, mask_poly, crop=True, filled=True)
+                one_burst.update(
+                    array=burst_arr,
+                    transform=burst_transform,
+                    profile=src.profile
+                )
+        out.append(one_burst)
+
+    return out
+
+
+@with_gdal_env
+def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None,
+                       bursts_data=None):
     """Prepares input images (bursts) for processing and returns list of paths.
 
         For each burst:
@@ -177,47 +357,42 @@ def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None):
         3a) If yes, then first erode by a couple pixels
         3b) Use GDAL fill nodata to interpolate missing data
         4)  Erode the edges of the raster (remove dark pixels)
+
+        Bursts are read with read_bursts(), unless they were already read
+        (bursts_data). Cleaned bursts are quantized if the output profile
+        says so. Bursts found in the burst cache are used directly, newly
+        cleaned bursts are added to it.
     """
+    if bursts_data is None:
+        bursts_data = read_bursts(bursts_list, polarity, bbox, dt)
+    encoding = encoding_for(dt)
+    cache = get_burst_cache()
+
     paths = []
-    for i, burst in enumerate(bursts_list):
+    for i, burst in enumerate(bursts_data):
         print(f"{i+1}", end="")
+        burst_file = burst["file"]
 
-        # Determine full file name
-        p = os.path.join(burst, f"*{polarity}*.img")
-        burst_file = glob.glob(p)[0]
-
-        # Check if extents overlap with AOI (if bbox was assigned)
-        # This will make sure all parts of the image that fall out of bounds are cropped
         if bbox:
-            with rasterio.open(burst_file) as src:
-                # Extents of the burst
-                burst_bounds = box(*src.bounds)
-
-            # Check if bounding boxes overlap
-            is_overlapping = burst_bounds.intersects(box(*bbox))
             shp_name = f"{i:02d}_" + os.path.basename(burst_file)[:-4] + ".gpkg"
             out_shp = os.path.join(folder_pth, shp_name)
-            gpd.GeoSeries([burst_bounds, box(*bbox)]).to_file(out_shp, driver="GPKG")
-
-            # Get intersection between AOI bbox and burst bbox
-            out_poly = burst_bounds.intersection(box(*bbox))
-
-        else:
-            # If bbox of AOI was not assigned, do not crop the image
-            is_overlapping = True
-            out_poly = burst_bounds
-
-        if is_overlapping:
+            gpd.GeoSeries([burst["bounds"], box(*bbox)]).to_file(out_shp, driver="GPKG")
+
+        if burst.get("cached"):
+            paths.append(burst["cached"])
+            print(f"C ", end="")
+        elif "skipped" in burst:
+            # Too few valid pixels inside bounds (estimated)
+            print(f":low ", end="")
+        elif burst["array"] is not None:
             # Store paths of output, so they can be used in the nex step
             image_name = f"{i:02d}_" + os.path.basename(burst_file)[:-4] + ".tif"
             out_burst = os.path.join(folder_pth, image_name)
             paths.append(out_burst)
 
-            # Crop image to bbox
-            mask_poly = [mapping(out_poly)]
-            with rasterio.open(burst_file) as src:
-                burst_arr, burst_transform = mask(src, mask_poly, crop=True, filled=True)
-                burst_profile = src.profile
+            burst_arr = burst["array"]
+            burst_transform = burst["transform"]
+            burst_profile = burst["profile"].copy()
 
             # Deal with nodata
             burst_arr[np.isnan(burst_arr)] = 0
@@ -225,7 +400,7 @@ def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None):
 
             # Remove dark pixels on the edge of each raster
             nodata_mask = np.isnan(burst_arr)
-            dilated_mask = binary_dilation(nodata_mask, iterations=10)
+            dilated_mask = binary_dilation(nodata_mask, iterations=EDGE_EROSION)
             burst_arr[dilated_mask] = np.nan
             
             # Clip values larger than 1 for COH
@@ -233,15 +408,21 @@ def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None):
                 burst_arr[burst_arr > 1] = 1
 
             burst_profile.update(
-                driver="GTiff",
-                compress="lzw",
                 width=burst_arr.shape[2],
                 height=burst_arr.shape[1],
                 transform=burst_transform,
                 nodata=np.nan
             )
+            if encoding:
+                burst_arr = encoding.encode(burst_arr)
+                encoded_profile(burst_profile, encoding)
+            update_profile(burst_profile, burst_arr.dtype)
             with rasterio.open(out_burst, "w", **burst_profile) as dst:
                 dst.write(burst_arr)
+                if encoding:
+                    write_encoding(dst, encoding)
+            if cache and burst.get("key"):
+                cache.put(burst["key"], out_burst, burst.get("valid"))
 
             print(f"X ", end="")
         else:
@@ -250,7 +431,10 @@ def pre_process_bursts(bursts_list, polarity, folder_pth, dt, bbox=None):
     return paths
 
 
-def make_individual_rasters(to_aggregate, direct, polar, tmp_folder, dt, bbox=None):
+@with_gdal_env
+def make_individual_rasters(to_aggregate, direct, polar, tmp_folder, dt, bbox=None,
+                            bounds=None, read_ahead=0, min_valid=0,
+                            timings=None, mosaic_workers=MOSAIC_WORKERS):
     """Prepares all individual products from one week for compositing.
 
     Parameters
@@ -269,11 +453,25 @@ def make_individual_rasters(to_aggregate, direct, polar, tmp_folder, dt, bbox=No
         COH or SIG
     bbox : list
         Output extents in the [x_min, y_min, x_max, y_max] format
+    bounds : list (optional)
+        Extents of the merged image, if different from bbox (used for tiles)
+    read_ahead : int
+        Number of products that are read in a background thread while the
+        current one is being processed (0 to read in the main thread)
+    min_valid : int
+        Bursts with fewer (estimated) valid pixels inside bbox are skipped
+        without reading them (0 to read all overlapping bursts)
+    mosaic_workers : int
+        Number of bursts read in parallel while mosaicking
+    timings : dict (optional)
+        Seconds and work of each stage are added to it: read (bytes),
+        clean (burst pixels) and mosaic (output pixels), see cost_model.py
 
     Returns
     -------
     final_paths : list
-        List of paths to the prepared products.
+        List of paths to the prepared products (each stored only over its
+        footprint window on the grid of bounds, see mosaic.py).
 
     Notes
     _____
@@ -288,44 +486,618 @@ def make_individual_rasters(to_aggregate, direct, polar, tmp_folder, dt, bbox=No
     """
     # Make sure output folder exist
     os.makedirs(tmp_folder, exist_ok=True)
+    if bounds is None:
+        bounds = bbox
+
+    # Read bursts of the next products while the current one is processed
+    prefetch = None
+    if read_ahead and to_aggregate:
+        prefetch = ReadAhead(
+            [(bursts, polar, bbox, dt, min_valid)
+             for _, bursts in to_aggregate],
+            read_bursts,
+            depth=read_ahead
+        )
+    # Target grid and canvas are the same for all products
+    mosaic = Mosaic(bounds, res=10, workers=mosaic_workers)
+    tt_all = time.time()
+    tt_io = 0
+    tt_probe = 0
+    n_skipped = 0
 
     # Process all individual images (warp to single file)
     final_paths = []
-    for product, bursts in to_aggregate:
-        tta1 = time.time()
-        print(f"\n     Pre-processing {product}")
-
-        # Pre-process "bursts" for warping into a single image
-        # to_be_warped is a LIST OF PATHS to individual product folders
-        print(f"        - consists of {len(bursts)} bursts\n        ", end="")
-        to_be_warped = pre_process_bursts(bursts, polar, tmp_folder, dt, bbox=bbox)
-
-        if to_be_warped:
-            # WARP BURSTS INTO SINGLE IMAGE
-            out_image = os.path.join(tmp_folder, product + f"_{direct}_{polar}.tif")
-            final_paths.append(out_image)
-            print(f"\n        - warping into a single image")
-
-            # Resample to 10m using bilinear interpolation and align pixels to grid
-            # Also crop to extents - all files should have the same extents (outputBounds)
-            merge(
-                to_be_warped,
-                bounds=bbox,
-                res=(10, 10),
-                target_aligned_pixels=True,
-                dst_path=out_image
+    try:
+        for k, (product, bursts) in enumerate(to_aggregate):
+            tta1 = time.time()
+            print(f"\n     Pre-processing {product}")
+
+            # Read bursts (time spent waiting for data counts as I/O)
+            if prefetch:
+                wait_before = prefetch.wait_time
+                bursts_data = prefetch.get(k)
+                tt_io += prefetch.wait_time - wait_before
+            else:
+                tt_read = time.time()
+                bursts_data = read_bursts(bursts, polar, bbox, dt, min_valid)
+                tt_io += time.time() - tt_read
+
+            # Pre-process "bursts" for warping into a single image
+            # to_be_warped is a LIST OF PATHS to individual product folders
+            print(f"        - consists of {len(bursts)} bursts\n        ", end="")
+            if timings is not None:
+                arrays = [a["array"] for a in bursts_data if a["array"] is not None]
+                add_timing(timings, "read", time.time() - tta1,
+                           sum(a.nbytes for a in arrays))
+                tt_clean = time.time()
+            to_be_warped = pre_process_bursts(bursts, polar, tmp_folder, dt, bbox=bbox,
+                                              bursts_data=bursts_data)
+            if timings is not None:
+                add_timing(timings, "clean", time.time() - tt_clean,
+                           sum(a.size for a in arrays))
+                arrays = None
+            if min_valid:
+                skipped = [a["skipped"] for a in bursts_data if "skipped" in a]
+                checked = [a for a in bursts_data if "valid" in a]
+                t_probe = sum(a.get("probe_time", 0) for a in checked)
+                print(f"\n        - skipped {len(skipped)} of {len(checked)} checked "
+                      f"bursts with < {min_valid} valid pixels "
+                      f"(estimated: {skipped}) [probes: {t_probe:.2f} sec.]",
+                      end="")
+                tt_probe += t_probe
+                n_skipped += len(skipped)
+            bursts_data = None
+
+            if to_be_warped:
+                # WARP BURSTS INTO SINGLE IMAGE
+                out_image = os.path.join(tmp_folder, product + f"_{direct}_{polar}.tif")
+                final_paths.append(out_image)
+                print(f"\n        - warping into a single image")
+                tt_mosaic = time.time()
+
+                # Resample to 10m using bilinear interpolation and align pixels to grid
+                # Only the footprint window of the product is stored (sparse), its
+                # position on the grid of the extents (bounds) is in the tags
+                with rasterio.open(to_be_warped[0]) as first:
+                    merge_dtype = first.dtypes[0]
+                mosaic.merge(
+                    to_be_warped,
+                    dst_path=out_image,
+                    dst_kwds=creation_options(merge_dtype),
+                    sparse=True
+                )
+                # Merge copies quantized values, but not the encoding metadata
+                encoding = encoding_for(dt)
+                if encoding:
+                    with rasterio.open(out_image, "r+") as dst:
+                        write_encoding(dst, encoding)
+                if timings is not None:
+                    with rasterio.open(out_image) as dst:
+                        add_timing(timings, "mosaic", time.time() - tt_mosaic,
+                                   dst.width * dst.height)
+
+                # # REMOVE TEMPORARY FILES ("bursts")
+                # for file in to_be_warped:
+                #     os.remove(file)
+
+                tta1 = time.time() - tta1
+                print(f"        [Time (individual image): {tta1:.2f} sec.]")
+            else:
+                print(f"\n        - no images inside bounds... SKIPPING")
+    finally:
+        if prefetch:
+            prefetch.close()
+        mosaic.close()
+    tt_all = time.time() - tt_all
+    print(f"\n     [Time blocked on I/O: {tt_io:.2f} sec., "
+          f"computing: {tt_all - tt_io:.2f} sec.]")
+    if min_valid:
+        print(f"     [Skipped {n_skipped} low-coverage bursts, "
+              f"probes: {tt_probe:.2f} sec.]")
+
+    return final_paths
+
+
+def add_timing(timings, stage, seconds, work):
+    """Adds seconds and work (bytes or pixels) of a processing stage."""
+    entry = timings.setdefault(stage, {"seconds": 0, "work": 0})
+    entry["seconds"] += seconds
+    entry["work"] += work
+
+
+def align_bounds(bbox, res=10):
+    """Snaps bbox outwards to the target grid (same as target_aligned_pixels
+    in rasterio.merge)."""
+    return [
+        math.floor(bbox[0] / res) * res,
+        math.floor(bbox[1] / res) * res,
+        math.ceil(bbox[2] / res) * res,
+        math.ceil(bbox[3] / res) * res
+    ]
+
+
+def default_tile_margin(src_res=14, res=10):
+    """Returns overlap margin (in map units) that is large enough for the
+    burst edge erosion.
+
+    Each burst is eroded by EDGE_EROSION source pixels, one more pixel is lost
+    when masking the burst to the tile polygon and one more for resampling to
+    the target grid. Default source resolution covers the coarsest products
+    (SI coherence at 13.91 m).
+    """
+    return math.ceil((EDGE_EROSION + 2) * src_res / res) * res
+
+
+def make_tiles(bbox, tile_size, margin=None, res=10):
+    """Splits bbox into tiles aligned to the target grid.
+
+    Parameters
+    ----------
+    bbox : list
+        Output extents in the [x_min, y_min, x_max, y_max] format.
+    tile_size : int
+        Size of the tile core in map units (rounded to a multiple of res).
+    margin : int (optional)
+        Overlap margin in map units, defaults to default_tile_margin().
+    res : int
+        Pixel size of the target grid.
+
+    Returns
+    -------
+    tiles : list(dict)
+        For each tile its name, core extents (the part that ends up in the
+        assembled product), processing extents (core with the overlap margin,
+        clipped to the AOI) and merge extents.
+
+    Notes
+    -----
+    Bursts are cropped to the processing extents, but merged with extents
+    padded by another margin on the inner sides of the tile. This way merge
+    never cuts a cropped burst on the inner side and places its pixels on the
+    same position of the target grid as in the untiled run (sources off the
+    target grid are resampled by the pixel centers, see mosaic.Mosaic).
+    """
+    if margin is None:
+        margin = default_tile_margin(res=res)
+    tile_size = max(res, round(tile_size / res) * res)
+    margin = math.ceil(margin / res) * res
+    x_min, y_min, x_max, y_max = align_bounds(bbox, res)
+
+    tiles = []
+    for row, top in enumerate(range(y_max, y_min, -tile_size)):
+        bottom = max(top - tile_size, y_min)
+        for col, left in enumerate(range(x_min, x_max, tile_size)):
+            right = min(left + tile_size, x_max)
+            tiles.append({
+                "name": f"r{row:02}c{col:02}",
+                "core": [left, bottom, right, top],
+                "bbox": [
+                    max(left - margin, bbox[0]),
+                    max(bottom - margin, bbox[1]),
+                    min(right + margin, bbox[2]),
+                    min(top + margin, bbox[3])
+                ],
+                "bounds": [
+                    max(left - 2 * margin, bbox[0]),
+                    max(bottom - 2 * margin, bbox[1]),
+                    min(right + 2 * margin, bbox[2]),
+                    min(top + 2 * margin, bbox[3])
+                ]
+            })
+
+    return tiles
+
+
+def process_tile(to_aggregate, direct, polar, tile, tmp_folder, dt,
+                 method="mean", save_loc=None, read_ahead=0, min_valid=0,
+                 mosaic_workers=MOSAIC_WORKERS):
+    """Runs burst cleaning, mosaicking and compositing for a single tile and
+    returns path to the tile composite (None if no images inside the tile).
+    Tile composite is saved to tmp_folder, unless save_loc is given."""
+    print(f"\n    Tile {tile['name']} {tile['bbox']}")
+    paths_for_composite = make_individual_rasters(
+        to_aggregate,
+        direct,
+        polar,
+        tmp_folder,
+        dt=dt,
+        bbox=tile["bbox"],
+        bounds=tile["bounds"],
+        read_ahead=read_ahead,
+        min_valid=min_valid,
+        mosaic_workers=mosaic_workers
+    )
+    if not paths_for_composite:
+        return None
+
+    return composite(
+        paths_for_composite,
+        save_loc or tmp_folder,
+        f"composite_{tile['name']}",
+        method=method,
+        dt=dt
+    )
+
+
+def worker_threads(num_threads, n_workers):
+    """Returns the share of num_threads ("ALL_CPUS" or int) of one of
+    n_workers processes running at the same time (at least 1)."""
+    if num_threads == "ALL_CPUS":
+        num_threads = os.cpu_count() or 1
+    return max(1, int(num_threads) // n_workers)
+
+
+def tile_worker_settings(n_workers):
+    """Returns output profile, GDAL configuration and number of mosaic
+    workers of this process for each of n_workers tile workers.
+
+    The thread counts (GDAL_NUM_THREADS, num_threads of the output profile
+    and the mosaic workers) are divided among the tile workers, otherwise
+    every worker starts as many threads as the whole machine has cores.
+    """
+    output_profile = copy.copy(get_output_profile())
+    output_profile.num_threads = worker_threads(output_profile.num_threads,
+                                                n_workers)
+    gdal_config = copy.copy(get_gdal_config())
+    gdal_config.num_threads = worker_threads(gdal_config.num_threads,
+                                             n_workers)
+    return (output_profile, gdal_config,
+            worker_threads(MOSAIC_WORKERS, n_workers))
+
+
+def _init_tile_worker(cache, output_profile, gdal_config, burst_cache,
+                      burst_index):
+    """Applies settings of the parent process in a tile worker."""
+    set_staging_cache(cache)
+    set_output_profile(output_profile)
+    set_gdal_config(gdal_config)
+    set_burst_cache(burst_cache)
+    set_burst_index(burst_index)
+
+
+def _process_tile_worker(*args, **kwargs):
+    """Runs process_tile() in a tile worker and returns staging cache, burst
+    cache and burst index statistics of the worker together with the
+    result."""
+    tif = process_tile(*args, **kwargs)
+    stats = [cache.pop_stats() if cache is not None else None
+             for cache in (get_staging_cache(), get_burst_cache(),
+                           get_burst_index())]
+    return tif, stats
+
+
+def process_tiles(to_aggregate, direct, polar, tmp_folder, dt, tiles,
+                  method="mean", max_workers=None, read_ahead=0,
+                  min_valid=0):
+    """Processes all tiles in parallel (one process per tile) and returns a
+    list of paths to tile composites (same order as tiles).
+
+    Workers are always started with "spawn" (default on Windows), forked
+    workers can deadlock in the Dask thread pool of the parent process.
+    Staging cache, output profile, GDAL configuration, burst cache and burst
+    index of this process are also used by the workers (bursts of all
+    products are added to the index first, so workers do not read them
+    again). Threads of GDAL, the output profile and the mosaic are divided
+    among the workers (tile_worker_settings()).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    caches = (get_staging_cache(), get_burst_cache(), get_burst_index())
+    if caches[2] is not None:
+        caches[2].update_products(to_aggregate)
+    n_workers = max(1, min(max_workers or os.cpu_count() or 1, len(tiles)))
+    output_profile, gdal_config, mosaic_workers = \
+        tile_worker_settings(n_workers)
+    print(f"\n    {n_workers} tile workers, threads per worker: "
+          f"GDAL {gdal_config.num_threads}, "
+          f"compression {output_profile.num_threads}, "
+          f"mosaic {mosaic_workers}")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                             initializer=_init_tile_worker,
+                             initargs=(caches[0], output_profile,
+                                       gdal_config, caches[1],
+                                       caches[2])) as pool:
+        futures = [
+            pool.submit(
+                _process_tile_worker,
+                to_aggregate,
+                direct,
+                polar,
+                tile,
+                os.path.join(tmp_folder, tile["name"]),
+                dt,
+                method,
+                read_ahead=read_ahead,
+                min_valid=min_valid,
+                mosaic_workers=mosaic_workers
             )
+            for tile in tiles
+        ]
+        tile_paths = []
+        for future in futures:
+            tif, stats = future.result()
+            tile_paths.append(tif)
+            for cache, cache_stats in zip(caches, stats):
+                if cache is not None and cache_stats:
+                    cache.add_stats(cache_stats)
 
-            # # REMOVE TEMPORARY FILES ("bursts")
-            # for file in to_be_warped:
-            #     os.remove(file)
+    return tile_paths
 
-            tta1 = time.time() - tta1
-            print(f"        [Time (individual image): {tta1:.2f} sec.]")
-        else:
-            print(f"\n        - no images inside bounds... SKIPPING")
 
-    return final_paths
+@with_gdal_env
+def assemble_tiles(tiles, tile_paths, bbox, save_loc, save_nam, res=10,
+                   as_tiled_set=False):
+    """Assembles cores of tile composites into the weekly product.
+
+    The output grid is the same as for the untiled run (bbox snapped to the
+    target grid), so the cores can be copied with integer pixel offsets.
+
+    Parameters
+    ----------
+    tiles : list(dict)
+        Tiles as returned by make_tiles().
+    tile_paths : list(str)
+        Paths to tile composites (None for tiles without any data).
+    bbox : list
+        Output extents in the [x_min, y_min, x_max, y_max] format.
+    save_loc : str
+        Path to save folder.
+    save_nam : str
+        Name of the file to be saved.
+    res : int
+        Pixel size of the target grid.
+    as_tiled_set : bool
+        If True, each core is saved as a separate GeoTIFF and a VRT is
+        created instead of a single mosaic.
+
+    Returns
+    -------
+    out_pth : str
+        Path to the product (None if none of the tiles contain data).
+    """
+    valid = [pth for pth in tile_paths if pth]
+    if not valid:
+        return None
+
+    with rasterio.open(valid[0]) as src:
+        out_meta = update_profile(src.profile.copy())
+        encoding = encoding_from_tags(src.tags())
+    nodata = encoding.nodata if encoding else np.nan
+
+    x_min, y_min, x_max, y_max = align_bounds(bbox, res)
+    out_meta.update(
+        width=round((x_max - x_min) / res),
+        height=round((y_max - y_min) / res),
+        transform=from_origin(x_min, y_max, res, res),
+        nodata=nodata
+    )
+    os.makedirs(save_loc, exist_ok=True)
+
+    def read_core(tile, pth):
+        left, bottom, right, top = tile["core"]
+        shape = (out_meta["count"], round((top - bottom) / res),
+                 round((right - left) / res))
+        if pth is None:
+            return np.full(shape, nodata, dtype=out_meta["dtype"])
+        with rasterio.open(pth) as src:
+            window = Window(
+                round((left - src.bounds.left) / res),
+                round((src.bounds.top - top) / res),
+                shape[2],
+                shape[1]
+            )
+            return src.read(window=window)
+
+    if as_tiled_set:
+        tiles_loc = os.path.join(save_loc, save_nam + "_tiles")
+        os.makedirs(tiles_loc, exist_ok=True)
+        tile_files = []
+        for tile, pth in zip(tiles, tile_paths):
+            arr = read_core(tile, pth)
+            tile_meta = out_meta.copy()
+            tile_meta.update(
+                width=arr.shape[2],
+                height=arr.shape[1],
+                transform=from_origin(
+                    tile["core"][0], tile["core"][3], res, res)
+            )
+            tile_file = os.path.join(tiles_loc, f"{save_nam}_{tile['name']}.tif")
+            with rasterio.open(tile_file, "w", **tile_meta) as dst:
+                dst.write(arr)
+                if encoding:
+                    write_encoding(dst, encoding)
+            tile_files.append(tile_file)
+        out_pth = os.path.join(save_loc, save_nam + ".vrt")
+        vrt = gdal.BuildVRT(out_pth, tile_files)
+        if encoding:
+            vrt.SetMetadata(encoding.tags())
+            for i in range(vrt.RasterCount):
+                vrt.GetRasterBand(i + 1).SetScale(encoding.scale)
+                vrt.GetRasterBand(i + 1).SetOffset(encoding.offset)
+        vrt = None
+        return out_pth
+
+    out_pth = os.path.join(save_loc, save_nam + ".tif")
+    with rasterio.open(out_pth, "w", **out_meta) as dst:
+        for tile, pth in zip(tiles, tile_paths):
+            window = Window(
+                round((tile["core"][0] - x_min) / res),
+                round((y_max - tile["core"][3]) / res),
+                round((tile["core"][2] - tile["core"][0]) / res),
+                round((tile["core"][3] - tile["core"][1]) / res)
+            )
+            dst.write(read_core(tile, pth), window=window)
+        if encoding:
+            write_encoding(dst, encoding)
+
+    return out_pth
+
+
+def init_week_log(this_week, data_type, save_loc, bbox, tiles=None,
+                  log_suffix=""):
+    """Creates the folder for weekly products and initializes the log file.
+
+    Returns paths to the weekly folder and to the log file.
+    """
+    week_path = make_save_folder(this_week, data_type, save_loc)
+
+    # Initialize LOG
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    log_name = f"log_{timestr}{log_suffix}.txt"
+    log_name = os.path.join(week_path, log_name)
+    with open(log_name, "w") as log:
+        title_str = f"# Log of {os.path.basename(week_path)} #"
+        log.write("#" * len(title_str) + "\n")
+        log.write(title_str + "\n")
+        log.write("#" * len(title_str) + "\n")
+
+        current_time = time.strftime("%a, %d %b %Y %H:%M:%S")
+        log.write("\n")
+        log.write(f"Time started: {current_time}\n")
+
+        log.write("\n")
+        log.write("Save location:\n")
+        log.write(week_path + "\n")
+        log.write("\n")
+        log.write("Geo. extents [minx, miny, maxx, maxy]:\n")
+        log.write(f"{bbox}\n")
+        log.write("\n")
+        if tiles:
+            log.write(f"Processed in {len(tiles)} tiles [core] [bbox]:\n")
+            for tile in tiles:
+                log.write(f" - {tile['name']} {tile['core']} {tile['bbox']}\n")
+            log.write("\n")
+
+    return week_path, log_name
+
+
+def composite_name_for(this_week, data_type, direct, polar):
+    """Returns file name (without extension) of the weekly composite."""
+    diw = days_in_week(this_week)
+    tww = this_week["week"]
+    return f"{diw[0]}_{diw[-1]}_weekly_SLC_{data_type}" \
+           f"_{direct}_{polar}_yr{diw[0][2:4]}wk{tww:02}"
+
+
+def find_week_images(this_week, direct, polar, src_folder, data_type,
+                     log_name=None):
+    """Finds individual images of one week and logs them (if log is given)."""
+    # Filter list for dates within this week
+    diw = days_in_week(this_week)  # diw = Days In Week (list)
+
+    # Find individual images for that day
+    to_aggregate = find_individual_images(diw, src_folder, direct, data_type)
+
+    # LOG INPUT FILES
+    if log_name:
+        with open(log_name, "a") as log:
+            log.write(f"Source products for {direct} {polar}:\n")
+            for prod1, prod2 in to_aggregate:
+                log.write(f" - {prod1}\n")
+                [log.write(f"   -> {a}\n") for a in prod2]
+            log.write("\n")
+
+    return to_aggregate
+
+
+def process_combo(
+        this_week,
+        direct,
+        polar,
+        bbox,
+        data_type,
+        src_folder,
+        week_path,
+        log_name,
+        temp_path=".\\tmp2",
+        country_border=None,
+        tiles=None,
+        tile_workers=None,
+        as_tiled_set=False,
+        read_ahead=0,
+        min_valid=0
+):
+    """Creates the weekly composite (and preview) for one product combination.
+
+    Returns path to the composite or None if there are no images available.
+    """
+    t_combo = time.time()
+    print(f"  Now processing combo: {direct} {polar}")
+
+    # Create folder for saving
+    tmp_f = os.path.join(temp_path, direct + "_" + polar)
+    os.makedirs(tmp_f, exist_ok=True)
+
+    to_aggregate = find_week_images(this_week, direct, polar, src_folder,
+                                    data_type, log_name)
+    composite_name = composite_name_for(this_week, data_type, direct, polar)
+
+    tif = None
+    if tiles:
+        # ==================================================================
+        # PROCESS TILES (individual images + composite for each tile)
+        tile_paths = process_tiles(
+            to_aggregate,
+            direct,
+            polar,
+            tmp_f,
+            data_type,
+            tiles,
+            method="mean",
+            max_workers=tile_workers,
+            read_ahead=read_ahead,
+            min_valid=min_valid
+        )
+        tif = assemble_tiles(
+            tiles,
+            tile_paths,
+            bbox,
+            week_path,
+            composite_name,
+            as_tiled_set=as_tiled_set
+        )
+        paths_for_composite = [pth for pth in tile_paths if pth]
+    else:
+        # ==================================================================
+        # PROCESS INDIVIDUAL IMAGES
+        paths_for_composite = make_individual_rasters(
+            to_aggregate,
+            direct,
+            polar,
+            tmp_f,
+            dt=data_type,
+            bbox=bbox,
+            read_ahead=read_ahead,
+            min_valid=min_valid
+        )
+    t_combo = time.time() - t_combo
+    print(f"\n  Finished combo {direct} {polar} in {t_combo:.2f} sec.")
+
+    # ======================================================================
+    # CREATE COMPOSITE
+    tta2 = time.time()
+    if paths_for_composite:
+        diw = days_in_week(this_week)
+        print(f"\nCreating composite for {direct} {polar} {data_type} in {diw[0]}")
+        if not tiles:
+            tif = composite(
+                paths_for_composite,
+                week_path,
+                composite_name,
+                method="mean",
+                dt=data_type
+            )
+
+        # CREATE JPG PREVIEW
+        tif2jpg(tif, country_border)
+        tta2 = time.time() - tta2
+        print(f"#\n# Time (composite + preview file): {tta2:.2f} sec.\n")
+    else:
+        print("\nNo images available for this combo!\n# SKIPPED!\n")
+
+    # Remove temporary folder
+    rmtree(tmp_f, ignore_errors=True)
+
+    return tif
 
 
 def loop_weeks(
@@ -337,122 +1109,258 @@ def loop_weeks(
         src_folder,
         save_loc,
         combinations=None,
-        country_border=None
+        country_border=None,
+        tile_size=None,
+        tile_margin=None,
+        tile_workers=None,
+        as_tiled_set=False,
+        staging_cache=None,
+        read_ahead=0,
+        output_profile=None,
+        gdal_config=None,
+        burst_cache=None,
+        min_valid=0,
+        burst_index=None
 ):
+    """Creates weekly composites for all weeks and product combinations.
+
+    If tile_size is given, the bbox is split into tiles aligned to the 10 m
+    grid (with an overlap margin for the burst edge erosion). Each tile is
+    processed independently in a separate process (tile_workers) and tile
+    cores are assembled into the weekly product, which is identical to the
+    product of an untiled run (sources off the 10 m target grid are resampled
+    geometrically, see mosaic.py, tiling_check.py compares tiled and untiled
+    products). With as_tiled_set=True the cores
+    are saved as separate files and a VRT is created instead.
+
+    If staging_cache (local_cache.StagingCache) is given, source rasters are
+    read through the local cache and cache statistics are reported at the end.
+    With read_ahead > 0, bursts of the next read_ahead products are read in a
+    background thread while the current product is processed.
+
+    All rasters are written with output_profile (output_profile.OutputProfile
+    or codec name), default is OutputProfile(). All rasters are opened with
+    gdal_config (gdal_config.GdalConfig or dict of its parameters), default
+    is GdalConfig(). Settings of an earlier call are not kept.
+
+    If burst_cache (local_cache.BurstCache) is given, cleaned bursts are kept
+    in it and re-runs with the same bbox and parameters (e.g. a different
+    compositing method or a repeated week) skip reading and cleaning.
+
+    With min_valid > 0, bursts with fewer valid pixels inside the bbox (or
+    tile) than min_valid are skipped. Valid pixels (after the edge erosion)
+    are estimated from a decimated read of the burst, skip statistics are
+    printed for each product.
+
+    If burst_index (burst_index.BurstIndex) is given, burst extents are read
+    once and kept in a spatial index for all weeks, combos and tiles of the
+    run, overlapping bursts are found with indexed queries.
+    """
     # Create object for finding time intervals for processing
     my_weeks = WeekList(dt_start, dt_end, dt_step)
+    set_staging_cache(staging_cache)
+    set_burst_cache(burst_cache)
+    set_burst_index(burst_index)
+    set_output_profile(output_profile)
+    set_gdal_config(gdal_config)
+    print(f"Output profile: {get_output_profile()}")
+    print(f"GDAL config: {gdal_report()}")
+
+    # Split AOI into tiles
+    tiles = None
+    if tile_size:
+        tiles = make_tiles(bbox, tile_size, tile_margin)
 
     # PROCESS FOR ONE WEEK
     for this_week in my_weeks.week_list:
         tta_week = time.time()
 
         # CREATE NEW FOLDER FOR SAVING WEEKLY PRODUCTS
-        week_path = make_save_folder(this_week, data_type, save_loc)
-        temp_path = ".\\tmp2"
+        week_path, log_name = init_week_log(this_week, data_type, save_loc,
+                                            bbox, tiles)
 
         print(f"\nProcessing {os.path.basename(week_path)}")
 
-        # Initialize LOG
-        timestr = time.strftime("%Y%m%d-%H%M%S")
-        log_name = f"log_{timestr}.txt"
-        log_name = os.path.join(week_path, log_name)
-        with open(log_name, "w") as log:
-            title_str = f"# Log of {os.path.basename(week_path)} #"
-            log.write("#" * len(title_str) + "\n")
-            log.write(title_str + "\n")
-            log.write("#" * len(title_str) + "\n")
-
-            current_time = time.strftime("%a, %d %b %Y %H:%M:%S")
-            log.write("\n")
-            log.write(f"Time started: {current_time}\n")
-
-            log.write("\n")
-            log.write("Save location:\n")
-            log.write(week_path + "\n")
-            log.write("\n")
-            log.write("Geo. extents [minx, miny, maxx, maxy]:\n")
-            log.write(f"{bbox}\n")
-            log.write("\n")
-
         # LOOP OVER ALL 4 PRODUCT COMBINATIONS
         if combinations is None:
-            combinations = [
-                ("DES", "VV"),
-                ("DES", "VH"),
-                ("ASC", "VV"),
-                ("ASC", "VH")
-            ]
+            combinations = COMBINATIONS
         for direct, polar in combinations:
-            t_combo = time.time()
-            print(f"  Now processing combo: {direct} {polar}")
-
-            # Create folder for saving
-            tmp_f = os.path.join(temp_path, direct + "_" + polar)
-            os.makedirs(tmp_f, exist_ok=True)
-
-            # Filter list for dates within this week
-            diw = days_in_week(this_week)  # diw = Days In Week (list)
-
-            # Find individual images for that day
-            to_aggregate = find_individual_images(diw, src_folder, direct,
-                                                  data_type)
-
-            # LOG INPUT FILES
-            with open(log_name, "a") as log:
-                log.write(f"Source products for {direct} {polar}:\n")
-                for prod1, prod2 in to_aggregate:
-                    log.write(f" - {prod1}\n")
-                    [log.write(f"   -> {a}\n") for a in prod2]
-                log.write("\n")
-
-            # ==================================================================
-            # PROCESS INDIVIDUAL IMAGES
-            paths_for_composite = make_individual_rasters(
-                to_aggregate,
+            process_combo(
+                this_week,
                 direct,
                 polar,
-                tmp_f,
-                dt=data_type,
-                bbox=bbox
+                bbox,
+                data_type,
+                src_folder,
+                week_path,
+                log_name,
+                country_border=country_border,
+                tiles=tiles,
+                tile_workers=tile_workers,
+                as_tiled_set=as_tiled_set,
+                read_ahead=read_ahead,
+                min_valid=min_valid
             )
-            t_combo = time.time() - t_combo
-            print(f"\n  Finished combo {direct} {polar} in {t_combo:.2f} sec.")
-
-            # ==================================================================
-            # CREATE COMPOSITE
-            tta2 = time.time()
-            if paths_for_composite:
-                print(f"\nCreating composite for {direct} {polar} {data_type} in {diw[0]}")
-                tww = this_week["week"]
-                composite_name = f"{diw[0]}_{diw[-1]}_weekly_SLC_{data_type}" \
-                                 f"_{direct}_{polar}_yr{diw[0][2:4]}wk{tww:02}"
-                
-                tif = composite(
-                    paths_for_composite,
-                    week_path,
-                    composite_name,
-                    method="mean",
-                    dt=data_type
-                )
-                
-                # CREATE JPG PREVIEW
-                tif2jpg(tif, country_border)
-                tta2 = time.time() - tta2
-                print(f"#\n# Time (composite + preview file): {tta2:.2f} sec.\n")
-            else:
-                print("\nNo images available for this combo!\n# SKIPPED!\n")
-
-            # Remove temporary folder
-            rmtree(tmp_f, ignore_errors=True)
 
         # Print time for processing one week
         tta_week = time.time() - tta_week
         tw = this_week["start"].strftime("%Y%m%d")
         print(f"~~~~ Time for week {tw}: {tta_week:.2f} sec. ~~~~")
 
+    if staging_cache:
+        print(f"\n{staging_cache.report()}")
+    if burst_cache:
+        print(f"\n{burst_cache.report()}")
+    if burst_index is not None:
+        print(f"\n{burst_index.report()}")
+
     return "\n################ Finished processing! ################"
 
 
+def make_week_tasks(week_list, data_type, combinations, tiles=None):
+    """Creates list of tasks (week x combo or week x combo x tile) for the
+    work queue.
+
+    With tiles, each tile is a separate task and an additional "assemble"
+    task (requires all tiles of the week and combo) creates the product.
+    """
+    tasks = []
+    for this_week in week_list:
+        wk_name = week_name(this_week, data_type)
+        for direct, polar in combinations:
+            group = f"{wk_name}_{direct}_{polar}"
+            common = {"week": this_week, "direct": direct, "polar": polar,
+                      "group": group}
+            if not tiles:
+                tasks.append({"id": group, "kind": "combo", **common})
+                continue
+            tile_ids = []
+            for tile in tiles:
+                tile_id = f"{group}_{tile['name']}"
+                tile_ids.append(tile_id)
+                tasks.append({"id": tile_id, "kind": "tile", "tile": tile,
+                              **common})
+            tasks.append({"id": group + "_assemble", "kind": "assemble",
+                          "requires": tile_ids, **common})
+
+    return tasks
+
+
+def queue_weeks(
+        dt_start,
+        dt_end,
+        dt_step,
+        bbox,
+        data_type,
+        src_folder,
+        save_loc,
+        combinations=None,
+        country_border=None,
+        tile_size=None,
+        tile_margin=None,
+        queue_dir=None,
+        worker_id=None,
+        lease_timeout=LEASE_TIMEOUT,
+        heartbeat=HEARTBEAT,
+        staging_cache=None,
+        read_ahead=0,
+        output_profile=None,
+        gdal_config=None,
+        burst_cache=None,
+        min_valid=0,
+        burst_index=None
+):
+    """Same as loop_weeks(), but tasks are claimed through a work queue in the
+    (shared) save location, so any number of hosts (or processes) can work on
+    the same campaign. Run it with the same parameters on every host.
+
+    Tasks are week x combo, or week x combo x tile if tile_size is given (tile
+    composites are kept in the queue folder until they are assembled). Tasks
+    of a worker that stops sending heartbeats for lease_timeout seconds are
+    taken over by other workers.
+
+    Returns
+    -------
+    str
+        Message with the number of tasks processed by this worker.
+    """
+    my_weeks = WeekList(dt_start, dt_end, dt_step)
+    set_staging_cache(staging_cache)
+    set_burst_cache(burst_cache)
+    set_burst_index(burst_index)
+    set_output_profile(output_profile)
+    set_gdal_config(gdal_config)
+    print(f"Output profile: {get_output_profile()}")
+    print(f"GDAL config: {gdal_report()}")
+    tiles = make_tiles(bbox, tile_size, tile_margin) if tile_size else None
+    if combinations is None:
+        combinations = COMBINATIONS
+    if queue_dir is None:
+        queue_dir = os.path.join(save_loc, "_queue")
+
+    queue = WorkQueue(queue_dir, worker_id, lease_timeout, heartbeat)
+    tasks = make_week_tasks(my_weeks.week_list, data_type, combinations, tiles)
+
+    # Temporary files are local to each worker
+    temp_path = os.path.join(".\\tmp2", queue.worker_id)
+
+    def run_task(task):
+        this_week, direct, polar = task["week"], task["direct"], task["polar"]
+        tile_loc = os.path.join(queue_dir, "tiles", task["group"])
+
+        if task["kind"] == "tile":
+            to_aggregate = find_week_images(this_week, direct, polar,
+                                            src_folder, data_type)
+            tmp_f = os.path.join(temp_path, task["id"])
+            tif = process_tile(to_aggregate, direct, polar, task["tile"], tmp_f,
+                               data_type, save_loc=tile_loc,
+                               read_ahead=read_ahead, min_valid=min_valid)
+            rmtree(tmp_f, ignore_errors=True)
+            return tif
+
+        week_path, log_name = init_week_log(
+            this_week, data_type, save_loc, bbox, tiles,
+            log_suffix=f"_{direct}_{polar}_{queue.worker_id}"
+        )
+        if task["kind"] == "combo":
+            return process_combo(this_week, direct, polar, bbox, data_type,
+                                 src_folder, week_path, log_name,
+                                 temp_path=temp_path,
+                                 country_border=country_border,
+                                 read_ahead=read_ahead, min_valid=min_valid)
+
+        # Assemble tiles processed by (possibly) different workers
+        find_week_images(this_week, direct, polar, src_folder, data_type,
+                         log_name)
+        tile_paths = [queue.result(a) for a in task["requires"]]
+        tif = assemble_tiles(
+            tiles,
+            tile_paths,
+            bbox,
+            week_path,
+            composite_name_for(this_week, data_type, direct, polar)
+        )
+        if tif:
+            tif2jpg(tif, country_border)
+        else:
+            print("\nNo images available for this combo!\n# SKIPPED!\n")
+        rmtree(tile_loc, ignore_errors=True)
+        return tif
+
+    processed = queue.run(tasks, run_task)
+    rmtree(temp_path, ignore_errors=True)
+    print(f"\nQueue status: {queue.summary(tasks)}")
+    if staging_cache:
+        print(staging_cache.report())
+    if burst_cache:
+        print(burst_cache.report())
+    if burst_index is not None:
+        print(burst_index.report())
+
+    return f"\n######## Finished processing {len(processed)} tasks " \
+           f"({queue.worker_id}) ########"
+
+
 if __name__ == "__main__":
     # ----- INPUT --------------------------------------------------------------
     # Create list of weekly intervals (6 days per week)
@@ -11,7 +11,11 @@ from matplotlib.collections import PatchCollection
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from numpy.random import rand
 
+from gdal_config import with_gdal_env
+from quantize import encoding_from_tags
 
+
+@with_gdal_env
 def tif2jpg(path_in, country_border=None):
     """Function creates JPEG preview file from SLC weekly composites (GeoTIFF).
     Optionally add country borders to the preview. The image is saved in the
@@ -57,7 +61,14 @@ def tif2jpg(path_in, country_border=None):
         # f = plt.figure(figsize=(9.6, 7.2))
         img_hidden = ax.imshow(rand(2, 2), vmax=v_max, vmin=v_min)
         # ax = f.add_subplot(111)
-        img = rasterio.plot.show((src, 1), ax=ax, vmax=v_max, vmin=v_min)
+        encoding = encoding_from_tags(src.tags())
+        if encoding:
+            # Quantized product, plot decoded values
+            img = rasterio.plot.show(encoding.decode(src.read(1)), ax=ax,
+                                     transform=src.transform, vmax=v_max,
+                                     vmin=v_min)
+        else:
+            img = rasterio.plot.show((src, 1), ax=ax, vmax=v_max, vmin=v_min)
         # fig.colorbar(img_hidden, ax=ax)
 
     # Add title
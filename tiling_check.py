@@ -0,0 +1,221 @@
+"""
+Check that tiled processing gives the same weekly products as the untiled run.
+
+Synthetic products (three acquisitions of three overlapping bursts with the
+usual nodata edges and stripes) are written in the source folder structure of
+slc_week.py, with bursts on the 10 m target grid and off it (13.91 m, like the
+SI coherence products). loop_weeks() is run without tiles and with tiles of
+several sizes (float32 and quantized output) and the weekly products are
+compared pixel by pixel.
+
+check_worker_settings() runs the tile workers with a non-default output
+profile and GDAL configuration and checks that the tile composites were
+written with them (codec, block size and GDAL_TIFF_ENDIANNESS=BIG, which
+makes GDAL write big-endian TIFFs) and that the threads of the parent are
+divided among the workers.
+
+check_queue() runs queue_weeks() in several processes (hosts) sharing one
+save location, without and with tiles, and compares the weekly products with
+the ones of loop_weeks().
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from gdal_config import GdalConfig, get_gdal_config, set_gdal_config
+from output_profile import (OutputProfile, get_output_profile,
+                            set_output_profile)
+from slc_week import (find_week_images, loop_weeks, make_tiles,
+                      process_tiles, queue_weeks, tile_worker_settings,
+                      worker_threads)
+
+# Acquisition days of the synthetic products (two weeks of 6 days)
+DAYS = ["20170301", "20170302", "20170308"]
+
+# Extents of the weekly products (cut by the bursts on all sides)
+BBOX = [1013, 3980, 4200, 4950]
+
+
+def make_products(src_folder, res=10, data_type="SIG", seed=0):
+    """Writes synthetic descending products with bursts of pixel size res
+    (ENVI rasters in the folder structure expected by find_week_images())."""
+    rng = np.random.default_rng(seed)
+    for k, day in enumerate(DAYS):
+        for b in range(3):
+            burst = os.path.join(
+                src_folder, f"S1_{data_type}_2017",
+                f"{day}T0000{k}_AAAAAAAAAAAAAAAAAAAA_DES_b{b}")
+            os.makedirs(burst, exist_ok=True)
+            arr = rng.random((120, 300)).astype("float32")
+            arr[:5, :] = 0
+            arr[:, :7] = np.nan
+            arr[60, 40:200] = 0
+            transform = from_origin(1003 + 41 * k + b * 53,
+                                    5000 - b * 90 - 31 * k, res, res)
+            for polar in ("VV", "VH"):
+                with rasterio.open(
+                        os.path.join(burst, f"Sigma0_{polar}.img"), "w",
+                        driver="ENVI", width=arr.shape[1],
+                        height=arr.shape[0], count=1, dtype="float32",
+                        crs="EPSG:28992", transform=transform) as dst:
+                    dst.write(arr, 1)
+
+
+def compare_products(folder_a, folder_b):
+    """Returns number of weekly products and list of those that differ."""
+    products_a = sorted(glob.glob(os.path.join(folder_a, "*", "*.tif")))
+    products_b = sorted(glob.glob(os.path.join(folder_b, "*", "*.tif")))
+    if [os.path.basename(a) for a in products_a] != \
+            [os.path.basename(a) for a in products_b]:
+        raise Exception(f"Different products in {folder_a} and {folder_b}")
+    different = []
+    for pth_a, pth_b in zip(products_a, products_b):
+        with rasterio.open(pth_a) as src_a, rasterio.open(pth_b) as src_b:
+            if src_a.transform != src_b.transform or not np.array_equal(
+                    src_a.read(), src_b.read(), equal_nan=True):
+                different.append(os.path.basename(pth_b))
+    return len(products_a), different
+
+
+def check_tiling(work_dir, res=10, quantize=False, tile_sizes=(700, 1500)):
+    """Runs untiled and tiled processing of synthetic products, returns
+    dictionary with the differing products for each tile size."""
+    src_folder = os.path.join(work_dir, f"src_{res}")
+    make_products(src_folder, res)
+    bbox = BBOX
+    kwargs = {"combinations": [("DES", "VV")],
+              "output_profile": OutputProfile(quantize=quantize)}
+
+    untiled = os.path.join(work_dir, f"untiled_{res}_{quantize}")
+    loop_weeks(DAYS[0], DAYS[-1], 6, bbox, "SIG", src_folder, untiled,
+               **kwargs)
+    out = {}
+    for tile_size in tile_sizes:
+        tiled = os.path.join(work_dir, f"tiled_{res}_{quantize}_{tile_size}")
+        loop_weeks(DAYS[0], DAYS[-1], 6, bbox, "SIG", src_folder, tiled,
+                   tile_size=tile_size, tile_workers=2, **kwargs)
+        n_products, out[tile_size] = compare_products(untiled, tiled)
+        if not n_products:
+            raise Exception("No weekly products were created")
+    return out
+
+
+def check_worker_settings(work_dir, tile_workers=2):
+    """Processes tiles of synthetic products with a non-default output
+    profile and GDAL configuration, returns list of problems (empty if the
+    tile workers used both and the threads were divided among them)."""
+    src_folder = os.path.join(work_dir, "src_settings")
+    make_products(src_folder)
+    this_week = {"start": datetime(2017, 3, 1), "end": datetime(2017, 3, 6)}
+    to_aggregate = find_week_images(this_week, "DES", "VV", src_folder, "SIG")
+    tiles = make_tiles(BBOX, 1500)
+
+    parent = (get_output_profile(), get_gdal_config())
+    set_output_profile(OutputProfile(codec="lzw", blocksize=256))
+    set_gdal_config(GdalConfig(extra={"GDAL_TIFF_ENDIANNESS": "BIG"}))
+    problems = []
+    try:
+        profile, config, mosaic_workers = tile_worker_settings(tile_workers)
+        n_threads = worker_threads("ALL_CPUS", tile_workers)
+        if (profile.num_threads, config.num_threads) != (n_threads,
+                                                         n_threads):
+            problems.append(f"threads per worker: {profile.num_threads}, "
+                            f"{config.num_threads} instead of {n_threads}")
+        if get_output_profile().num_threads != "ALL_CPUS" or \
+                get_gdal_config().num_threads != "ALL_CPUS":
+            problems.append("threads of the parent process were changed")
+
+        tile_paths = process_tiles(to_aggregate, "DES", "VV",
+                                   os.path.join(work_dir, "tmp_settings"),
+                                   "SIG", tiles, max_workers=tile_workers)
+    finally:
+        set_output_profile(parent[0])
+        set_gdal_config(parent[1])
+
+    tile_paths = [pth for pth in tile_paths if pth]
+    if not tile_paths:
+        problems.append("no tile composites were created")
+    for pth in tile_paths:
+        with rasterio.open(pth) as src:
+            if src.compression is None or src.compression.value != "LZW" or \
+                    src.block_shapes[0] != (256, 256):
+                problems.append(f"{pth}: {src.compression}, "
+                                f"blocks {src.block_shapes[0]}")
+        with open(pth, "rb") as f:
+            if f.read(2) != b"MM":
+                problems.append(f"{pth}: GDAL configuration not used")
+    return problems
+
+
+def _queue_host(work_dir, src_folder, save_loc, worker_id, tile_size):
+    """Runs queue_weeks() as one host (in a separate process, temporary
+    files of the host are kept in work_dir)."""
+    os.chdir(work_dir)
+    queue_weeks(DAYS[0], DAYS[-1], 6, BBOX, "SIG", src_folder, save_loc,
+                combinations=[("DES", "VV"), ("DES", "VH")],
+                tile_size=tile_size, worker_id=worker_id,
+                output_profile=OutputProfile())
+
+
+def check_queue(work_dir, hosts=3, tile_sizes=(None, 1500)):
+    """Runs queue_weeks() in several processes on the same save location,
+    returns dictionary with the products that differ from the ones of
+    loop_weeks() for each tile size (None = untiled tasks)."""
+    src_folder = os.path.join(work_dir, "src_queue")
+    make_products(src_folder)
+    single = os.path.join(work_dir, "single_host")
+    loop_weeks(DAYS[0], DAYS[-1], 6, BBOX, "SIG", src_folder, single,
+               combinations=[("DES", "VV"), ("DES", "VH")],
+               output_profile=OutputProfile())
+
+    ctx = multiprocessing.get_context("spawn")
+    out = {}
+    for tile_size in tile_sizes:
+        save_loc = os.path.join(work_dir, f"queue_{tile_size}")
+        procs = [ctx.Process(target=_queue_host,
+                             args=(work_dir, src_folder, save_loc,
+                                   f"host{i}", tile_size))
+                 for i in range(hosts)]
+        [a.start() for a in procs]
+        [a.join() for a in procs]
+        if any(a.exitcode for a in procs):
+            raise Exception(f"Queue workers failed: "
+                            f"{[a.exitcode for a in procs]}")
+        n_products, out[tile_size] = compare_products(single, save_loc)
+        if n_products != 4:
+            raise Exception(f"{n_products} weekly products instead of 4")
+    return out
+
+
+if __name__ == "__main__":
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for in_res in (10, 13.91):
+            for in_quantize in (False, True):
+                diff = check_tiling(tmp_dir, in_res, in_quantize)
+                results.append((in_res, in_quantize, diff))
+        settings_problems = check_worker_settings(tmp_dir)
+        queue_diff = check_queue(tmp_dir)
+
+    print("\nTiled vs. untiled weekly products:")
+    for in_res, in_quantize, diff in results:
+        for tile_size, different in diff.items():
+            print(f" {in_res} m, {'uint16' if in_quantize else 'float32'}, "
+                  f"tile {tile_size} m: "
+                  f"{'identical' if not different else different}")
+    print("\nSettings of the tile workers: " + (
+        str(settings_problems) if settings_problems
+        else "output profile and GDAL configuration used"))
+    print("Weekly products of 3 queue workers vs. loop_weeks():")
+    for tile_size, different in queue_diff.items():
+        print(f" {'tile ' + str(tile_size) + ' m' if tile_size else 'untiled'}"
+              f": {'identical' if not different else different}")
+    assert not any(d for _, _, diff in results for d in diff.values())
+    assert not settings_problems
+    assert not any(queue_diff.values())
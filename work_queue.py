@@ -0,0 +1,381 @@
+"""
+Work queue on a shared file system for running one processing campaign on
+several hosts at once.
+
+Every host that mounts the shared output folder can join the campaign by
+running the same list of tasks. Tasks are claimed through lock files in the
+queue folder:
+    - <task>.lock   task is claimed (lock file is created atomically, it
+                    contains the worker ID and a token of the claim, its
+                    modification time is the heartbeat of the owner)
+    - <task>.done   task is finished
+    - <task>.failed task failed (contains the traceback)
+
+Locks whose heartbeat is older than the lease timeout belong to an abandoned
+worker and are stolen by the next worker that finds them. The age of a lock is
+measured against the time of the file server (modification time of a probe
+file touched by the worker), so clocks of the hosts do not have to agree. No
+central service is required, the only requirement is that the shared file
+system supports exclusive file creation (O_EXCL) and atomic rename (SMB and
+NFS do).
+"""
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+# Seconds without a heartbeat after which a claimed task can be stolen
+LEASE_TIMEOUT = 600
+
+# Seconds between two heartbeats of the worker
+HEARTBEAT = 60
+
+
+class WorkQueue:
+    """Claims tasks through lock files in a (shared) queue folder.
+
+    Parameters
+    ----------
+    queue_dir : str
+        Path to the queue folder (has to be the same for all hosts).
+    worker_id : str (optional)
+        Unique name of the worker, default is built from host name and PID.
+    lease_timeout : float
+        Seconds without heartbeat after which a task is considered abandoned.
+    heartbeat : float
+        Seconds between heartbeats (has to be well below lease_timeout).
+    """
+    def __init__(self, queue_dir, worker_id=None, lease_timeout=LEASE_TIMEOUT,
+                 heartbeat=HEARTBEAT):
+        self.queue_dir = queue_dir
+        os.makedirs(queue_dir, exist_ok=True)
+        if worker_id is None:
+            worker_id = f"{socket.gethostname()}-{os.getpid()}-" \
+                        f"{uuid.uuid4().hex[:6]}"
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+
+        # Tasks currently held by this worker and tokens of their claims (kept
+        # alive by the heartbeat)
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._beat = None
+
+    def _path(self, task_id, ext):
+        return os.path.join(self.queue_dir, f"{task_id}.{ext}")
+
+    def is_done(self, task_id):
+        return os.path.isfile(self._path(task_id, "done"))
+
+    def is_failed(self, task_id):
+        return os.path.isfile(self._path(task_id, "failed"))
+
+    def is_finished(self, task_id):
+        return self.is_done(task_id) or self.is_failed(task_id)
+
+    def result(self, task_id):
+        """Returns result saved by the worker that finished the task."""
+        try:
+            with open(self._path(task_id, "done")) as f:
+                return json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _read_lock(lock_pth):
+        """Returns content of the lock file (None if it is missing or not
+        written yet)."""
+        try:
+            with open(lock_pth) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def owner(self, task_id):
+        """Returns worker ID written in the lock file (None if not locked)."""
+        return (self._read_lock(self._path(task_id, "lock")) or {}).get(
+            "worker")
+
+    def _owns(self, task_id, token):
+        """Returns True if the lock file holds the token of the claim."""
+        info = self._read_lock(self._path(task_id, "lock"))
+        return bool(info) and info.get("token") == token
+
+    def _create_lock(self, task_id, token):
+        """Atomically creates the lock file with the token of the claim,
+        returns False if it exists. The token is read back, so the claim also
+        fails if the file system did not honour the exclusive creation."""
+        try:
+            fd = os.open(self._path(task_id, "lock"),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker_id, "token": token,
+                       "claimed": time.time()}, f)
+        return self._owns(task_id, token)
+
+    def _server_time(self):
+        """Returns current time of the file server: modification time of a
+        probe file of this worker in the queue folder after touching it."""
+        probe_pth = os.path.join(self.queue_dir, f".clock-{self.worker_id}")
+        with open(probe_pth, "a"):
+            pass
+        os.utime(probe_pth)
+        return os.path.getmtime(probe_pth)
+
+    def _lock_age(self, lock_pth):
+        """Returns seconds since the last heartbeat of the lock on the clock
+        of the file server (None if the lock is missing)."""
+        now = self._server_time()
+        try:
+            return now - os.path.getmtime(lock_pth)
+        except OSError:
+            return None
+
+    def _steal(self, task_id, seen):
+        """Removes an abandoned lock (with content seen), returns True if the
+        lock was removed.
+
+        The lock is first renamed to a name unique to this worker, so only one
+        of the workers that found it can remove it. The renamed file is removed
+        in any case, it is only counted as stolen if it still is the lock that
+        was seen and has not had a heartbeat in the meantime. A fresh lock that
+        was renamed by mistake is not put back (that could replace a lock
+        created meanwhile), its owner re-creates it with the next heartbeat.
+        """
+        lock_pth = self._path(task_id, "lock")
+        stale_pth = self._path(task_id, f"stale-{self.worker_id}")
+        try:
+            os.rename(lock_pth, stale_pth)
+        except OSError:
+            return False
+        try:
+            age = self._lock_age(stale_pth)
+            stolen = self._read_lock(stale_pth) == seen and \
+                age is not None and age >= self.lease_timeout
+        finally:
+            try:
+                os.remove(stale_pth)
+            except OSError:
+                pass
+        if stolen:
+            print(f" > Stealing abandoned task {task_id}")
+        return stolen
+
+    def claim(self, task_id):
+        """Tries to claim the task, returns True if task is now held by this
+        worker."""
+        if self.is_finished(task_id):
+            return False
+        token = uuid.uuid4().hex
+        if not self._create_lock(task_id, token):
+            lock_pth = self._path(task_id, "lock")
+            seen = self._read_lock(lock_pth)
+            age = self._lock_age(lock_pth)
+            if age is None or age < self.lease_timeout:
+                return False
+            if not (self._steal(task_id, seen) and
+                    self._create_lock(task_id, token)):
+                return False
+
+        # Task could have been finished just before the lock was created
+        if self.is_finished(task_id):
+            self._remove_lock(task_id, token)
+            return False
+
+        with self._lock:
+            self._held[task_id] = token
+        return True
+
+    def _remove_lock(self, task_id, token):
+        if self._owns(task_id, token):
+            try:
+                os.remove(self._path(task_id, "lock"))
+            except OSError:
+                pass
+
+    def release(self, task_id, result=None, error=None):
+        """Marks held task as done (or failed if error is given) and removes
+        the lock."""
+        with self._lock:
+            token = self._held.pop(task_id, None)
+        if not self._owns(task_id, token):
+            print(f" > WARNING: lease on task {task_id} was lost (lease timeout "
+                  f"too short?)")
+
+        status = "failed" if error else "done"
+        tmp_pth = self._path(task_id, f"{status}-{self.worker_id}")
+        with open(tmp_pth, "w") as f:
+            json.dump({
+                "worker": self.worker_id,
+                "finished": time.time(),
+                "result": result,
+                "error": error
+            }, f)
+        os.replace(tmp_pth, self._path(task_id, status))
+        self._remove_lock(task_id, token)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self._held.items())
+            for task_id, token in held:
+                if self._owns(task_id, token):
+                    try:
+                        os.utime(self._path(task_id, "lock"))
+                    except OSError:
+                        pass
+                elif not os.path.exists(self._path(task_id, "lock")):
+                    # Lock was removed by a worker that took it for an
+                    # abandoned one
+                    self._create_lock(task_id, token)
+
+    def start(self):
+        """Starts the heartbeat thread."""
+        if self._beat is None:
+            self._stop.clear()
+            self._beat = threading.Thread(target=self._heartbeat_loop,
+                                          daemon=True)
+            self._beat.start()
+
+    def stop(self):
+        """Stops the heartbeat thread."""
+        if self._beat is not None:
+            self._stop.set()
+            self._beat.join()
+            self._beat = None
+        try:
+            os.remove(os.path.join(self.queue_dir, f".clock-{self.worker_id}"))
+        except OSError:
+            pass
+
+    def run(self, tasks, process_fn, poll=None):
+        """Processes tasks until all of them are finished (by any worker).
+
+        Parameters
+        ----------
+        tasks : list(dict)
+            Each task is a dictionary with a unique "id" (also used as a file
+            name) and an optional list "requires" of task IDs that have to be
+            done before the task can be claimed. Task list has to be the same
+            for all workers.
+        process_fn : function
+            Called with the task as the only argument, return value has to be
+            JSON serializable (it is saved in the .done file).
+        poll : float (optional)
+            Seconds to wait when all unfinished tasks are held by other
+            workers, default is a quarter of the heartbeat.
+
+        Returns
+        -------
+        processed : list(str)
+            IDs of tasks processed by this worker.
+        """
+        if poll is None:
+            poll = self.heartbeat / 4
+        processed = []
+        self.start()
+        try:
+            while True:
+                pending = [a for a in tasks if not self.is_finished(a["id"])]
+                if not pending:
+                    break
+                claimed = False
+                for task in pending:
+                    required = task.get("requires", [])
+                    if not all(self.is_done(a) for a in required):
+                        if any(self.is_failed(a) for a in required):
+                            if self.claim(task["id"]):
+                                self.release(task["id"],
+                                             error="Required task failed")
+                        continue
+                    if not self.claim(task["id"]):
+                        continue
+                    claimed = True
+                    print(f"\n[{self.worker_id}] Claimed task {task['id']}")
+                    try:
+                        result = process_fn(task)
+                    except Exception:
+                        self.release(task["id"], error=traceback.format_exc())
+                        print(f"[{self.worker_id}] Task {task['id']} FAILED")
+                    else:
+                        self.release(task["id"], result=result)
+                        processed.append(task["id"])
+                    break
+                if not claimed:
+                    time.sleep(poll)
+        finally:
+            self.stop()
+
+        return processed
+
+    def summary(self, tasks):
+        """Returns number of done, failed, claimed and waiting tasks."""
+        out = {"done": 0, "failed": 0, "claimed": 0, "waiting": 0}
+        for task in tasks:
+            if self.is_done(task["id"]):
+                out["done"] += 1
+            elif self.is_failed(task["id"]):
+                out["failed"] += 1
+            elif os.path.isfile(self._path(task["id"], "lock")):
+                out["claimed"] += 1
+            else:
+                out["waiting"] += 1
+        return out
+
+
+def _demo_task(task):
+    """Task for the local test (appends own PID to the task log)."""
+    time.sleep(task["sleep"])
+    with open(task["log"], "a") as f:
+        f.write(f"{task['id']} {os.getpid()}\n")
+    return os.getpid()
+
+
+def _demo_worker(queue_dir, tasks, crash_after=None):
+    queue = WorkQueue(queue_dir, lease_timeout=2, heartbeat=0.5)
+    if crash_after is not None:
+        # Simulate a host that dies while holding a task
+        queue.claim(tasks[crash_after]["id"])
+        os._exit(1)
+    queue.run(tasks, _demo_task, poll=0.1)
+
+
+if __name__ == "__main__":
+    # Local test: several processes share one temporary queue folder, one of
+    # them dies while holding a task. Every task has to be processed exactly
+    # once and the abandoned task has to be stolen.
+    import multiprocessing
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_log = os.path.join(tmp_dir, "tasks.log")
+        in_tasks = [{"id": f"task{i:02}", "sleep": 0.2, "log": in_log}
+                    for i in range(20)]
+        in_tasks.append({"id": "final", "sleep": 0, "log": in_log,
+                         "requires": [a["id"] for a in in_tasks]})
+
+        crashed = multiprocessing.Process(target=_demo_worker,
+                                          args=(tmp_dir, in_tasks, 5))
+        crashed.start()
+        crashed.join()
+        workers = [multiprocessing.Process(target=_demo_worker,
+                                           args=(tmp_dir, in_tasks))
+                   for _ in range(4)]
+        [w.start() for w in workers]
+        [w.join() for w in workers]
+
+        with open(in_log) as lf:
+            done = [line.split() for line in lf]
+        done_ids = [a[0] for a in done]
+        assert sorted(done_ids) == sorted(a["id"] for a in in_tasks), done_ids
+        assert done_ids[-1] == "final"
+        print(WorkQueue(tmp_dir).summary(in_tasks))
+        print(f"All {len(done_ids)} tasks processed exactly once by "
+              f"{len(set(a[1] for a in done))} workers.")